@@ -22,7 +22,6 @@ ATOM_LIST -> ATOM
 """
 
 from typing import List, Any, Optional
-import ply.yacc as yacc
 from das.atomese_lex import AtomeseLex
 from das.metta_lex import BASIC_TYPE
 from das.exceptions import AtomeseSyntaxError, UndefinedSymbolError
@@ -145,7 +144,7 @@ class AtomeseYacc(BaseYacc):
         super().__init__(**kwargs)
         self.lex_wrap = AtomeseLex()
         super().setup()
-        self.parser = yacc.yacc(module=self)
+        self.parser = self.build_parser()
         self.types = set()
         self.nodes = set()
         named_type_hash = self._get_named_type_hash(BASIC_TYPE)
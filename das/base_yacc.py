@@ -23,12 +23,18 @@ EXPRESSION -> EXPRESSION_OPENNING LIST_OF_EXPRESSIONS EXPRESSION_CLOSING
             | TERMINAL_NAME
 """
 
+from threading import Lock
 from typing import List, Any, Optional
 import ply.yacc as yacc
 from das.expression_hasher import ExpressionHasher
 from das.expression import Expression
 from das.metta_lex import BASIC_TYPE
 
+# Parsing tables of each grammar (parser class). They are built by PLY for
+# the first parser of the grammar and shared by all the others.
+_parsing_tables = {}
+_parsing_tables_lock = Lock()
+
 class BaseYacc:
 
     def __init__(self, **kwargs):
@@ -64,6 +70,25 @@ class BaseYacc:
         if self.action_broker is not None:
             expression = self._typedef(BASIC_TYPE, BASIC_TYPE)
             self.action_broker.new_top_level_typedef_expression(expression)
+
+    def build_parser(self):
+        # yacc.yacc() isn't thread safe (and writes the tables to disk) so
+        # tables are built only once per grammar. Each parser gets its own
+        # productions bound to its rule methods.
+        with _parsing_tables_lock:
+            if type(self) not in _parsing_tables:
+                parser = yacc.yacc(module=self, write_tables=False, debug=False)
+                _parsing_tables[type(self)] = (
+                    parser.action,
+                    parser.goto,
+                    [(p.str, p.name, p.len, p.func, p.file, p.line) for p in parser.productions])
+        action, goto, productions = _parsing_tables[type(self)]
+        table = yacc.LRTable()
+        table.lr_action = action
+        table.lr_goto = goto
+        table.lr_productions = [yacc.MiniProduction(*production) for production in productions]
+        table.bind_callables({p.func: getattr(self, p.func) for p in table.lr_productions if p.func})
+        return yacc.LRParser(table, self.p_error)
         
     def _get_terminal_hash(self, named_type, terminal_name):
         key = (named_type, terminal_name)
@@ -202,16 +227,16 @@ class BaseYacc:
 
     def parse(self, input_string):
         self.file_name = ""
-        return self.parser.parse(input_string)
+        return self.parser.parse(input_string, lexer=self.lexer)
 
     def parse_action_broker_input(self):
         self.file_name = self.action_broker.file_path
         input_string = self.action_broker.input_string
-        return self.parser.parse(input_string)
+        return self.parser.parse(input_string, lexer=self.lexer)
 
     def check(self, input_string):
         self.file_name = ""
         self.check_mode = True
-        answer = self.parser.parse(input_string)
+        answer = self.parser.parse(input_string, lexer=self.lexer)
         self.check_mode = False
         return answer
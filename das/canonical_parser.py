@@ -1,16 +1,19 @@
 from enum import Enum, auto
 import datetime
+import multiprocessing
 import subprocess
 import pickle
-import sys
 import os
+import shutil
 from das.logger import logger
 from das.expression_hasher import ExpressionHasher
-from das.database.key_value_schema import CollectionNames as KeyPrefix, build_redis_key
+from das.database.key_value_schema import CollectionNames as KeyPrefix, build_redis_key, \
+    get_target_type_hashes, PatternIndexPolicy
 from das.database.mongo_schema import CollectionNames as MongoCollections
-from das.key_value_file import write_key_value, key_value_generator, key_value_targets_generator, sort_file
+from das.key_value_file import write_key_value, key_value_generator, key_value_targets_generator
 import das.key_value_file
-from das.database.db_interface import WILDCARD
+from das.mongo_writer import MongoWriter, connect_mongo_db
+from das.redis_bulk_loader import RedisBulkLoader
 
 class State(str, Enum):
     READING_TYPES = auto()
@@ -22,38 +25,90 @@ def _file_line_count(file_name):
     output = subprocess.run(["wc", "-l", file_name], stdout=subprocess.PIPE)
     return int(output.stdout.split()[0])
 
-EXPRESSIONS_CHUNK_SIZE = 10000000
+# Documents are sent to MongoDB in batches of fixed size (see MongoWriter) so
+# memory usage doesn't depend on the size of the knowledge base
+EXPRESSIONS_CHUNK_SIZE = 100000
+TERMINALS_CHUNK_SIZE = 100000
 HINT_FILE_SIZE = None
 TMP_DIR = '/tmp'
 #TMP_DIR = '/mnt/HD10T/nfs_share/work/tmp'
-SKIP_KEY_VALUE_FILES_GENERATION = False
-SKIP_PARSER = SKIP_KEY_VALUE_FILES_GENERATION or False
+# Max number of memoized terminal hashes (the cache is cleared when it's full)
+TERMINAL_HASH_CACHE_SIZE = 1000000
+# Load Redis with pipelined commands (see RedisBulkLoader) instead of one
+# round trip per key
+REDIS_BULK_LOAD = True
 
 class CanonicalParser:
 
-    def __init__(self, db, allow_duplicates):
+    def __init__(self, db, allow_duplicates, processes=1, worker_id=None, manifest=None):
         self.current_line_count = None
+        self.current_state = None
+        self.current_line = None
         self.mongo_typedef = []
         self.mongo_terminal = []
         self.mongo_expression = []
         self.typedef_mark_hash = ExpressionHasher.named_type_hash(":")
         self.base_type_hash = ExpressionHasher.named_type_hash("Type")
         self.db = db
+        self.mongo_db = db.mongo_db if db is not None else None
         self.allow_duplicates = allow_duplicates
+        self.mongo_writer = None
+        # Number of processes used to parse the expressions of each file
+        self.processes = processes
+        # Set in the worker processes (see _parse_expression_range())
+        self.worker_id = worker_id
+        suffix = "" if worker_id is None else f"_{worker_id}"
         self.temporary_file_name = {
-            s.value: f"{TMP_DIR}/parser_{s.value}.txt" for s in KeyPrefix
+            s.value: f"{TMP_DIR}/parser_{s.value}{suffix}.txt" for s in KeyPrefix
         }
-        for fname in self.temporary_file_name.values():
-            try:
-                os.remove(fname)
-            except Exception as e:
-                logger().info(f"Temp file doesn't exist: {fname}")
+        # Progress of the load (see LoadManifest). Resumed loads keep the
+        # key-value files written before the last checkpoint.
+        self.manifest = manifest
+        # Set when a chunk of expressions is sent to MongoDB
+        self.expressions_flushed = False
+        if manifest is None or not manifest.resumed:
+            for fname in self.temporary_file_name.values():
+                try:
+                    os.remove(fname)
+                except Exception as e:
+                    logger().info(f"Temp file doesn't exist: {fname}")
         self.pattern_black_list = None
+        # Memoized hashes (named and composite types are few, terminal
+        # hashes are kept up to TERMINAL_HASH_CACHE_SIZE terminals)
+        self.named_type_hash = {}
+        self.composite_type_hash = {}
+        self.terminal_hash = {}
+        self.pattern_index_policy = PatternIndexPolicy()
+
+
+    def _named_type_hash(self, name):
+        named_type_hash = self.named_type_hash.get(name, None)
+        if named_type_hash is None:
+            named_type_hash = ExpressionHasher.named_type_hash(name)
+            self.named_type_hash[name] = named_type_hash
+        return named_type_hash
+
+    def _terminal_hash(self, stype, name):
+        key = (stype, name)
+        terminal_hash = self.terminal_hash.get(key, None)
+        if terminal_hash is None:
+            terminal_hash = ExpressionHasher.terminal_hash(stype, name)
+            if len(self.terminal_hash) >= TERMINAL_HASH_CACHE_SIZE:
+                self.terminal_hash.clear()
+            self.terminal_hash[key] = terminal_hash
+        return terminal_hash
 
+    def _composite_type_hash(self, hash_list):
+        key = tuple(hash_list)
+        composite_type_hash = self.composite_type_hash.get(key, None)
+        if composite_type_hash is None:
+            composite_type_hash = ExpressionHasher.composite_hash(hash_list)
+            self.composite_type_hash[key] = composite_type_hash
+        return composite_type_hash
 
     def _add_typedef(self, name, stype):
-        stype_hash = ExpressionHasher.named_type_hash(stype)
-        name_hash = ExpressionHasher.named_type_hash(name)
+        stype_hash = self._named_type_hash(stype)
+        name_hash = self._named_type_hash(name)
         composite_type = [self.typedef_mark_hash, stype_hash, self.base_type_hash]
         composite_type_hash = ExpressionHasher.composite_hash(composite_type)
         id_hash = ExpressionHasher.expression_hash(self.typedef_mark_hash, [name_hash, stype_hash])
@@ -63,25 +118,30 @@ class CanonicalParser:
             "named_type": name,
             "named_type_hash": name_hash,
         })
-            
+        if len(self.mongo_typedef) >= TERMINALS_CHUNK_SIZE:
+            self._flush_terminals()
+
     def _add_terminal(self, name, stype):
-        stype_hash = ExpressionHasher.named_type_hash(stype)
-        name_hash = ExpressionHasher.named_type_hash(name)
-        id_hash = ExpressionHasher.terminal_hash(stype, name)
+        stype_hash = self._named_type_hash(stype)
+        id_hash = self._terminal_hash(stype, name)
         self.mongo_terminal.append({
             "_id": id_hash,
             "composite_type_hash": stype_hash,
             "name": name,
             "named_type": stype,
         })
+        if len(self.mongo_terminal) >= TERMINALS_CHUNK_SIZE:
+            self._flush_terminals()
 
     def _flush_mongo_expressions(self):
         logger().info(f"Populating MongoDB link tables")
         self._populate_mongo_links()
+        self._write_key_value_files(self.mongo_expression)
         self.mongo_expression = []
 
     def _add_expression(self, expression, composite_type, toplevel, named_type, composite_type_hash):
-        named_type_hash = ExpressionHasher.named_type_hash(named_type)
+        # Returns the handle of the expression
+        named_type_hash = self._named_type_hash(named_type)
         id_hash = ExpressionHasher.expression_hash(named_type_hash, expression[1:])
         document = {
             "_id": id_hash,
@@ -97,31 +157,13 @@ class CanonicalParser:
         if len(self.mongo_expression) >= EXPRESSIONS_CHUNK_SIZE:
             logger().info(f"Expression chunk size reached.")
             self._flush_mongo_expressions()
-
-    def _mongo_insert_many(self, collection, bulk_insertion_raw):
-        all_ids = set()
-        bulk_insertion_no_duplicates = []
-        for d in bulk_insertion_raw:
-            if d["_id"] not in all_ids:
-                all_ids.add(d["_id"])
-                bulk_insertion_no_duplicates.append(d)
-        bulk_insertion = [d for d in bulk_insertion_no_duplicates if ("name" not in d) or sys.getsizeof(d["name"]) < 16000000]
-        if len(bulk_insertion_no_duplicates) != len(bulk_insertion):
-            logger().error(f"Striped {len(bulk_insertion_no_duplicates) - len(bulk_insertion)} too large documents")
-        try:
-            collection.insert_many(bulk_insertion, ordered=False)
-        except Exception as e:
-            if not self.allow_duplicates:
-                logger().error(str(e))
+            self.expressions_flushed = True
+        return id_hash
 
     def _flush_terminals(self):
         logger().info(f"Flushing terminals")
-        if self.mongo_typedef:
-            mongo_collection = self.db.mongo_db[MongoCollections.ATOM_TYPES]
-            self._mongo_insert_many(mongo_collection, self.mongo_typedef)
-        if self.mongo_terminal:
-            mongo_collection = self.db.mongo_db[MongoCollections.NODES]
-            self._mongo_insert_many(mongo_collection, self.mongo_terminal)
+        self.mongo_writer.write(MongoCollections.ATOM_TYPES, self.mongo_typedef)
+        self.mongo_writer.write(MongoCollections.NODES, self.mongo_terminal)
         with open(self.temporary_file_name[KeyPrefix.NAMED_ENTITIES], "a") as named_entities:
             for document in self.mongo_terminal:
                 write_key_value(named_entities, document["_id"], document["name"])
@@ -129,64 +171,45 @@ class CanonicalParser:
         self.mongo_terminal = []
         logger().info(f"Terminals flushed")
 
-    def _sort_files(self):
-        sort_file(self.temporary_file_name[KeyPrefix.OUTGOING_SET])
-        sort_file(self.temporary_file_name[KeyPrefix.INCOMING_SET])
-        sort_file(self.temporary_file_name[KeyPrefix.PATTERNS])
-        sort_file(self.temporary_file_name[KeyPrefix.TEMPLATES])
-
-    def _build_key_value_files(self):
-        outgoing = open(self.temporary_file_name[KeyPrefix.OUTGOING_SET], "w")
-        incoming = open(self.temporary_file_name[KeyPrefix.INCOMING_SET], "w")
-        patterns = open(self.temporary_file_name[KeyPrefix.PATTERNS], "w")
-        template = open(self.temporary_file_name[KeyPrefix.TEMPLATES], "w")
-        for tag in [MongoCollections.LINKS_ARITY_1, MongoCollections.LINKS_ARITY_2, MongoCollections.LINKS_ARITY_N]:
-            mongo_collection = self.db.mongo_db[tag]
-            for expression in mongo_collection.find():
-                elements = [expression[k] for k in expression.keys() if k.startswith("key")]
-                for target in elements:
-                    write_key_value(outgoing, expression["_id"], target)
-                    write_key_value(incoming, target, expression["_id"])
-                if expression["named_type"] not in self.pattern_black_list:
-                    arity = len(elements)
-                    type_hash = expression["named_type_hash"]
-                    keys = []
-                    keys.append([WILDCARD, *elements])
-                    if arity == 1:
-                        keys.append([type_hash, WILDCARD])
-                        keys.append([WILDCARD, elements[0]])
-                        keys.append([WILDCARD, WILDCARD])
-                    elif arity == 2:
-                        keys.append([type_hash, elements[0], WILDCARD])
-                        keys.append([type_hash, WILDCARD, elements[1]])
-                        keys.append([type_hash, WILDCARD, WILDCARD])
-                        keys.append([WILDCARD, elements[0], elements[1]])
-                        keys.append([WILDCARD, elements[0], WILDCARD])
-                        keys.append([WILDCARD, WILDCARD, elements[1]])
-                        keys.append([WILDCARD, WILDCARD, WILDCARD])
-                    elif arity == 3:
-                        keys.append([type_hash, elements[0], elements[1], WILDCARD])
-                        keys.append([type_hash, elements[0], WILDCARD, elements[2]])
-                        keys.append([type_hash, WILDCARD, elements[1], elements[2]])
-                        keys.append([type_hash, elements[0], WILDCARD, WILDCARD])
-                        keys.append([type_hash, WILDCARD, elements[1], WILDCARD])
-                        keys.append([type_hash, WILDCARD, WILDCARD, elements[2]])
-                        keys.append([type_hash, WILDCARD, WILDCARD, WILDCARD])
-                        keys.append([WILDCARD, elements[0], elements[1], elements[2]])
-                        keys.append([WILDCARD, elements[0], elements[1], WILDCARD])
-                        keys.append([WILDCARD, elements[0], WILDCARD, elements[2]])
-                        keys.append([WILDCARD, WILDCARD, elements[1], elements[2]])
-                        keys.append([WILDCARD, elements[0], WILDCARD, WILDCARD])
-                        keys.append([WILDCARD, WILDCARD, elements[1], WILDCARD])
-                        keys.append([WILDCARD, WILDCARD, WILDCARD, elements[2]])
-                        keys.append([WILDCARD, WILDCARD, WILDCARD, WILDCARD])
-                for key in keys:
-                    write_key_value(patterns, key, [expression["_id"], *elements])
-                write_key_value(template, expression["composite_type_hash"], [expression["_id"], *elements])
-                write_key_value(template, expression["named_type_hash"], [expression["_id"], *elements])
+    def _write_key_value_files(self, expressions):
+        # Key-value records are generated from the batches sent to MongoDB so
+        # the link collections don't need to be read back after parsing
+        outgoing = open(self.temporary_file_name[KeyPrefix.OUTGOING_SET], "a")
+        incoming = open(self.temporary_file_name[KeyPrefix.INCOMING_SET], "a")
+        patterns = open(self.temporary_file_name[KeyPrefix.PATTERNS], "a")
+        template = open(self.temporary_file_name[KeyPrefix.TEMPLATES], "a")
+        written = set()
+        for expression in expressions:
+            if expression["_id"] in written:
+                continue
+            written.add(expression["_id"])
+            elements = [expression[k] for k in expression.keys() if k.startswith("key")]
+            for target in elements:
+                write_key_value(outgoing, expression["_id"], target)
+                write_key_value(incoming, target, expression["_id"])
+            keys = []
+            if expression["named_type"] not in self.pattern_black_list:
+                keys = self.pattern_index_policy.pattern_keys(
+                    expression["named_type"],
+                    expression["named_type_hash"],
+                    elements,
+                    get_target_type_hashes(expression["composite_type"]))
+            for key in keys:
+                write_key_value(patterns, key, [expression["_id"], *elements])
+            write_key_value(template, expression["composite_type_hash"], [expression["_id"], *elements])
+            write_key_value(template, expression["named_type_hash"], [expression["_id"], *elements])
         for file in [outgoing, incoming, patterns, template]:
             file.close()
-        self._sort_files()
+
+    def _merge_worker_files(self, worker_ids):
+        for collection_name, file_name in self.temporary_file_name.items():
+            with open(file_name, "a") as output:
+                for worker_id in worker_ids:
+                    worker_file_name = f"{TMP_DIR}/parser_{collection_name}_{worker_id}.txt"
+                    if os.path.exists(worker_file_name):
+                        with open(worker_file_name, "r") as worker_file:
+                            shutil.copyfileobj(worker_file, output)
+                        os.remove(worker_file_name)
 
     def _populate_mongo_links(self):
         bulk_insertion_1 = []
@@ -201,46 +224,56 @@ class CanonicalParser:
                 bulk_insertion_2.append(expression)
             else:
                 bulk_insertion_N.append(expression)
-        if bulk_insertion_1:
-            mongo_collection = self.db.mongo_db[MongoCollections.LINKS_ARITY_1]
-            self._mongo_insert_many(mongo_collection, bulk_insertion_1)
-        if bulk_insertion_2:
-            mongo_collection = self.db.mongo_db[MongoCollections.LINKS_ARITY_2]
-            self._mongo_insert_many(mongo_collection, bulk_insertion_2)
-        if bulk_insertion_N:
-            mongo_collection = self.db.mongo_db[MongoCollections.LINKS_ARITY_N]
-            self._mongo_insert_many(mongo_collection, bulk_insertion_N)
-
-    def _populate_redis_collection(self, collection_name, use_targets, merge_rest, update):
+        self.mongo_writer.write(MongoCollections.LINKS_ARITY_1, bulk_insertion_1)
+        self.mongo_writer.write(MongoCollections.LINKS_ARITY_2, bulk_insertion_2)
+        self.mongo_writer.write(MongoCollections.LINKS_ARITY_N, bulk_insertion_N)
+
+    def _populate_redis_collection(self, collection_name, use_targets, merge_rest, update, sort):
         logger().info(f"Populating collection {collection_name}")
         file_name = self.temporary_file_name[collection_name]
         generator = key_value_targets_generator if use_targets else key_value_generator
         key_count = 0
-        for key, value, block_count in generator(file_name, block_size=100000, merge_rest=merge_rest):
+        # With REDIS_BULK_LOAD, commands are sent in batches so errors may be
+        # reported a few keys after the one which caused them
+        bulk_loader = RedisBulkLoader(self.db.redis) if REDIS_BULK_LOAD else None
+        # Links which appear in more than one batch are written more than
+        # once in the key-value files so duplicated lines are dropped
+        key_values = generator(file_name, block_size=100000, merge_rest=merge_rest, sort=sort, unique=sort)
+        if self.manifest is not None:
+            # Keys are sorted in the same order every time so a resumed load
+            # skips the ones uploaded before the last checkpoint
+            key_values = self.manifest.track(
+                f"redis:{collection_name}",
+                key_values,
+                bulk_loader.flush if bulk_loader is not None else lambda: None)
+        for key, value, block_count in key_values:
             key_count += 1
             if key_count % 100000 == 0:
                 logger().info(f"Added {key_count} keys (line count = {das.key_value_file.KEY_VALUE_LINE_COUNTER})")
             try:
                 if use_targets:
-                    self.db.redis.sadd(build_redis_key(collection_name, key), *[pickle.dumps(v) for v in value])
+                    members = [pickle.dumps(v) for v in value]
+                else:
+                    members = value
+                if bulk_loader is not None:
+                    bulk_loader.sadd(build_redis_key(collection_name, key), members)
                 else:
-                    self.db.redis.sadd(build_redis_key(collection_name, key), *value)
+                    self.db.redis.sadd(build_redis_key(collection_name, key), *members)
             except:
                 logger().error(f"Error in key-value file {collection_name} on line {das.key_value_file.KEY_VALUE_LINE_COUNTER}")
                 assert False
+        if bulk_loader is not None:
+            bulk_loader.close()
 
     def _populate_redis(self):
-        self._populate_redis_collection(KeyPrefix.OUTGOING_SET, False, False, False),
-        self._populate_redis_collection(KeyPrefix.INCOMING_SET, False, False, False),
-        self._populate_redis_collection(KeyPrefix.PATTERNS, True, False, False),
-        self._populate_redis_collection(KeyPrefix.TEMPLATES, True, False, False),
-        self._populate_redis_collection(KeyPrefix.NAMED_ENTITIES, False, True, False)
+        self._populate_redis_collection(KeyPrefix.OUTGOING_SET, False, False, False, True),
+        self._populate_redis_collection(KeyPrefix.INCOMING_SET, False, False, False, True),
+        self._populate_redis_collection(KeyPrefix.PATTERNS, True, False, False, True),
+        self._populate_redis_collection(KeyPrefix.TEMPLATES, True, False, False, True),
+        self._populate_redis_collection(KeyPrefix.NAMED_ENTITIES, False, True, False, False)
 
     def _process_key_value_files(self):
         logger().info(f"Populating Redis")
-        if not SKIP_KEY_VALUE_FILES_GENERATION:
-            logger().info(f"Building key-value files")
-            self._build_key_value_files()
         logger().info(f"Processing key-value files")
         self._populate_redis()
         logger().info(f"Redis is up to date")
@@ -261,7 +294,7 @@ class CanonicalParser:
                         s = "".join(slist)
                         stack.append(s)
                         named_type_stack.append(s)
-                        named_type_hash = ExpressionHasher.named_type_hash(s)
+                        named_type_hash = self._named_type_hash(s)
                         composite_type_stack.append(named_type_hash)
                         composite_type_hash_stack.append(named_type_hash)
                         slist = []
@@ -279,10 +312,9 @@ class CanonicalParser:
                     expression.reverse()
                     composite_type.reverse()
                     hash_list.reverse()
-                    composite_type_hash = ExpressionHasher.composite_hash(hash_list)
+                    composite_type_hash = self._composite_type_hash(hash_list)
                     if stack:
-                        self._add_expression(expression, composite_type, False, named_type, composite_type_hash)
-                        id_hash = ExpressionHasher.expression_hash(ExpressionHasher.named_type_hash(named_type), expression[1:])
+                        id_hash = self._add_expression(expression, composite_type, False, named_type, composite_type_hash)
                         stack.append(id_hash)
                         named_type_stack.append(":")
                         composite_type_stack.append(composite_type)
@@ -298,9 +330,9 @@ class CanonicalParser:
                     s = "".join(slist).split()
                     stype = s[0]
                     name = " ".join(s[1:])
-                    stack.append(ExpressionHasher.terminal_hash(stype, name))
+                    stack.append(self._terminal_hash(stype, name))
                     named_type_stack.append(stype)
-                    named_type_hash = ExpressionHasher.named_type_hash(stype)
+                    named_type_hash = self._named_type_hash(stype)
                     composite_type_stack.append(named_type_hash)
                     composite_type_hash_stack.append(named_type_hash)
                     slist = []
@@ -318,54 +350,206 @@ class CanonicalParser:
     def populate_indexes(self):
         self._process_key_value_files()
 
+    def _parse_line(self, line):
+        self.current_line = line.strip()
+        self.current_line_count += 1
+        expression = self.current_line.split()
+        if self.current_state == State.READING_TYPES:
+            self._check(expression[0] == "(:")
+            if expression[1].startswith("\""):
+                self.current_state = State.READING_TERMINALS
+                logger().info(f"Parsing terminals")
+            else:
+                self._check(len(expression) == 3)
+                type_name = expression[1]
+                stype = expression[-1].rstrip(")")
+                self._add_typedef(type_name, stype)
+        if self.current_state == State.READING_TERMINALS:
+            if expression[0] == "(:":
+                terminal_name = " ".join(expression[1:-1]).strip("\"")
+                stype = expression[-1].rstrip(")")
+                self._add_terminal(terminal_name, stype)
+            else:
+                self.current_state = State.READING_EXPRESSIONS
+                self._flush_terminals()
+                logger().info(f"Parsing expressions")
+        if self.current_state == State.READING_EXPRESSIONS:
+            self._check(expression[0] != "(:")
+            self._check(self.current_line.startswith("("))
+            self._check(self.current_line.endswith(")"))
+            self._parse_expression(self.current_line)
+
+    def _split_expressions(self, path, offset):
+        # Byte ranges (at line boundaries) of the expressions section, one
+        # per process
+        file_size = os.path.getsize(path)
+        boundaries = [offset]
+        with open(path, "rb") as file:
+            for i in range(1, self.processes):
+                file.seek(offset + (file_size - offset) * i // self.processes)
+                file.readline()
+                position = file.tell()
+                if boundaries[-1] < position < file_size:
+                    boundaries.append(position)
+        boundaries.append(file_size)
+        return [(start, end) for start, end in zip(boundaries[:-1], boundaries[1:]) if start < end]
+
+    def _stage(self, path):
+        return f"parse:{os.path.abspath(path)}"
+
+    def _resume_state(self, path):
+        # State of the parsing of the file recorded by the last checkpoint
+        if self.manifest is None:
+            return None
+        return self.manifest.get(self._stage(path))
+
+    def _spill_file_sizes(self):
+        return {
+            name: os.path.getsize(file_name) if os.path.exists(file_name) else 0
+            for name, file_name in self.temporary_file_name.items()}
+
+    def _truncate_spill_files(self):
+        # Drop what was written to the key-value files after the last
+        # checkpoint
+        sizes = self.manifest.get("spill_sizes", {})
+        for name, file_name in self.temporary_file_name.items():
+            with open(file_name, "a") as file:
+                file.truncate(sizes.get(name, 0))
+
+    def _checkpoint(self, path, state):
+        # Everything parsed so far must be in MongoDB and in the key-value
+        # files before the state is recorded
+        self.mongo_writer.flush()
+        self.manifest.set_many({
+            self._stage(path): state,
+            "spill_sizes": self._spill_file_sizes(),
+        })
+
+    def _parse_in_parallel(self, path, state):
+        # Typedefs and terminals are parsed here. Expressions are parsed in
+        # a process pool, each process inserting its own MongoDB batches and
+        # writing its own key-value files, which are merged as each process
+        # finishes.
+        if state is None:
+            offset = 0
+            with open(path, "rb") as file:
+                for line in file:
+                    if not line.startswith(b"(:"):
+                        break
+                    self._parse_line(line.decode())
+                    offset += len(line)
+            self.current_state = State.READING_EXPRESSIONS
+            self._flush_terminals()
+            state = {
+                "ranges": self._split_expressions(path, offset),
+                "done_ranges": [],
+                "line_count": self.current_line_count,
+            }
+            if self.manifest is not None:
+                self._checkpoint(path, state)
+        else:
+            self.current_state = State.READING_EXPRESSIONS
+        ranges = state["ranges"]
+        logger().info(f"Parsing expressions in {len(ranges)} processes")
+        tasks = [
+            (path, start, end, self.mongo_db.name, self.allow_duplicates,
+             self.pattern_black_list, self.pattern_index_policy, ExpressionHasher.algorithm, worker_id)
+            for worker_id, (start, end) in enumerate(ranges) if worker_id not in state["done_ranges"]]
+        with multiprocessing.get_context("spawn").Pool(self.processes) as pool:
+            for worker_id, count in pool.imap_unordered(_parse_expression_range, tasks):
+                self._merge_worker_files([worker_id])
+                state["done_ranges"].append(worker_id)
+                state["line_count"] += count
+                logger().info(f"Parsed {state['line_count']} lines")
+                if self.manifest is not None:
+                    self._checkpoint(path, state)
+        self.current_line_count = state["line_count"]
+
+    def parse_expression_range(self, path, start, end):
+        """
+        Parse the expressions in the passed byte range of a file (which must
+        start and end at line boundaries). Returns the number of parsed
+        lines.
+        """
+        self.current_state = State.READING_EXPRESSIONS
+        self.current_line_count = 0
+        self.mongo_writer = MongoWriter(self.mongo_db, self.allow_duplicates)
+        with open(path, "rb") as file:
+            file.seek(start)
+            position = start
+            while position < end:
+                line = file.readline()
+                if not line:
+                    break
+                position += len(line)
+                self._parse_line(line.decode())
+        self._flush_mongo_expressions()
+        self.mongo_writer.close()
+        self.mongo_writer = None
+        return self.current_line_count
+
     def parse(self, path):
         logger().info(f"Parsing {path}")
-        if SKIP_PARSER:
-            logger().info(f"Skipping parser")
+        state = self._resume_state(path)
+        if state is not None and state.get("done", False):
+            logger().info(f"Skipping {path} (already parsed)")
             return
-        logger().info(f"Computing file size")
+        if self.manifest is not None:
+            self._truncate_spill_files()
         self.current_line_count = 1
-        HINT_FILE_SIZE = _file_line_count(path)
-        logger().info(f"Parsing types")
         self.current_state = State.READING_TYPES
-        if HINT_FILE_SIZE is not None:
-            progress_count = 1
-            progress_bound = HINT_FILE_SIZE // 100
-        with open(path, "r") as file:
-            for line in file:
-                if HINT_FILE_SIZE is not None:
-                    if progress_count >= progress_bound:
-                        percent = ("{0:.0f}").format(100 * (self.current_line_count / float(HINT_FILE_SIZE)))
-                        logger().info(f"Parsed {self.current_line_count}/{HINT_FILE_SIZE} ({percent}%)")
-                        progress_count = 1
-                    else:
-                        progress_count += 1
-                self.current_line = line.strip()
-                self.current_line_count += 1
-                expression = self.current_line.split()
-                if self.current_state == State.READING_TYPES:
-                    self._check(expression[0] == "(:")
-                    if expression[1].startswith("\""):
-                        self.current_state = State.READING_TERMINALS
-                        logger().info(f"Parsing terminals")
-                    else:
-                        self._check(len(expression) == 3)
-                        type_name = expression[1]
-                        stype = expression[-1].rstrip(")")
-                        self._add_typedef(type_name, stype)
-                if self.current_state == State.READING_TERMINALS:
-                    if expression[0] == "(:":
-                        terminal_name = " ".join(expression[1:-1]).strip("\"")
-                        stype = expression[-1].rstrip(")")
-                        self._add_terminal(terminal_name, stype)
-                    else:
-                        self.current_state = State.READING_EXPRESSIONS
-                        self._flush_terminals()
-                        logger().info(f"Parsing expressions")
-                if self.current_state == State.READING_EXPRESSIONS:
-                    self._check(expression[0] != "(:")
-                    self._check(self.current_line.startswith("("))
-                    self._check(self.current_line.endswith(")"))
-                    self._parse_expression(self.current_line)
+        self.mongo_writer = MongoWriter(self.mongo_db, self.allow_duplicates)
+        if self.processes > 1:
+            logger().info(f"Parsing types")
+            self._parse_in_parallel(path, state)
+        else:
+            logger().info(f"Computing file size")
+            HINT_FILE_SIZE = _file_line_count(path)
+            logger().info(f"Parsing types")
+            if HINT_FILE_SIZE is not None:
+                progress_count = 1
+                progress_bound = HINT_FILE_SIZE // 100
+            with open(path, "rb") as file:
+                if state is not None:
+                    logger().info(f"Resuming from line {state['line_count']}")
+                    file.seek(state["offset"])
+                    self.current_line_count = state["line_count"]
+                    self.current_state = State.READING_EXPRESSIONS
+                position = file.tell()
+                for line in file:
+                    if HINT_FILE_SIZE is not None:
+                        if progress_count >= progress_bound:
+                            percent = ("{0:.0f}").format(100 * (self.current_line_count / float(HINT_FILE_SIZE)))
+                            logger().info(f"Parsed {self.current_line_count}/{HINT_FILE_SIZE} ({percent}%)")
+                            progress_count = 1
+                        else:
+                            progress_count += 1
+                    self._parse_line(line.decode())
+                    position += len(line)
+                    if self.expressions_flushed and self.manifest is not None:
+                        # Checkpoint once per chunk of expressions
+                        self._flush_mongo_expressions()
+                        self._checkpoint(path, {"offset": position, "line_count": self.current_line_count})
+                    self.expressions_flushed = False
         logger().info(f"Finished parsing file.")
+        if self.current_state != State.READING_EXPRESSIONS:
+            self._flush_terminals()
         self._flush_mongo_expressions()
+        self.mongo_writer.close()
+        self.mongo_writer = None
+        if self.manifest is not None:
+            self.manifest.set_many({
+                self._stage(path): {"done": True},
+                "spill_sizes": self._spill_file_sizes(),
+            })
+
+def _parse_expression_range(task):
+    # Runs in the worker processes of CanonicalParser._parse_in_parallel()
+    path, start, end, database_name, allow_duplicates, pattern_black_list, pattern_index_policy, \
+        hash_algorithm, worker_id = task
+    ExpressionHasher.set_algorithm(hash_algorithm)
+    parser = CanonicalParser(None, allow_duplicates, worker_id=worker_id)
+    parser.pattern_black_list = pattern_black_list
+    parser.pattern_index_policy = pattern_index_policy
+    parser.mongo_db = connect_mongo_db(database_name)
+    return worker_id, parser.parse_expression_range(path, start, end)
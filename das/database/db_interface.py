@@ -1,6 +1,9 @@
+import random
 from abc import ABC, abstractmethod
 from typing import List, Dict, Any, Optional, Tuple
 
+from das.exceptions import UnsupportedOperationError
+
 WILDCARD = '*'
 UNORDERED_LINK_TYPES = ['Similarity', 'Set']
 
@@ -60,6 +63,218 @@ class DBInterface(ABC):
         pass
 
     #############################
+    # Optional lookups. DBs which don't support them keep these defaults:
+    # the hash methods return None, so the pattern matcher falls back to
+    # get_matched_links() and get_matched_type_template(), and the other
+    # methods raise UnsupportedOperationError.
+
+    def get_link_pattern_hash(self, link_type: str, target_handles: List[str]) -> Optional[str]:
+        """
+        Return the key used to index links matching the passed pattern (which
+        may contain WILDCARDs) or None if the DB doesn't support lookups by a
+        precomputed key.
+        """
+        return None
+
+    def get_typed_link_pattern_hash(
+        self,
+        link_type: str,
+        target_handles: List[str],
+        target_types: List[Optional[str]]) -> Optional[str]:
+        """
+        Same as get_link_pattern_hash() for patterns where some WILDCARDs are
+        restricted to targets of a given type (target_types has the type of
+        each typed WILDCARD and None in the other positions).
+        """
+        return None
+
+    def get_matched_typed_links(
+        self,
+        link_type: str,
+        target_handles: List[str],
+        target_types: List[Optional[str]]):
+        """
+        Same as get_matched_links() for patterns with typed WILDCARDs (see
+        get_typed_link_pattern_hash()). Queries with TypedVariable targets in
+        Links need it.
+        """
+        raise UnsupportedOperationError('get_matched_typed_links')
+
+    def get_type_template_hash(self, template: List[Any]) -> Optional[str]:
+        """
+        Same as get_link_pattern_hash() but for type templates.
+        """
+        return None
+
+    def get_matched_pattern(self, pattern_hash: str):
+        """
+        Same as get_matched_links() but using a key previously returned by
+        get_link_pattern_hash() (so it must be overridden along with it).
+        """
+        raise UnsupportedOperationError('get_matched_pattern')
+
+    def get_matched_template(self, template_hash: str) -> List[str]:
+        """
+        Same as get_matched_type_template() but using a key previously returned
+        by get_type_template_hash() (so it must be overridden along with it).
+        """
+        raise UnsupportedOperationError('get_matched_template')
+
+    def get_matched_patterns(self, pattern_hashes: List[str]) -> Dict[str, Any]:
+        """
+        Same as get_matched_pattern() for many keys at once. Returns a dict
+        mapping each key to its matched links.
+        """
+        return {pattern_hash: self.get_matched_pattern(pattern_hash) for pattern_hash in pattern_hashes}
+
+    def get_matched_templates(self, template_hashes: List[str]) -> Dict[str, Any]:
+        """
+        Same as get_matched_template() for many keys at once.
+        """
+        return {template_hash: self.get_matched_template(template_hash) for template_hash in template_hashes}
+
+    def get_matched_links_many(self, link_type: str, patterns: List[List[str]]) -> List[Any]:
+        """
+        Same as get_matched_links() for many target patterns of the same link
+        type at once. Returns the matched links of each pattern (in the same
+        order). Patterns are fetched together through get_matched_patterns()
+        when the DB supports lookups by key.
+        """
+        pattern_hashes = [self.get_link_pattern_hash(link_type, targets) for targets in patterns]
+        if any(pattern_hash is None for pattern_hash in pattern_hashes):
+            return [self.get_matched_links(link_type, targets) for targets in patterns]
+        matched = self.get_matched_patterns(list(set(pattern_hashes)))
+        return [matched[pattern_hash] for pattern_hash in pattern_hashes]
+
+    def links_exist(self, links: List[Tuple[str, List[str]]]) -> List[bool]:
+        """
+        Same as link_exists() for many (link_type, target_handles) pairs at
+        once. DBs should override this to check all the links in a single
+        round trip.
+        """
+        return [self.link_exists(link_type, target_handles) for link_type, target_handles in links]
+
+    def get_link_targets_many(self, link_handles: List[str]) -> Dict[str, List[str]]:
+        """
+        Same as get_link_targets() for many links at once. Returns a dict
+        mapping each link to its targets.
+        """
+        return {handle: self.get_link_targets(handle) for handle in link_handles}
+
+    def get_incoming(self, handle: str, link_type: Optional[str] = None) -> List[str]:
+        """
+        Handles of the links which have the passed atom as one of their
+        targets (only the ones of the passed type if link_type is not None).
+        expand() and get_incoming_many() need it.
+        """
+        raise UnsupportedOperationError('get_incoming')
+
+    def get_incoming_many(
+        self,
+        handles: List[str],
+        link_types: Optional[List[str]] = None) -> Dict[str, List[str]]:
+        """
+        Same as get_incoming() for many atoms at once, optionally restricted
+        to links of any of the passed types. Returns a dict mapping each atom
+        to its incoming links. DBs should override this to fetch all the
+        incoming sets in a single round trip.
+        """
+        if link_types is None:
+            return {handle: self.get_incoming(handle) for handle in handles}
+        return {
+            handle: [link for link_type in link_types for link in self.get_incoming(handle, link_type)]
+            for handle in handles}
+
+    def expand(
+        self,
+        handles: List[str],
+        depth: int,
+        link_types: Optional[List[str]] = None,
+        max_fanout: Optional[int] = None) -> Dict[str, int]:
+        """
+        Neighborhood of the passed atoms. One hop goes from an atom to the
+        other targets of the links (of any of link_types, if passed) which
+        point to it. Returns a dict mapping each atom reached in up to depth
+        hops to its distance (the passed atoms have distance 0).
+
+        Every hop fetches the incoming sets of the whole frontier and the
+        targets of the new links in one batch each. Atoms are expanded only
+        the first time they are reached. If max_fanout is passed, only the
+        first max_fanout incoming links of each atom are followed.
+        """
+        distances = {handle: 0 for handle in handles}
+        frontier = list(distances.keys())
+        for hop in range(1, depth + 1):
+            if not frontier:
+                break
+            incoming = self.get_incoming_many(frontier, link_types)
+            links = {}
+            for handle in frontier:
+                atom_links = incoming.get(handle, [])
+                if max_fanout is not None:
+                    atom_links = atom_links[:max_fanout]
+                for link in atom_links:
+                    links[link] = None
+            frontier = []
+            for targets in self.get_link_targets_many(list(links.keys())).values():
+                for target in targets or []:
+                    if target not in distances:
+                        distances[target] = hop
+                        frontier.append(target)
+        return distances
+
+    def sample_matched_links(
+        self,
+        link_type: str,
+        target_handles: List[str],
+        size: int,
+        target_types: Optional[List[Optional[str]]] = None):
+        """
+        Up to size distinct links drawn uniformly at random from the ones
+        get_matched_links() (or get_matched_typed_links() if target_types is
+        passed) would return. DBs with indexes should override this to avoid
+        fetching all the links.
+        """
+        if target_types is not None:
+            links = list(self.get_matched_typed_links(link_type, target_handles, target_types))
+        else:
+            links = list(self.get_matched_links(link_type, target_handles))
+        return random.sample(links, min(size, len(links)))
+
+    def sample_matched_type_template(self, template: List[Any], size: int) -> List[str]:
+        """
+        Same as sample_matched_links() for get_matched_type_template().
+        """
+        links = list(self.get_matched_type_template(template))
+        return random.sample(links, min(size, len(links)))
+
+    def count_matched_links(
+        self,
+        link_type: str,
+        target_handles: List[str],
+        target_types: Optional[List[Optional[str]]] = None) -> int:
+        """
+        Number of links get_matched_links() (or get_matched_typed_links() if
+        target_types is passed) would return. DBs with indexes should
+        override this to avoid fetching the links.
+        """
+        if target_types is not None:
+            return len(self.get_matched_typed_links(link_type, target_handles, target_types))
+        return len(self.get_matched_links(link_type, target_handles))
+
+    def count_matched_type_template(self, template: List[Any]) -> int:
+        """
+        Number of links get_matched_type_template() would return.
+        """
+        return len(self.get_matched_type_template(template))
+
+    def type_template_matches(self, template: List[Any], link_types: List[Any]) -> bool:
+        """
+        True if get_matched_type_template(template) would return the links
+        whose type and target types are link_types (link type followed by the
+        target types). By default types are matched exactly.
+        """
+        return template == link_types
 
     def get_atom_as_dict(self, handle: str, arity: int):
         pass
@@ -0,0 +1,85 @@
+import heapq
+from typing import Any, Dict, List, Optional, Tuple
+
+# Degrees are counted in power of two buckets: 0, 1, 2-3, 4-7, ...
+def degree_bucket(degree: int) -> int:
+    return 0 if degree == 0 else 1 << (degree.bit_length() - 1)
+
+class DegreeDistribution:
+    """
+    Streaming summary of the degrees of a set of atoms: count, total, max,
+    histogram (see degree_bucket()) and the top_k atoms with the largest
+    degrees (hubs).
+    """
+
+    def __init__(self, top_k: int):
+        self.top_k = top_k
+        self.count = 0
+        self.total = 0
+        self.max = 0
+        self.histogram: Dict[int, int] = {}
+        # Min-heap of (degree, handle) with the top_k largest degrees
+        self.top: List[Tuple[int, str]] = []
+
+    def add(self, handle: str, degree: int) -> None:
+        self.count += 1
+        self.total += degree
+        self.max = max(self.max, degree)
+        bucket = degree_bucket(degree)
+        self.histogram[bucket] = self.histogram.get(bucket, 0) + 1
+        if len(self.top) < self.top_k:
+            heapq.heappush(self.top, (degree, handle))
+        elif self.top and degree > self.top[0][0]:
+            heapq.heapreplace(self.top, (degree, handle))
+
+    def to_dict(self) -> Dict[str, Any]:
+        return {
+            'count': self.count,
+            'total': self.total,
+            'max': self.max,
+            'mean': self.total / self.count if self.count else 0.0,
+            'histogram': dict(sorted(self.histogram.items())),
+            'top': [(handle, degree) for degree, handle in sorted(self.top, reverse=True)],
+        }
+
+class DegreeStatistics:
+    """
+    In-degree (size of the incoming set) and out-degree (size of the outgoing
+    set, i.e. arity of links) distributions over all the atoms and grouped by
+    atom type (link types and node types).
+    """
+
+    def __init__(self, top_k: int):
+        self.top_k = top_k
+        self.in_degree = DegreeDistribution(top_k)
+        self.out_degree = DegreeDistribution(top_k)
+        self.in_degree_by_type: Dict[str, DegreeDistribution] = {}
+        self.out_degree_by_type: Dict[str, DegreeDistribution] = {}
+
+    def _add(
+        self,
+        distribution: DegreeDistribution,
+        by_type: Dict[str, DegreeDistribution],
+        handle: str,
+        atom_type: Optional[str],
+        degree: int) -> None:
+        distribution.add(handle, degree)
+        if atom_type is not None:
+            if atom_type not in by_type:
+                by_type[atom_type] = DegreeDistribution(self.top_k)
+            by_type[atom_type].add(handle, degree)
+
+    def add_in_degree(self, handle: str, atom_type: Optional[str], degree: int) -> None:
+        self._add(self.in_degree, self.in_degree_by_type, handle, atom_type, degree)
+
+    def add_out_degree(self, handle: str, link_type: Optional[str], degree: int) -> None:
+        self._add(self.out_degree, self.out_degree_by_type, handle, link_type, degree)
+
+    def to_dict(self) -> Dict[str, Any]:
+        return {
+            'top_k': self.top_k,
+            'in_degree': self.in_degree.to_dict(),
+            'out_degree': self.out_degree.to_dict(),
+            'in_degree_by_type': {t: d.to_dict() for t, d in sorted(self.in_degree_by_type.items())},
+            'out_degree_by_type': {t: d.to_dict() for t, d in sorted(self.out_degree_by_type.items())},
+        }
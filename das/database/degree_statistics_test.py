@@ -0,0 +1,31 @@
+from das.database.degree_statistics import DegreeDistribution, DegreeStatistics, degree_bucket
+
+def test_degree_bucket():
+    assert [degree_bucket(d) for d in [0, 1, 2, 3, 4, 7, 8, 1000]] == [0, 1, 2, 2, 4, 4, 8, 512]
+
+def test_degree_distribution():
+    distribution = DegreeDistribution(2)
+    for handle, degree in [('a', 3), ('b', 0), ('c', 10), ('d', 1), ('e', 5)]:
+        distribution.add(handle, degree)
+    answer = distribution.to_dict()
+    assert answer['count'] == 5
+    assert answer['total'] == 19
+    assert answer['max'] == 10
+    assert answer['mean'] == 19 / 5
+    assert answer['histogram'] == {0: 1, 1: 1, 2: 1, 4: 1, 8: 1}
+    assert answer['top'] == [('c', 10), ('e', 5)]
+    assert DegreeDistribution(3).to_dict()['mean'] == 0.0
+
+def test_degree_statistics():
+    statistics = DegreeStatistics(1)
+    statistics.add_in_degree('n1', 'Concept', 2)
+    statistics.add_in_degree('n2', 'Concept', 4)
+    statistics.add_in_degree('l1', 'Inheritance', 1)
+    statistics.add_in_degree('x', None, 7)
+    statistics.add_out_degree('l1', 'Inheritance', 2)
+    answer = statistics.to_dict()
+    assert answer['in_degree']['count'] == 4
+    assert answer['in_degree']['top'] == [('x', 7)]
+    assert list(answer['in_degree_by_type'].keys()) == ['Concept', 'Inheritance']
+    assert answer['in_degree_by_type']['Concept']['top'] == [('n2', 4)]
+    assert answer['out_degree_by_type']['Inheritance']['total'] == 2
@@ -1,4 +1,10 @@
+from dataclasses import dataclass, field
 from enum import Enum
+from itertools import product
+from typing import Any, Dict, List, Optional, Tuple
+
+from das.database.db_interface import WILDCARD
+from das.expression_hasher import ExpressionHasher
 
 class CollectionNames(str, Enum):
     INCOMING_SET = 'incomming_set'
@@ -7,5 +13,150 @@ class CollectionNames(str, Enum):
     TEMPLATES = 'templates'
     NAMED_ENTITIES = 'names'
 
+# Arity up to which typed pattern keys are usually worth building (like the
+# untyped ones). Typed keys are built only if PatternIndexPolicy's
+# max_typed_arity is set (e.g. to this).
+MAX_TYPED_PATTERN_ARITY = 3
+
 def build_redis_key(prefix, key):
     return prefix + ":" + key
+
+def build_typed_wildcard(type_hash: str) -> str:
+    """
+    Element of a pattern key which matches any target of the passed type.
+    """
+    return ExpressionHasher.composite_hash([WILDCARD, type_hash])
+
+def get_target_type_hashes(composite_type: List[Any]) -> List[str]:
+    """
+    Named type hash of each target of a link given the link's composite type.
+    """
+    return [t if isinstance(t, str) else t[0] for t in composite_type[1:]]
+
+@dataclass
+class PatternIndexPolicy:
+    """
+    Which pattern keys (stored in the PATTERNS collection) are built for each
+    link. A key has the link type (or a wildcard) followed by each target,
+    which is either constant, a wildcard or a typed wildcard (see
+    build_typed_wildcard()). Patterns without a key are matched by filtering
+    all the links of their type (see has_key()), so the policy should cover
+    the patterns used by queries.
+
+    The number of keys of a link grows exponentially with its arity (2^arity
+    untyped keys or 3^arity with typed wildcards) so it's limited by
+    max_arity, max_wildcards and wildcard_positions. Typed wildcards are off
+    by default: queries with typed variables then filter the links matched
+    by the untyped pattern.
+    """
+
+    # Links with larger arity only get the key with a wildcard in place of
+    # the link type and constant targets (None means no limit)
+    max_arity: Optional[int] = 3
+    # Typed wildcards are used only in links up to this arity (None means no
+    # limit)
+    max_typed_arity: Optional[int] = 0
+    # Max number of wildcards (typed or not) in the targets of a key (None
+    # means no limit)
+    max_wildcards: Optional[int] = None
+    # Target positions which may be wildcarded in links of each type (all
+    # the positions of types not in this dict)
+    wildcard_positions: Dict[str, List[int]] = field(default_factory=dict)
+    # Link types without pattern keys
+    black_list: List[str] = field(default_factory=list)
+
+    def _target_choices(self, named_type: str, arity: int) -> List[Tuple[int, ...]]:
+        # Choices for each target: 0 (constant), 1 (wildcard), 2 (typed wildcard)
+        positions = self.wildcard_positions.get(named_type, range(arity))
+        typed = self.max_typed_arity is None or arity <= self.max_typed_arity
+        return [((0, 1, 2) if typed else (0, 1)) if i in positions else (0,) for i in range(arity)]
+
+    def has_key(self, named_type: str, choices: List[int]) -> bool:
+        """
+        Whether links get the pattern key with the passed link type (WILDCARD
+        for the keys matching links of any type) and the passed choice for
+        each target (0 for constant, 1 for wildcard and 2 for typed
+        wildcard). Links of black listed types have no keys at all so they're
+        never matched by keys with a WILDCARD link type.
+        """
+        arity = len(choices)
+        wildcards = arity - choices.count(0)
+        if named_type == WILDCARD:
+            if 2 in choices:
+                return False
+            if wildcards == 0:
+                return True
+        elif named_type in self.black_list or wildcards == 0:
+            return False
+        if self.max_arity is not None and arity > self.max_arity:
+            return False
+        if self.max_wildcards is not None and wildcards > self.max_wildcards:
+            return False
+        if named_type == WILDCARD:
+            # Built for the links of every type with these wildcards
+            return all(
+                all(choice == 0 or i in positions for i, choice in enumerate(choices))
+                for positions in self.wildcard_positions.values())
+        return all(choice in allowed for choice, allowed in zip(choices, self._target_choices(named_type, arity)))
+
+    def intersection(self, other: 'PatternIndexPolicy') -> 'PatternIndexPolicy':
+        """
+        Policy which builds only the keys built by both policies, i.e. the
+        keys which links loaded with either of them have.
+        """
+        if self == other:
+            return self
+
+        def minimum(a, b):
+            # None means no limit
+            return b if a is None else a if b is None else min(a, b)
+
+        wildcard_positions = {}
+        for named_type in [*self.wildcard_positions, *other.wildcard_positions]:
+            positions = [
+                set(policy.wildcard_positions[named_type]) for policy in [self, other]
+                if named_type in policy.wildcard_positions]
+            wildcard_positions[named_type] = sorted(set.intersection(*positions))
+        return PatternIndexPolicy(
+            max_arity=minimum(self.max_arity, other.max_arity),
+            max_typed_arity=minimum(self.max_typed_arity, other.max_typed_arity),
+            max_wildcards=minimum(self.max_wildcards, other.max_wildcards),
+            wildcard_positions=wildcard_positions,
+            black_list=sorted({*self.black_list, *other.black_list}))
+
+    def pattern_keys(
+        self,
+        named_type: str,
+        type_hash: str,
+        elements: List[str],
+        target_type_hashes: List[str]) -> List[List[str]]:
+        """
+        Pattern keys of a link given its type, targets and the named type
+        hash of each target (see get_target_type_hashes()).
+        """
+        if named_type in self.black_list:
+            return []
+        arity = len(elements)
+        if self.max_arity is not None and arity > self.max_arity:
+            return [[WILDCARD, *elements]]
+        keys = []
+        for choices in product(*self._target_choices(named_type, arity)):
+            wildcards = arity - choices.count(0)
+            if self.max_wildcards is not None and wildcards > self.max_wildcards:
+                continue
+            targets = []
+            for choice, element, target_type in zip(choices, elements, target_type_hashes):
+                if choice == 0:
+                    targets.append(element)
+                elif choice == 1:
+                    targets.append(WILDCARD)
+                else:
+                    targets.append(build_typed_wildcard(target_type))
+            if 2 in choices:
+                # Typed keys are built only for links with a named type
+                keys.append([type_hash, *targets])
+            else:
+                if wildcards > 0:
+                    keys.append([type_hash, *targets])
+                keys.append([WILDCARD, *targets])
+        return keys
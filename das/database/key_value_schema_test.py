@@ -0,0 +1,108 @@
+from das.database.db_interface import WILDCARD
+from das.database.key_value_schema import PatternIndexPolicy, build_typed_wildcard, MAX_TYPED_PATTERN_ARITY
+
+def _keys(policy, elements, named_type='Similarity'):
+    answer = policy.pattern_keys(named_type, 'T', elements, [f'type_{e}' for e in elements])
+    return sorted(tuple(key) for key in answer)
+
+def test_default_policy():
+    policy = PatternIndexPolicy()
+    assert _keys(policy, ['a']) == sorted([
+        (WILDCARD, 'a'),
+        ('T', WILDCARD),
+        (WILDCARD, WILDCARD),
+    ])
+    assert len(_keys(policy, ['a', 'b'])) == 2 * 4 - 1
+    assert len(_keys(policy, ['a', 'b', 'c'])) == 2 * 8 - 1
+    assert _keys(policy, ['a', 'b', 'c', 'd']) == [(WILDCARD, 'a', 'b', 'c', 'd')]
+
+def test_typed_policy():
+    policy = PatternIndexPolicy(max_typed_arity=MAX_TYPED_PATTERN_ARITY)
+    assert _keys(policy, ['a']) == sorted([
+        (WILDCARD, 'a'),
+        ('T', WILDCARD),
+        (WILDCARD, WILDCARD),
+        ('T', build_typed_wildcard('type_a')),
+    ])
+    assert len(_keys(policy, ['a', 'b'])) == 2 * 4 - 1 + (9 - 4)
+    assert len(_keys(policy, ['a', 'b', 'c'])) == 2 * 8 - 1 + (27 - 8)
+    assert _keys(policy, ['a', 'b', 'c', 'd']) == [(WILDCARD, 'a', 'b', 'c', 'd')]
+
+def test_policy_limits():
+    policy = PatternIndexPolicy(max_arity=None, max_typed_arity=0)
+    assert len(_keys(policy, ['a', 'b', 'c', 'd'])) == 2 * 16 - 1
+    policy = PatternIndexPolicy(max_typed_arity=0, max_wildcards=1, wildcard_positions={'Similarity': [1]})
+    assert _keys(policy, ['a', 'b']) == sorted([
+        (WILDCARD, 'a', 'b'),
+        ('T', 'a', WILDCARD),
+        (WILDCARD, 'a', WILDCARD),
+    ])
+    assert len(_keys(policy, ['a', 'b'], 'Inheritance')) == 5
+    policy = PatternIndexPolicy(max_typed_arity=MAX_TYPED_PATTERN_ARITY, wildcard_positions={'Similarity': [1]})
+    assert _keys(policy, ['a', 'b']) == sorted([
+        (WILDCARD, 'a', 'b'),
+        ('T', 'a', WILDCARD),
+        (WILDCARD, 'a', WILDCARD),
+        ('T', 'a', build_typed_wildcard('type_b')),
+    ])
+    assert len(_keys(policy, ['a', 'b'], 'Inheritance')) == 2 * 4 - 1 + (9 - 4)
+    policy = PatternIndexPolicy(black_list=['Similarity'])
+    assert _keys(policy, ['a', 'b']) == []
+
+def test_has_key():
+    assert not PatternIndexPolicy().has_key('Similarity', [2, 0])
+    policy = PatternIndexPolicy(max_typed_arity=MAX_TYPED_PATTERN_ARITY, wildcard_positions={'Member': [1]})
+    assert policy.has_key('Similarity', [2, 0])
+    assert policy.has_key('Member', [0, 2])
+    assert not policy.has_key('Member', [2, 0])
+    assert not policy.has_key('Similarity', [2, 0, 0, 0])
+    policy = PatternIndexPolicy(max_arity=None, max_typed_arity=MAX_TYPED_PATTERN_ARITY, max_wildcards=1)
+    assert not policy.has_key('Similarity', [2, 0, 0, 0])
+    assert not policy.has_key('Similarity', [2, 1])
+    policy = PatternIndexPolicy(max_typed_arity=None, black_list=['Member'])
+    assert not policy.has_key('Member', [2, 0])
+    for elements in [['a'], ['a', 'b'], ['a', 'b', 'c']]:
+        typed_keys = [key for key in _keys(policy, elements) if key[0] == 'T' and not set(key[1:]) <= {WILDCARD, *elements}]
+        assert len(typed_keys) == 3 ** len(elements) - 2 ** len(elements)
+
+def test_has_untyped_key():
+    policy = PatternIndexPolicy()
+    assert policy.has_key('Similarity', [1, 0])
+    assert policy.has_key(WILDCARD, [1, 1, 1])
+    assert not policy.has_key('Similarity', [1, 0, 0, 0])
+    assert policy.has_key(WILDCARD, [0, 0, 0, 0])
+    assert not policy.has_key(WILDCARD, [1, 0, 0, 0])
+    policy = PatternIndexPolicy(max_wildcards=1, wildcard_positions={'Member': [1]}, black_list=['Set'])
+    assert policy.has_key('Member', [0, 1])
+    assert not policy.has_key('Member', [1, 0])
+    assert not policy.has_key('Similarity', [1, 1])
+    assert not policy.has_key('Set', [1, 0])
+    assert policy.has_key(WILDCARD, [0, 1])
+    assert not policy.has_key(WILDCARD, [1, 0])
+    # Every key the policy reports is built
+    for named_type in ['Member', 'Similarity']:
+        keys = _keys(policy, ['a', 'b'], named_type)
+        for choices in [(0, 1), (1, 0), (1, 1)]:
+            key = tuple(WILDCARD if choice else element for choice, element in zip(choices, ['a', 'b']))
+            assert policy.has_key(named_type, list(choices)) == (('T', *key) in keys)
+
+def test_intersection():
+    policy = PatternIndexPolicy(max_typed_arity=MAX_TYPED_PATTERN_ARITY)
+    assert policy.intersection(policy) == policy
+    assert policy.intersection(PatternIndexPolicy()) == PatternIndexPolicy()
+    other = PatternIndexPolicy(
+        max_arity=None,
+        max_typed_arity=None,
+        max_wildcards=1,
+        wildcard_positions={'Member': [1], 'Set': [0]},
+        black_list=['List'])
+    policy = PatternIndexPolicy(
+        max_typed_arity=MAX_TYPED_PATTERN_ARITY,
+        wildcard_positions={'Member': [0, 1]},
+        black_list=['Set'])
+    assert policy.intersection(other) == PatternIndexPolicy(
+        max_arity=3,
+        max_typed_arity=MAX_TYPED_PATTERN_ARITY,
+        max_wildcards=1,
+        wildcard_positions={'Member': [1], 'Set': [0]},
+        black_list=['List', 'Set'])
@@ -6,6 +6,7 @@ class CollectionNames(str, Enum):
     LINKS_ARITY_1 = 'links_1'
     LINKS_ARITY_2 = 'links_2'
     LINKS_ARITY_N = 'links_n'
+    METADATA = 'metadata'
 
 class FieldNames(str, Enum):
     NODE_NAME = 'name'
@@ -16,3 +17,4 @@ class FieldNames(str, Enum):
     COMPOSITE_TYPE = 'composite_type'
     KEY_PREFIX = 'key'
     KEYS = 'keys'
+    METADATA_VALUE = 'value'
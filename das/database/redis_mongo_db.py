@@ -1,4 +1,7 @@
 import os
+from collections import Counter
+from dataclasses import asdict
+from itertools import product
 from signal import raise_signal
 from typing import List, Dict, Optional, Union, Any, Tuple
 from redis import Redis
@@ -6,8 +9,10 @@ import pickle
 
 from pymongo.database import Database
 
-from das.expression_hasher import ExpressionHasher
-from das.database.key_value_schema import CollectionNames as KeyPrefix, build_redis_key
+from das.expression_hasher import ExpressionHasher, DEFAULT_HASH_ALGORITHM
+from das.database.key_value_schema import CollectionNames as KeyPrefix, build_redis_key, build_typed_wildcard, \
+    PatternIndexPolicy
+from das.database.degree_statistics import DegreeStatistics
 from das.database.mongo_schema import CollectionNames as MongoCollectionNames, FieldNames as MongoFieldNames
 
 from .db_interface import DBInterface, WILDCARD, UNORDERED_LINK_TYPES
@@ -15,6 +20,24 @@ from .db_interface import DBInterface, WILDCARD, UNORDERED_LINK_TYPES
 USE_CACHED_NODES = True
 USE_CACHED_LINK_TYPES = True
 USE_CACHED_NODE_TYPES = True
+# Max number of handles in each $in query issued by links_exist()
+LINKS_EXIST_BATCH_SIZE = 10000
+# If True, type templates also match links whose types are subtypes of the
+# ones in the template (opt-in: by default templates match exact types and
+# get_type_template_hash() always returns the template key)
+MATCH_TEMPLATE_SUBTYPES = False
+# Templates which expand to more composite types than this are matched
+# exactly (e.g. templates over the base type)
+MAX_TEMPLATE_EXPANSION = 1000
+# Number of keys requested by each SCAN call (and sized in each SCARD
+# pipeline) when computing degree statistics
+STATISTICS_SCAN_BATCH_SIZE = 10000
+# Redis key where the last computed degree statistics are stored
+DEGREE_STATISTICS_KEY = build_redis_key('statistics', 'degree')
+# Document of the METADATA collection with the hash algorithm of the atoms
+HASH_ALGORITHM_METADATA = 'hash_algorithm'
+# Document of the METADATA collection with the PatternIndexPolicy of the links
+PATTERN_INDEX_POLICY_METADATA = 'pattern_index_policy'
 
 class NodeDocuments():
 
@@ -48,7 +71,11 @@ class NodeDocuments():
 
 class RedisMongoDB(DBInterface):
 
-    def __init__(self, redis: Redis, mongo_db: Database):
+    # Hash algorithm selected by the instances of this process (see
+    # _select_hash_algorithm())
+    _selected_hash_algorithm: Optional[str] = None
+
+    def __init__(self, redis: Redis, mongo_db: Database, hash_algorithm: Optional[str] = None):
         self.redis = redis
         self.mongo_db = mongo_db
         self.mongo_link_collection = {
@@ -58,16 +85,20 @@ class RedisMongoDB(DBInterface):
         }
         self.mongo_nodes_collection = self.mongo_db.get_collection(MongoCollectionNames.NODES)
         self.mongo_types_collection = self.mongo_db.get_collection(MongoCollectionNames.ATOM_TYPES)
+        self.mongo_metadata_collection = self.mongo_db.get_collection(MongoCollectionNames.METADATA)
+        self._select_hash_algorithm(hash_algorithm)
         self.wildcard_hash = ExpressionHasher._compute_hash(WILDCARD)
         self.named_type_hash = None
         self.named_type_hash_reverse = None
         self.named_types = None
         self.symbol_hash = None
         self.parent_type = None
+        self.subtypes = None
         self.node_documents = None
         self.terminal_hash = None
         self.link_type_cache = None
         self.node_type_cache = None
+        self.pattern_index_policy = None
         self.typedef_mark_hash = ExpressionHasher._compute_hash(":")
         self.typedef_base_type_hash = ExpressionHasher._compute_hash("Type")
         self.typedef_composite_type_hash = ExpressionHasher.composite_hash([
@@ -96,6 +127,7 @@ class RedisMongoDB(DBInterface):
         self.link_type_cache = {}
         self.node_type_cache = {}
         self.node_documents = NodeDocuments(self.mongo_nodes_collection)
+        self.pattern_index_policy = self.get_pattern_index_policy()
         if USE_CACHED_NODES:
             for document in self.mongo_nodes_collection.find():
                 node_id = document[MongoFieldNames.ID_HASH]
@@ -125,6 +157,34 @@ class RedisMongoDB(DBInterface):
                 self.named_types[named_type] = type_document[MongoFieldNames.TYPE_NAME]
                 self.parent_type[named_type_hash] = type_document[MongoFieldNames.TYPE_NAME_HASH]
             self.symbol_hash[named_type] = hash_id
+        self._build_subtype_closure()
+
+    def _is_terminal_typedef(self, name_hash: str, type_hash: str) -> bool:
+        # Typedefs of terminals (e.g. (: "human" Concept)) declare nodes, not
+        # subtypes
+        name = self.named_type_hash_reverse.get(name_hash, None)
+        named_type = self.named_type_hash_reverse.get(type_hash, None)
+        if name is None or named_type is None:
+            return False
+        return self.node_documents.get(ExpressionHasher.terminal_hash(named_type, name), None) is not None
+
+    def _build_subtype_closure(self) -> None:
+        # Only type symbols are subtypes. Base types are their own parents.
+        children = {}
+        for child, parent in self.parent_type.items():
+            if child != parent and not self._is_terminal_typedef(child, parent):
+                children.setdefault(parent, set()).add(child)
+        self.subtypes = {}
+        for type_hash, direct_subtypes in children.items():
+            closure = set()
+            stack = list(direct_subtypes)
+            while stack:
+                subtype = stack.pop()
+                if subtype in closure or subtype == type_hash:
+                    continue
+                closure.add(subtype)
+                stack.extend(children.get(subtype, []))
+            self.subtypes[type_hash] = closure
 
     def _retrieve_mongo_document(self, handle: str, arity=-1) -> dict:
         mongo_filter = {"_id": handle}
@@ -150,6 +210,16 @@ class RedisMongoDB(DBInterface):
         else:
             return [* self.redis.smembers(build_redis_key(prefix, key))]
 
+    def _retrieve_key_values(self, prefix: str, keys: List[str]) -> Dict[str, List[str]]:
+        pipeline = self.redis.pipeline(transaction=False)
+        for key in keys:
+            pipeline.smembers(build_redis_key(prefix, key))
+        members = pipeline.execute()
+        if prefix in self.use_targets:
+            return {key: [pickle.loads(t) for t in value] for key, value in zip(keys, members)}
+        else:
+            return {key: [* value] for key, value in zip(keys, members)}
+
     def _build_named_type_hash_template(self, template: Union[str, List[Any]]) -> List[Any]:
         if isinstance(template, str):
             return self._get_atom_type_hash(template)
@@ -160,6 +230,35 @@ class RedisMongoDB(DBInterface):
                 answer.append(v)
             return answer
 
+    def _expand_named_type_hash_template(self, template: Union[str, List[Any]]) -> Optional[List[Any]]:
+        # All the templates obtained by replacing types by their subtypes or
+        # None if there are more than MAX_TEMPLATE_EXPANSION of them
+        if isinstance(template, str):
+            return [template, *sorted(self.subtypes.get(template, []))]
+        alternatives = []
+        size = 1
+        for element in template:
+            element_alternatives = self._expand_named_type_hash_template(element)
+            if element_alternatives is None:
+                return None
+            size *= len(element_alternatives)
+            if size > MAX_TEMPLATE_EXPANSION:
+                return None
+            alternatives.append(element_alternatives)
+        return [list(expanded) for expanded in product(*alternatives)]
+
+    def _get_type_template_hashes(self, template: List[Any]) -> List[str]:
+        try:
+            template = self._build_named_type_hash_template(template)
+        except KeyError as exception:
+            raise ValueError(f'{exception}\nInvalid type')
+        expanded = None
+        if MATCH_TEMPLATE_SUBTYPES and self.subtypes:
+            expanded = self._expand_named_type_hash_template(template)
+        if expanded is None:
+            expanded = [template]
+        return [ExpressionHasher.composite_hash(t) for t in expanded]
+
     def _build_named_type_template(self, template: Union[str, List[Any]]) -> List[Any]:
         if isinstance(template, str):
             return self.named_type_hash_reverse.get(template, None)
@@ -212,6 +311,26 @@ class RedisMongoDB(DBInterface):
         document = self._retrieve_mongo_document(link_handle, len(target_handles))
         return document is not None
 
+    def links_exist(self, links: List[Tuple[str, List[str]]]) -> List[bool]:
+        handles = [
+            ExpressionHasher.expression_hash(self._get_atom_type_hash(link_type), target_handles)
+            for link_type, target_handles in links]
+        if USE_CACHED_LINK_TYPES and self.link_type_cache is not None:
+            return [handle in self.link_type_cache for handle in handles]
+        handles_by_collection = {}
+        for handle, (_, target_handles) in zip(handles, links):
+            arity = len(target_handles)
+            tag = str(arity) if arity <= 2 else 'N'
+            handles_by_collection.setdefault(tag, set()).add(handle)
+        existing = set()
+        for tag, collection_handles in handles_by_collection.items():
+            collection_handles = list(collection_handles)
+            for i in range(0, len(collection_handles), LINKS_EXIST_BATCH_SIZE):
+                mongo_filter = {"_id": {"$in": collection_handles[i:i + LINKS_EXIST_BATCH_SIZE]}}
+                for document in self.mongo_link_collection[tag].find(mongo_filter, {"_id": 1}):
+                    existing.add(document["_id"])
+        return [handle in existing for handle in handles]
+
     def get_node_handle(self, node_type: str, node_name: str) -> str:
         return ExpressionHasher.terminal_hash(node_type, node_name)
 
@@ -226,6 +345,40 @@ class RedisMongoDB(DBInterface):
         #return answer[1:]
         return [h.decode() for h in answer]
 
+    def get_link_targets_many(self, link_handles: List[str]) -> Dict[str, List[str]]:
+        answer = self._retrieve_key_values(KeyPrefix.OUTGOING_SET, link_handles)
+        return {handle: [h.decode() for h in targets] for handle, targets in answer.items()}
+
+    def _get_link_types(self, link_handles: List[str]) -> Dict[str, str]:
+        if USE_CACHED_LINK_TYPES and self.link_type_cache is not None:
+            return {handle: self.link_type_cache.get(handle) for handle in link_handles}
+        answer = {}
+        for collection in self.mongo_link_collection.values():
+            for i in range(0, len(link_handles), LINKS_EXIST_BATCH_SIZE):
+                mongo_filter = {"_id": {"$in": link_handles[i:i + LINKS_EXIST_BATCH_SIZE]}}
+                projection = {"_id": 1, MongoFieldNames.TYPE_NAME: 1}
+                for document in collection.find(mongo_filter, projection):
+                    answer[document["_id"]] = document[MongoFieldNames.TYPE_NAME]
+        return answer
+
+    def get_incoming(self, handle: str, link_type: Optional[str] = None) -> List[str]:
+        return self.get_incoming_many([handle], None if link_type is None else [link_type])[handle]
+
+    def get_incoming_many(
+        self,
+        handles: List[str],
+        link_types: Optional[List[str]] = None) -> Dict[str, List[str]]:
+        incoming = self._retrieve_key_values(KeyPrefix.INCOMING_SET, handles)
+        answer = {handle: [h.decode() for h in links] for handle, links in incoming.items()}
+        if link_types is not None:
+            link_types = set(link_types)
+            all_links = list(set(link for links in answer.values() for link in links))
+            types = self._get_link_types(all_links)
+            answer = {
+                handle: [link for link in links if types.get(link) in link_types]
+                for handle, links in answer.items()}
+        return answer
+
     def is_ordered(self, link_handle: str) -> bool:
         document = self._retrieve_mongo_document(link_handle)
         if document is None:
@@ -240,16 +393,32 @@ class RedisMongoDB(DBInterface):
                 return [link_handle] if document else []
             except ValueError:
                 return []
+        pattern_hash = self.get_link_pattern_hash(link_type, target_handles)
+        if pattern_hash is None:
+            return self._get_unindexed_links(link_type, target_handles)
+        return self.get_matched_pattern(pattern_hash)
+
+    def _get_index_policy(self) -> PatternIndexPolicy:
+        # Links loaded before the policy was recorded got the default keys
+        if self.pattern_index_policy is None:
+            return PatternIndexPolicy()
+        return self.pattern_index_policy
+
+    def _get_unindexed_links(self, link_type: str, target_handles: List[str]) -> List[Any]:
+        # Links matching a pattern without keys in the pattern index policy
+        # are filtered from all the links of the type
         if link_type == WILDCARD:
-            link_type_hash = WILDCARD
-        else:
-            link_type_hash = self._get_atom_type_hash(link_type)
-        if link_type_hash is None:
-            return []
+            raise ValueError(
+                f"Pattern {target_handles} with a wildcard link type isn't indexed by the pattern index policy")
+        links = [
+            (link, targets) for link, targets in self.get_matched_type(link_type)
+            if len(targets) == len(target_handles)]
         if link_type in UNORDERED_LINK_TYPES:
-            target_handles = sorted(target_handles)
-        pattern_hash = ExpressionHasher.composite_hash([link_type_hash, *target_handles])
-        return self._retrieve_key_value(KeyPrefix.PATTERNS, pattern_hash)
+            constants = Counter(handle for handle in target_handles if handle != WILDCARD)
+            return [(link, targets) for link, targets in links if not constants - Counter(targets)]
+        return [
+            (link, targets) for link, targets in links
+            if all(handle == WILDCARD or handle == target for handle, target in zip(target_handles, targets))]
 
     def get_all_nodes(self, node_type: str, names: bool = False) -> List[str]:
         node_type_hash = self._get_atom_type_hash(node_type)
@@ -267,12 +436,12 @@ class RedisMongoDB(DBInterface):
                 if document[MongoFieldNames.TYPE] == node_type_hash]
 
     def get_matched_type_template(self, template: List[Any]) -> List[str]:
-        try:
-            template = self._build_named_type_hash_template(template)
-            template_hash = ExpressionHasher.composite_hash(template)
-        except KeyError as exception:
-            raise ValueError(f'{exception}\nInvalid type')
-        return self._retrieve_key_value(KeyPrefix.TEMPLATES, template_hash)
+        template_hashes = self._get_type_template_hashes(template)
+        if len(template_hashes) == 1:
+            return self.get_matched_template(template_hashes[0])
+        # A link has a single composite type so the keys are disjoint
+        matched = self.get_matched_templates(template_hashes)
+        return [link for template_hash in template_hashes for link in matched[template_hash]]
 
     def get_matched_type(self, link_type: str) -> List[str]:
         named_type_hash = self._get_atom_type_hash(link_type)
@@ -294,6 +463,168 @@ class RedisMongoDB(DBInterface):
 
     #################################
 
+    def get_link_pattern_hash(self, link_type: str, target_handles: List[str]) -> Optional[str]:
+        if link_type == WILDCARD:
+            link_type_hash = WILDCARD
+        else:
+            link_type_hash = self._get_atom_type_hash(link_type)
+        if link_type_hash is None:
+            return None
+        if link_type in UNORDERED_LINK_TYPES:
+            target_handles = sorted(target_handles)
+        # Patterns are looked up by key only if the policy used to load the
+        # links builds it
+        choices = [1 if handle == WILDCARD else 0 for handle in target_handles]
+        if not self._get_index_policy().has_key(link_type, choices):
+            return None
+        return ExpressionHasher.composite_hash([link_type_hash, *target_handles])
+
+    def get_typed_link_pattern_hash(
+        self,
+        link_type: str,
+        target_handles: List[str],
+        target_types: List[Optional[str]]) -> Optional[str]:
+        # Typed pattern keys are built only for links with a named type and
+        # only if the policy used to load the links builds them
+        if link_type == WILDCARD:
+            return None
+        link_type_hash = self._get_atom_type_hash(link_type)
+        if link_type_hash is None:
+            return None
+        key = []
+        for handle, target_type in zip(target_handles, target_types):
+            if target_type is None:
+                key.append(handle)
+            else:
+                key.append(build_typed_wildcard(self._get_atom_type_hash(target_type)))
+        if link_type in UNORDERED_LINK_TYPES:
+            # Wildcards (typed or not) go first, like in untyped patterns
+            key = sorted(key, key=lambda element: (element != WILDCARD and element in target_handles, element))
+        choices = [
+            0 if element in target_handles and element != WILDCARD else 1 if element == WILDCARD else 2
+            for element in key]
+        if 2 not in choices or not self._get_index_policy().has_key(link_type, choices):
+            return None
+        return ExpressionHasher.composite_hash([link_type_hash, *key])
+
+    def get_matched_typed_links(
+        self,
+        link_type: str,
+        target_handles: List[str],
+        target_types: List[Optional[str]]):
+        pattern_hash = self.get_typed_link_pattern_hash(link_type, target_handles, target_types)
+        if pattern_hash is not None:
+            return self.get_matched_pattern(pattern_hash)
+        links = self.get_matched_links(link_type, target_handles)
+        atom_types = self._get_atom_types(list({target for _, targets in links for target in targets}))
+        if link_type in UNORDERED_LINK_TYPES:
+            # Targets are stored sorted so the typed wildcards must match the
+            # types of the targets left after removing the constant ones
+            wanted_types = Counter(target_type for target_type in target_types if target_type is not None)
+            constants = Counter(
+                handle for handle, target_type in zip(target_handles, target_types)
+                if target_type is None and handle != WILDCARD)
+            answer = []
+            for link, targets in links:
+                free_types = Counter(atom_types.get(target) for target in (Counter(targets) - constants).elements())
+                if not wanted_types - free_types:
+                    answer.append((link, targets))
+            return answer
+        return [
+            (link, targets) for link, targets in links
+            if all(target_type is None or atom_types.get(target) == target_type
+                   for target, target_type in zip(targets, target_types))]
+
+    def type_template_matches(self, template: List[Any], link_types: List[Any]) -> bool:
+        if template == link_types:
+            return True
+        if len(template) != len(link_types) or any(isinstance(t, list) for t in [*template, *link_types]):
+            return False
+        if not MATCH_TEMPLATE_SUBTYPES or not self.subtypes:
+            return False
+        try:
+            template = self._build_named_type_hash_template(template)
+            link_types = self._build_named_type_hash_template(link_types)
+        except KeyError:
+            return False
+        # Same expansion as _get_type_template_hashes()
+        size = 1
+        for element in template:
+            size *= 1 + len(self.subtypes.get(element, []))
+            if size > MAX_TEMPLATE_EXPANSION:
+                return False
+        return all(
+            link_type == element or link_type in self.subtypes.get(element, [])
+            for element, link_type in zip(template, link_types))
+
+    def get_type_template_hash(self, template: List[Any]) -> Optional[str]:
+        # Templates matching subtypes aren't stored under a single key
+        template_hashes = self._get_type_template_hashes(template)
+        return template_hashes[0] if len(template_hashes) == 1 else None
+
+    def get_matched_pattern(self, pattern_hash: str):
+        return self._retrieve_key_value(KeyPrefix.PATTERNS, pattern_hash)
+
+    def get_matched_template(self, template_hash: str) -> List[str]:
+        return self._retrieve_key_value(KeyPrefix.TEMPLATES, template_hash)
+
+    def get_matched_patterns(self, pattern_hashes: List[str]) -> Dict[str, Any]:
+        return self._retrieve_key_values(KeyPrefix.PATTERNS, pattern_hashes)
+
+    def get_matched_templates(self, template_hashes: List[str]) -> Dict[str, Any]:
+        return self._retrieve_key_values(KeyPrefix.TEMPLATES, template_hashes)
+
+    def _sample_key_value(self, prefix: str, key: str, size: int) -> List[Any]:
+        members = self.redis.srandmember(build_redis_key(prefix, key), size)
+        return [pickle.loads(t) for t in members]
+
+    def sample_matched_links(
+        self,
+        link_type: str,
+        target_handles: List[str],
+        size: int,
+        target_types: Optional[List[Optional[str]]] = None):
+        if target_types is not None:
+            pattern_hash = self.get_typed_link_pattern_hash(link_type, target_handles, target_types)
+            if pattern_hash is None:
+                return super().sample_matched_links(link_type, target_handles, size, target_types)
+        elif link_type != WILDCARD and WILDCARD not in target_handles:
+            return super().sample_matched_links(link_type, target_handles, size)
+        else:
+            pattern_hash = self.get_link_pattern_hash(link_type, target_handles)
+            if pattern_hash is None:
+                return super().sample_matched_links(link_type, target_handles, size)
+        return self._sample_key_value(KeyPrefix.PATTERNS, pattern_hash, size)
+
+    def sample_matched_type_template(self, template: List[Any], size: int) -> List[str]:
+        template_hash = self.get_type_template_hash(template)
+        if template_hash is None:
+            return super().sample_matched_type_template(template, size)
+        return self._sample_key_value(KeyPrefix.TEMPLATES, template_hash, size)
+
+    def count_matched_links(
+        self,
+        link_type: str,
+        target_handles: List[str],
+        target_types: Optional[List[Optional[str]]] = None) -> int:
+        if target_types is not None:
+            pattern_hash = self.get_typed_link_pattern_hash(link_type, target_handles, target_types)
+            if pattern_hash is None:
+                return len(self.get_matched_typed_links(link_type, target_handles, target_types))
+            return self.redis.scard(build_redis_key(KeyPrefix.PATTERNS, pattern_hash))
+        if link_type != WILDCARD and WILDCARD not in target_handles:
+            return len(self.get_matched_links(link_type, target_handles))
+        pattern_hash = self.get_link_pattern_hash(link_type, target_handles)
+        if pattern_hash is None:
+            return len(self._get_unindexed_links(link_type, target_handles))
+        return self.redis.scard(build_redis_key(KeyPrefix.PATTERNS, pattern_hash))
+
+    def count_matched_type_template(self, template: List[Any]) -> int:
+        pipeline = self.redis.pipeline(transaction=False)
+        for template_hash in self._get_type_template_hashes(template):
+            pipeline.scard(build_redis_key(KeyPrefix.TEMPLATES, template_hash))
+        return sum(pipeline.execute())
+
     def get_atom_as_dict(self, handle, arity=-1) -> dict:
         answer = {}
         document = self.node_documents.get(handle, None) if arity <= 0 else None
@@ -333,3 +664,151 @@ class RedisMongoDB(DBInterface):
         for collection in self.mongo_link_collection.values():
             link_count += collection.estimated_document_count()
         return (node_count, link_count)
+
+    def get_hash_algorithm(self) -> Optional[str]:
+        """
+        Hash algorithm used to compute the handles of the atoms in the
+        database or None if it's empty.
+        """
+        document = self.mongo_metadata_collection.find_one({MongoFieldNames.ID_HASH: HASH_ALGORITHM_METADATA})
+        if document is not None:
+            return document[MongoFieldNames.METADATA_VALUE]
+        # Databases loaded before the algorithm was recorded use the default one
+        node_count, link_count = self.count_atoms()
+        if node_count or link_count or self.mongo_types_collection.estimated_document_count():
+            return DEFAULT_HASH_ALGORITHM
+        return None
+
+    def record_hash_algorithm(self) -> None:
+        """
+        Record the hash algorithm in use (see ExpressionHasher.set_algorithm())
+        if the database is empty. Otherwise, raise ValueError if it isn't the
+        one recorded. Must be called before atoms are added.
+        """
+        recorded_algorithm = self.get_hash_algorithm()
+        if recorded_algorithm is None:
+            self.mongo_metadata_collection.replace_one(
+                {MongoFieldNames.ID_HASH: HASH_ALGORITHM_METADATA},
+                {
+                    MongoFieldNames.ID_HASH: HASH_ALGORITHM_METADATA,
+                    MongoFieldNames.METADATA_VALUE: ExpressionHasher.algorithm,
+                },
+                upsert=True)
+            RedisMongoDB._selected_hash_algorithm = ExpressionHasher.algorithm
+        elif recorded_algorithm != ExpressionHasher.algorithm:
+            raise ValueError(
+                f"Atoms in the database are hashed with {recorded_algorithm}, not {ExpressionHasher.algorithm}")
+
+    def get_pattern_index_policy(self) -> Optional[PatternIndexPolicy]:
+        """
+        Policy which built the pattern keys of all the links in the database
+        or None if it wasn't recorded (see record_pattern_index_policy()).
+        """
+        document = self.mongo_metadata_collection.find_one({MongoFieldNames.ID_HASH: PATTERN_INDEX_POLICY_METADATA})
+        if document is None:
+            return None
+        return PatternIndexPolicy(**document[MongoFieldNames.METADATA_VALUE])
+
+    def record_pattern_index_policy(self, policy: PatternIndexPolicy) -> None:
+        """
+        Record the policy used to build the pattern keys of the links about to
+        be added. Keys are looked up only if every link got them so, if links
+        were added before with another policy, the intersection of both
+        policies is recorded (links added before any policy was recorded got
+        the keys of the default one).
+        """
+        recorded_policy = self.get_pattern_index_policy()
+        if recorded_policy is None:
+            node_count, link_count = self.count_atoms()
+            if link_count:
+                recorded_policy = PatternIndexPolicy()
+        if recorded_policy is not None:
+            policy = recorded_policy.intersection(policy)
+        self.mongo_metadata_collection.replace_one(
+            {MongoFieldNames.ID_HASH: PATTERN_INDEX_POLICY_METADATA},
+            {
+                MongoFieldNames.ID_HASH: PATTERN_INDEX_POLICY_METADATA,
+                MongoFieldNames.METADATA_VALUE: asdict(policy),
+            },
+            upsert=True)
+        self.pattern_index_policy = policy
+
+    def _select_hash_algorithm(self, hash_algorithm: Optional[str]) -> None:
+        # The algorithm recorded in the database is used unless it's empty.
+        # ExpressionHasher is shared by the whole process so databases hashed
+        # with different algorithms can't be used at the same time.
+        recorded_algorithm = self.get_hash_algorithm()
+        if recorded_algorithm is not None and hash_algorithm is not None and hash_algorithm != recorded_algorithm:
+            raise ValueError(f"Atoms in the database are hashed with {recorded_algorithm}, not {hash_algorithm}")
+        algorithm = recorded_algorithm or hash_algorithm
+        if algorithm is None:
+            return
+        selected_algorithm = RedisMongoDB._selected_hash_algorithm
+        if selected_algorithm is not None and algorithm != selected_algorithm:
+            raise ValueError(
+                f"Hash algorithm {algorithm} conflicts with {selected_algorithm}, "
+                f"already in use by another database in this process")
+        ExpressionHasher.set_algorithm(algorithm)
+        RedisMongoDB._selected_hash_algorithm = algorithm
+
+    def _get_atom_types(self, handles: List[str]) -> Dict[str, str]:
+        if USE_CACHED_LINK_TYPES and USE_CACHED_NODE_TYPES and self.link_type_cache is not None:
+            answer = {}
+            for handle in handles:
+                atom_type = self.link_type_cache.get(handle, None) or self.node_type_cache.get(handle, None)
+                if atom_type is not None:
+                    answer[handle] = atom_type
+            return answer
+        answer = self._get_link_types(handles)
+        for handle in handles:
+            if handle not in answer:
+                document = self.node_documents.get(handle, None)
+                if document is not None:
+                    answer[handle] = document[MongoFieldNames.TYPE_NAME]
+        return answer
+
+    def _scan_set_sizes(self, prefix: str):
+        # Streams batches of (handle, size) of all the sets with the passed
+        # prefix, sizing each batch of keys returned by SCAN with a pipelined
+        # SCARD
+        keys = []
+        for key in self.redis.scan_iter(match=build_redis_key(prefix, '*'), count=STATISTICS_SCAN_BATCH_SIZE):
+            keys.append(key)
+            if len(keys) == STATISTICS_SCAN_BATCH_SIZE:
+                yield self._get_set_sizes(prefix, keys)
+                keys = []
+        if keys:
+            yield self._get_set_sizes(prefix, keys)
+
+    def _get_set_sizes(self, prefix: str, keys: List[bytes]) -> List[Tuple[str, int]]:
+        pipeline = self.redis.pipeline(transaction=False)
+        for key in keys:
+            pipeline.scard(key)
+        start = len(build_redis_key(prefix, ''))
+        return [(key.decode()[start:], size) for key, size in zip(keys, pipeline.execute())]
+
+    def compute_degree_statistics(self, top_k: int = 100) -> Dict[str, Any]:
+        """
+        Compute (and store in Redis) in-degree and out-degree distributions
+        of all the atoms, overall and by atom type, from the sizes of the
+        incoming and outgoing sets. See DegreeStatistics.
+        """
+        statistics = DegreeStatistics(top_k)
+        for prefix, add in [
+                (KeyPrefix.INCOMING_SET, statistics.add_in_degree),
+                (KeyPrefix.OUTGOING_SET, statistics.add_out_degree)]:
+            for batch in self._scan_set_sizes(prefix):
+                atom_types = self._get_atom_types([handle for handle, _ in batch])
+                for handle, degree in batch:
+                    add(handle, atom_types.get(handle, None), degree)
+        answer = statistics.to_dict()
+        self.redis.set(DEGREE_STATISTICS_KEY, pickle.dumps(answer))
+        return answer
+
+    def get_degree_statistics(self) -> Optional[Dict[str, Any]]:
+        """
+        Degree statistics stored by the last call to
+        compute_degree_statistics() or None if they were never computed.
+        """
+        answer = self.redis.get(DEGREE_STATISTICS_KEY)
+        return pickle.loads(answer) if answer is not None else None
@@ -7,8 +7,10 @@ from pymongo import MongoClient as MongoDBClient
 from redis import Redis
 
 from das.database.db_interface import DBInterface
+from das.database import redis_mongo_db
 from das.database.redis_mongo_db import RedisMongoDB
-from das.database.key_value_schema import CollectionNames as KeyPrefix, build_redis_key
+from das.database.key_value_schema import CollectionNames as KeyPrefix, build_redis_key, PatternIndexPolicy, \
+    MAX_TYPED_PATTERN_ARITY
 from das.database.mongo_schema import CollectionNames as MongoCollectionNames, FieldNames as MongoFieldNames
 
 @pytest.fixture()
@@ -219,6 +221,50 @@ def test_get_matched_links(db: DBInterface):
     assert len(db.get_matched_links('Similarity', [human, mammal])) == 0
     assert len(db.get_matched_links('Similarity', [mammal, human])) == 0
 
+def test_get_matched_typed_links(db: DBInterface):
+    human = db.get_node_handle('Concept', 'human')
+    monkey = db.get_node_handle('Concept', 'monkey')
+    chimp = db.get_node_handle('Concept', 'chimp')
+    mammal = db.get_node_handle('Concept', 'mammal')
+    policy = db.pattern_index_policy
+    try:
+        # Typed keys are looked up only if the loader's policy built them
+        db.pattern_index_policy = None
+        assert db.get_typed_link_pattern_hash('Similarity', [human, '*'], [None, 'Concept']) is None
+        db.pattern_index_policy = PatternIndexPolicy(max_typed_arity=MAX_TYPED_PATTERN_ARITY)
+        assert db.get_typed_link_pattern_hash('Similarity', [human, '*'], [None, 'Concept']) is not None
+        assert db.get_typed_link_pattern_hash(
+            'Similarity', [human, monkey, chimp, '*'], [None, None, None, 'Concept']) is None
+        assert db.get_matched_typed_links('Similarity', [human, monkey, chimp, '*'], [None, None, None, 'Concept']) == []
+        db.pattern_index_policy = None
+        assert len(db.get_matched_typed_links('Similarity', [human, '*'], [None, 'Concept'])) == 3
+        assert len(db.get_matched_typed_links('Similarity', ['*', human], ['Concept', None])) == 3
+        assert len(db.get_matched_typed_links('Similarity', ['*', '*'], ['Concept', 'Concept'])) == 14
+        assert len(db.get_matched_typed_links('Similarity', [human, '*'], [None, 'Similarity'])) == 0
+        assert len(db.get_matched_typed_links('Inheritance', ['*', mammal], ['Concept', None])) == 4
+    finally:
+        db.pattern_index_policy = policy
+
+def test_get_matched_links_outside_policy(db: DBInterface):
+    human = db.get_node_handle('Concept', 'human')
+    mammal = db.get_node_handle('Concept', 'mammal')
+    expected = sorted(db.get_matched_links('Inheritance', [human, '*']))
+    expected_similarities = sorted(db.get_matched_links('Similarity', [human, '*']))
+    assert expected and expected_similarities
+    policy = db.pattern_index_policy
+    try:
+        # Keys the policy didn't build aren't looked up
+        db.pattern_index_policy = PatternIndexPolicy(wildcard_positions={'Inheritance': [0]}, black_list=['Similarity'])
+        assert db.get_link_pattern_hash('Inheritance', [human, '*']) is None
+        assert db.get_link_pattern_hash('Inheritance', ['*', mammal]) is not None
+        assert sorted(db.get_matched_links('Inheritance', [human, '*'])) == expected
+        assert db.count_matched_links('Inheritance', [human, '*']) == len(expected)
+        assert sorted(db.get_matched_links('Similarity', ['*', human])) == expected_similarities
+        with pytest.raises(ValueError):
+            db.get_matched_links('*', [human, '*'])
+    finally:
+        db.pattern_index_policy = policy
+
 def test_build_hash_template(db: DBInterface):
     v1 = db._build_named_type_hash_template(['Inheritance', 'Concept', 'Concept'])
     v2 = db._build_named_type_hash_template(['Similarity', 'Concept', 'Concept'])
@@ -250,6 +296,76 @@ def test_get_matched_type_template(db: DBInterface):
     assert(v1 == v5)
     assert(v2 == v6)
 
+def test_get_matched_type_template_exact_types(db: DBInterface):
+    template = ['Inheritance', 'Concept', 'Concept']
+    v1 = db.get_matched_type_template(template)
+    # Subtypes are ignored unless MATCH_TEMPLATE_SUBTYPES is set
+    db.parent_type[db._get_atom_type_hash('Mammal')] = db._get_atom_type_hash('Concept')
+    db._build_subtype_closure()
+    assert db.get_type_template_hash(template) is not None
+    assert db.get_matched_type_template(template) == v1
+    assert db.get_matched_template(db.get_type_template_hash(template)) == v1
+    assert db.type_template_matches(template, template)
+    assert not db.type_template_matches(template, ['Inheritance', 'Mammal', 'Concept'])
+
+def test_get_matched_type_template_with_subtypes(db: DBInterface, monkeypatch):
+    monkeypatch.setattr(redis_mongo_db, 'MATCH_TEMPLATE_SUBTYPES', True)
+    concept = db._get_atom_type_hash('Concept')
+    type_hash = db._get_atom_type_hash('Type')
+    assert concept in db.subtypes[type_hash]
+    template = ['Inheritance', 'Concept', 'Concept']
+    assert db.get_type_template_hash(template) is not None
+    v1 = db.get_matched_type_template(template)
+    # A new subtype of Concept without links expands the template but
+    # doesn't change the answer
+    db.parent_type[db._get_atom_type_hash('Mammal')] = concept
+    db._build_subtype_closure()
+    assert db.get_type_template_hash(template) is None
+    assert sorted(db.get_matched_type_template(template)) == sorted(v1)
+    assert db.count_matched_type_template(template) == 12
+    assert db.get_matched_type_template(['Inheritance', 'Mammal', 'Concept']) == []
+    # Same subtypes as get_matched_type_template() (used by standing queries)
+    assert db.type_template_matches(template, ['Inheritance', 'Mammal', 'Concept'])
+    assert not db.type_template_matches(['Inheritance', 'Mammal', 'Concept'], template)
+    assert not db.type_template_matches(template, ['Similarity', 'Concept', 'Concept'])
+
+def test_subtype_closure_without_terminals(db: DBInterface, monkeypatch):
+    monkeypatch.setattr(redis_mongo_db, 'MATCH_TEMPLATE_SUBTYPES', True)
+    concept = db._get_atom_type_hash('Concept')
+    mammal = db._get_atom_type_hash('Mammal')
+    # Subtype and terminals sharing a parent
+    db.parent_type[mammal] = concept
+    for name in ['human', 'monkey', 'chimp']:
+        db.parent_type[db._get_atom_type_hash(name)] = concept
+    db._build_subtype_closure()
+    assert db.subtypes[concept] == {mammal}
+    assert len(db._get_type_template_hashes(['Inheritance', 'Concept', 'Concept'])) == 4
+
+def test_get_matched_precomputed_hash(db: DBInterface):
+    human = db.get_node_handle('Concept', 'human')
+    mammal = db.get_node_handle('Concept', 'mammal')
+    for link_type, targets in [('Inheritance', ['*', mammal]), ('Similarity', ['*', human]), ('Similarity', [human, '*'])]:
+        pattern_hash = db.get_link_pattern_hash(link_type, targets)
+        assert sorted(db.get_matched_pattern(pattern_hash)) == sorted(db.get_matched_links(link_type, targets))
+    for template in [['Inheritance', 'Concept', 'Concept'], ['Similarity', 'Concept', 'Concept']]:
+        template_hash = db.get_type_template_hash(template)
+        assert sorted(db.get_matched_template(template_hash)) == sorted(db.get_matched_type_template(template))
+
+def test_get_matched_patterns(db: DBInterface):
+    human = db.get_node_handle('Concept', 'human')
+    mammal = db.get_node_handle('Concept', 'mammal')
+    patterns = [('Inheritance', ['*', mammal]), ('Similarity', ['*', human]), ('Inheritance', ['*', '*'])]
+    pattern_hashes = [db.get_link_pattern_hash(link_type, targets) for link_type, targets in patterns]
+    matched = db.get_matched_patterns(pattern_hashes)
+    assert len(matched) == 3
+    for pattern_hash, (link_type, targets) in zip(pattern_hashes, patterns):
+        assert sorted(matched[pattern_hash]) == sorted(db.get_matched_links(link_type, targets))
+    templates = [['Inheritance', 'Concept', 'Concept'], ['Similarity', 'Concept', 'Concept']]
+    template_hashes = [db.get_type_template_hash(template) for template in templates]
+    matched = db.get_matched_templates(template_hashes)
+    for template_hash, template in zip(template_hashes, templates):
+        assert sorted(matched[template_hash]) == sorted(db.get_matched_type_template(template))
+
 def test_get_matched_type(db: DBInterface):
     v1 = db.get_matched_type('Inheritance')
     v2 = db.get_matched_type('Similarity')
@@ -274,3 +390,48 @@ def test_atom_count(db: DBInterface):
     node_count, link_count = db.count_atoms()
     assert node_count == 14
     assert link_count == 26
+
+def test_hash_algorithm_conflict(redis_db, mongo_db, monkeypatch):
+    db = RedisMongoDB(redis_db, mongo_db)
+    algorithm = db.get_hash_algorithm()
+    assert RedisMongoDB._selected_hash_algorithm == algorithm
+    RedisMongoDB(redis_db, mongo_db, algorithm)
+    # Another database already selected a different algorithm in this process
+    monkeypatch.setattr(RedisMongoDB, '_selected_hash_algorithm', 'other')
+    with pytest.raises(ValueError):
+        RedisMongoDB(redis_db, mongo_db)
+
+def test_get_incoming(db: DBInterface):
+    triceratops = db.get_node_handle('Concept', 'triceratops')
+    dinosaur = db.get_node_handle('Concept', 'dinosaur')
+    mammal = db.get_node_handle('Concept', 'mammal')
+    inheritance = db.get_link_handle('Inheritance', [triceratops, dinosaur])
+    assert db.get_incoming(triceratops, 'Inheritance') == [inheritance]
+    assert inheritance in db.get_incoming(triceratops)
+    assert all(db.get_link_type(link) == 'Similarity' for link in db.get_incoming(triceratops, 'Similarity'))
+    assert len(db.get_incoming(mammal, 'Inheritance')) == 5
+    incoming = db.get_incoming_many([triceratops, dinosaur, mammal], ['Inheritance'])
+    for handle in [triceratops, dinosaur, mammal]:
+        assert sorted(incoming[handle]) == sorted(db.get_incoming(handle, 'Inheritance'))
+
+def test_expand(db: DBInterface):
+    def handles(*names):
+        return [db.get_node_handle('Concept', name) for name in names]
+    triceratops, dinosaur, reptile = handles('triceratops', 'dinosaur', 'reptile')
+    assert db.expand([triceratops], 2, ['Inheritance']) == {triceratops: 0, dinosaur: 1, reptile: 2}
+    assert db.expand([triceratops], 0) == {triceratops: 0}
+    neighbors = db.expand(handles('mammal'), 1, ['Inheritance'])
+    assert set(neighbors.keys()) == set(handles('mammal', 'human', 'monkey', 'chimp', 'rhino', 'animal'))
+    assert len(db.expand(handles('mammal'), 1, ['Inheritance'], max_fanout=1)) == 2
+
+def test_degree_statistics(db: DBInterface):
+    statistics = db.compute_degree_statistics(top_k=3)
+    assert db.get_degree_statistics() == statistics
+    # Every link of the animals KB has 2 targets
+    assert statistics['out_degree']['count'] == 26
+    assert statistics['out_degree']['histogram'] == {2: 26}
+    assert set(statistics['out_degree_by_type'].keys()) == set(['Inheritance', 'Similarity'])
+    assert statistics['in_degree']['count'] == 14
+    assert statistics['in_degree']['total'] == 52
+    assert len(statistics['in_degree']['top']) == 3
+    assert statistics['in_degree']['top'][0][1] == statistics['in_degree']['max']
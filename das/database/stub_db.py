@@ -1,7 +1,7 @@
 import re
-from typing import List, Any, Tuple
+from typing import List, Any, Optional, Tuple
 
-from das.database.db_interface import DBInterface
+from das.database.db_interface import DBInterface, UNORDERED_LINK_TYPES
 from das.pattern_matcher.pattern_matcher import WILDCARD
 
 
@@ -81,6 +81,8 @@ class StubDB(DBInterface):
             v = self.template_index.get(key, [])
             v.append([_build_link_handle(link[0], link[1:]), link[1:]])
             self.template_index[key] = v
+        # Pattern of each key returned by get_link_pattern_hash()
+        self.pattern_index = {}
 
     def __repr__(self):
         return '<StubDB>'
@@ -126,6 +128,11 @@ class StubDB(DBInterface):
                 return link[1:]
         return None
 
+    def get_incoming(self, handle: str, link_type: Optional[str] = None) -> List[str]:
+        return [
+            _build_link_handle(link[0], link[1:]) for link in self.all_links
+            if handle in link[1:] and (link_type is None or link[0] == link_type)]
+
     def get_matched_links(self, link_type: str, target_handles: List[str]):
         answer = []
         for link in self.all_links:
@@ -145,6 +152,23 @@ class StubDB(DBInterface):
                     raise ValueError(f"Invalid link type: {link[0]}")
         return answer
 
+    def get_matched_typed_links(self, link_type: str, target_handles: List[str], target_types: List[Optional[str]]):
+        answer = []
+        for link, targets in self.get_matched_links(link_type, target_handles):
+            if link_type in UNORDERED_LINK_TYPES:
+                free_types = [_split_node_handle(target)[0] for target in targets if target not in target_handles]
+                for target_type in target_types:
+                    if target_type is not None:
+                        if target_type not in free_types:
+                            break
+                        free_types.remove(target_type)
+                else:
+                    answer.append([link, targets])
+            elif all(target_type is None or _split_node_handle(target)[0] == target_type
+                     for target, target_type in zip(targets, target_types)):
+                answer.append([link, targets])
+        return answer
+
     def get_all_nodes(self, node_type: str, names: bool = False) -> List[str]:
         return self.all_nodes if node_type == 'Concept' else []
         if node_type != 'Concept':
@@ -161,6 +185,21 @@ class StubDB(DBInterface):
     def get_matched_type_template(self, template: List[Any]) -> List[str]:
         assert len(template) == 3
         return self.template_index.get(str(template), [])
+
+    def get_link_pattern_hash(self, link_type: str, target_handles: List[str]) -> Optional[str]:
+        pattern_hash = str([link_type, *target_handles])
+        self.pattern_index[pattern_hash] = (link_type, list(target_handles))
+        return pattern_hash
+
+    def get_matched_pattern(self, pattern_hash: str):
+        link_type, target_handles = self.pattern_index[pattern_hash]
+        return self.get_matched_links(link_type, target_handles)
+
+    def get_type_template_hash(self, template: List[Any]) -> Optional[str]:
+        return str(template) if len(template) == 3 else None
+
+    def get_matched_template(self, template_hash: str) -> List[str]:
+        return self.template_index.get(template_hash, [])
         
     def get_node_name(self, node_handle: str) -> str:
         _, name = _split_node_handle(node)
@@ -5,23 +5,40 @@ Distributed Atom Space
 
 import os
 import json
-from time import sleep
-from typing import List, Optional, Union, Tuple, Dict
-from pymongo import MongoClient as MongoDBClient
+import multiprocessing
+from dataclasses import replace
+from typing import Callable, List, Optional, Set, Union, Tuple, Dict
 from redis import Redis
 from redis.cluster import RedisCluster
 from enum import Enum, auto
 from das.parser_actions import KnowledgeBaseFile, MultiThreadParsing
 from das.database.mongo_schema import CollectionNames as MongoCollections
 from das.parser_threads import SharedData, ParserThread, FlushNonLinksToDBThread, BuildConnectivityThread, \
-    BuildPatternsThread, BuildTypeTemplatesThread, PopulateMongoDBLinksThread, PopulateRedisCollectionThread
+    BuildPatternsThread, BuildTypeTemplatesThread, PopulateMongoDBLinksThread, PopulateRedisCollectionThread, \
+    parse_action_broker_input
+from das.expression_hasher import ExpressionHasher
 from das.database.redis_mongo_db import RedisMongoDB
 from das.logger import logger
-from das.database.key_value_schema import CollectionNames as KeyPrefix
+from das.database.key_value_schema import CollectionNames as KeyPrefix, PatternIndexPolicy
 from das.database.db_interface import WILDCARD
 from das.transaction import Transaction
 from das.canonical_parser import CanonicalParser
-from das.pattern_matcher.pattern_matcher import PatternMatchingAnswer, LogicalExpression
+from das.mongo_writer import connect_mongo_db
+from das.load_manifest import LoadManifest, remove_load_manifest
+from das.expression import Expression
+from das.pattern_matcher.pattern_matcher import PatternMatchingAnswer, LogicalExpression, PreparedQuery, match_many, \
+    profile as _profile_query, explain, QueryBudget, QueryContext, count as _count_query, \
+    project as _project_query, sample as _sample_query, delta, check_standing_query, Assignment
+
+def _parse_knowledge_base_file(task):
+    # Runs in the worker processes of DistributedAtomSpace.load_knowledge_base().
+    # Expressions are returned (pickled) in batches already deduplicated.
+    file_name, hash_algorithm = task
+    ExpressionHasher.set_algorithm(hash_algorithm)
+    shared_data = SharedData()
+    parse_action_broker_input(KnowledgeBaseFile(None, file_name, shared_data))
+    return file_name, list(shared_data.regular_expressions), list(shared_data.typedef_expressions), \
+        list(shared_data.terminals)
 
 class QueryOutputFormat(int, Enum):
     HANDLE = auto()
@@ -32,18 +49,21 @@ class DistributedAtomSpace:
 
     def __init__(self, **kwargs):
         self.database_name = kwargs.get("database_name", "das")
+        # Hash algorithm used to compute handles (see ExpressionHasher). Only
+        # empty databases can use an algorithm other than the recorded one.
+        self.hash_algorithm = kwargs.get("hash_algorithm", None)
         self.db = None
         logger().info(f"New Distributed Atom Space. Database name: {self.database_name}")
         self._setup_database()
         self.pattern_black_list = []
+        # Pattern keys built when knowledge bases are loaded
+        self.pattern_index_policy = PatternIndexPolicy()
+        # id -> (query, callback) (see register_standing_query())
+        self.standing_queries: Dict[int, Tuple[LogicalExpression, Callable[[Set[Assignment]], None]]] = {}
+        self.next_standing_query_id = 1
 
     def _setup_database(self):
-        hostname = os.environ.get('DAS_MONGODB_HOSTNAME')
-        port = os.environ.get('DAS_MONGODB_PORT')
-        username = os.environ.get('DAS_DATABASE_USERNAME')
-        password = os.environ.get('DAS_DATABASE_PASSWORD')
-        logger().info(f"Connecting to MongoDB at {hostname}:{port}")
-        self.mongo_db = MongoDBClient(f'mongodb://{username}:{password}@{hostname}:{port}')[self.database_name]
+        self.mongo_db = connect_mongo_db(self.database_name)
 
         hostname = os.environ.get('DAS_REDIS_HOSTNAME')
         port = os.environ.get('DAS_REDIS_PORT')
@@ -55,7 +75,7 @@ class DistributedAtomSpace:
             self.redis = Redis(host=hostname, port=port, decode_responses=False)
             logger().info(f"Connecting to standalone Redis at {hostname}:{port}")
 
-        self.db = RedisMongoDB(self.redis, self.mongo_db)
+        self.db = RedisMongoDB(self.redis, self.mongo_db, self.hash_algorithm)
         logger().info(f"Prefetching data")
         self.db.prefetch()
         logger().info(f"Database setup finished")
@@ -135,38 +155,81 @@ class DistributedAtomSpace:
                 answer.append(self.db.get_atom_as_deep_representation(handle, arity))
         return json.dumps(answer, sort_keys=False, indent=4)
 
-    def _process_parsed_data(self, shared_data: SharedData, update: bool):
-        shared_data.replicate_regular_expressions()
-        file_builder_threads = [
-            FlushNonLinksToDBThread(self.db, shared_data, update),
-            BuildConnectivityThread(shared_data),
-            BuildPatternsThread(shared_data),
-            BuildTypeTemplatesThread(shared_data)
-        ]
-        for thread in file_builder_threads:
-            thread.start()
-        links_uploader_to_mongo_thread = PopulateMongoDBLinksThread(self.db, shared_data, update)
-        links_uploader_to_mongo_thread.start()
-        for thread in file_builder_threads:
-            thread.join()
-        assert shared_data.build_ok_count == len(file_builder_threads)
+    def _record_pattern_index_policy(self):
+        # Links of types in pattern_black_list get no pattern keys either
+        black_list = [*self.pattern_index_policy.black_list, *self.pattern_black_list]
+        self.db.record_pattern_index_policy(replace(self.pattern_index_policy, black_list=black_list))
+
+    def _add_parsed_files(self, shared_data: SharedData, parsed_files):
+        for file_name, regular_expressions, typedef_expressions, terminals in parsed_files:
+            logger().info(f"Parsed {file_name}")
+            shared_data.add_expressions(regular_expressions, typedef_expressions, terminals)
+            shared_data.parse_ok()
+
+    def _process_parsed_data(self, shared_data: SharedData, update: bool, manifest: Optional[LoadManifest] = None):
+        # The key-value files and MongoDB are built in the "parse" stage of
+        # the manifest (if any) which is skipped when the load is resumed
+        # after it's done
+        parse_done = manifest is not None and manifest.is_done("parse")
+        if not parse_done:
+            shared_data.replicate_regular_expressions()
+            file_builder_threads = [
+                FlushNonLinksToDBThread(self.db, shared_data, update),
+                BuildConnectivityThread(shared_data),
+                BuildPatternsThread(shared_data),
+                BuildTypeTemplatesThread(shared_data)
+            ]
+            for thread in file_builder_threads:
+                thread.start()
+            links_uploader_to_mongo_thread = PopulateMongoDBLinksThread(self.db, shared_data, update)
+            links_uploader_to_mongo_thread.start()
+            for thread in file_builder_threads:
+                thread.join()
+            assert shared_data.build_ok_count == len(file_builder_threads)
 
         file_processor_threads = [
-            PopulateRedisCollectionThread(self.db, shared_data, KeyPrefix.OUTGOING_SET, False, False, update),
-            PopulateRedisCollectionThread(self.db, shared_data, KeyPrefix.INCOMING_SET, False, False, update),
-            PopulateRedisCollectionThread(self.db, shared_data, KeyPrefix.PATTERNS, True, False, update),
-            PopulateRedisCollectionThread(self.db, shared_data, KeyPrefix.TEMPLATES, True, False, update),
-            PopulateRedisCollectionThread(self.db, shared_data, KeyPrefix.NAMED_ENTITIES, False, True, update)
+            PopulateRedisCollectionThread(self.db, shared_data, KeyPrefix.OUTGOING_SET, False, False, update, manifest=manifest),
+            PopulateRedisCollectionThread(self.db, shared_data, KeyPrefix.INCOMING_SET, False, False, update, manifest=manifest),
+            PopulateRedisCollectionThread(self.db, shared_data, KeyPrefix.PATTERNS, True, False, update, manifest=manifest),
+            PopulateRedisCollectionThread(self.db, shared_data, KeyPrefix.TEMPLATES, True, False, update, manifest=manifest),
+            PopulateRedisCollectionThread(self.db, shared_data, KeyPrefix.NAMED_ENTITIES, False, True, update, manifest=manifest)
         ]
         for thread in file_processor_threads:
             thread.start()
-        links_uploader_to_mongo_thread.join()
-        assert shared_data.mongo_uploader_ok
+        if not parse_done:
+            links_uploader_to_mongo_thread.join()
+            assert shared_data.mongo_uploader_ok
+            if manifest is not None:
+                manifest.set_done("parse")
         for thread in file_processor_threads:
             thread.join()
         assert shared_data.process_ok_count == len(file_processor_threads)
         self.db.prefetch()
 
+    def _format_query_answer(self,
+        matched: bool,
+        query_answer: PatternMatchingAnswer,
+        output_format: QueryOutputFormat) -> str:
+
+        tag_not = ""
+        mapping = ""
+        if matched:
+            if query_answer.negation:
+                tag_not = "NOT "
+            if output_format == QueryOutputFormat.HANDLE:
+                mapping = str(query_answer.assignments)
+            elif output_format == QueryOutputFormat.ATOM_INFO:
+                mapping = str({
+                    var: self.db.get_atom_as_dict(handle)
+                    for var, handle in query_answer.assignments.items()})
+            elif output_format == QueryOutputFormat.JSON:
+                mapping = json.dumps({
+                    var: self.db.get_atom_as_deep_representation(handle)
+                    for var, handle in query_answer.assignments.items()}, sort_keys=False, indent=4)
+            else:
+                raise ValueError(f"Invalid output format: '{output_format}'")
+        return f"{tag_not}{mapping}"
+
 
     # Public API
 
@@ -174,10 +237,23 @@ class DistributedAtomSpace:
         for collection_name in self.mongo_db.collection_names():
             self.mongo_db.drop_collection(collection_name)
         self.redis.flushall()
+        remove_load_manifest(self.database_name)
 
     def count_atoms(self) -> Tuple[int, int]:
         return self.db.count_atoms()
 
+    def compute_degree_statistics(self, top_k: int = 100) -> Dict:
+        """
+        Compute and store in-degree and out-degree distributions (overall and
+        by atom type) along with the top_k hubs. Atoms with the largest
+        in-degrees are the ones whose patterns are candidates for
+        pattern_black_list.
+        """
+        return self.db.compute_degree_statistics(top_k)
+
+    def get_degree_statistics(self) -> Optional[Dict]:
+        return self.db.get_degree_statistics()
+
     def get_atom(self,
         handle: str,
         output_format: QueryOutputFormat = QueryOutputFormat.HANDLE) -> Union[str, Dict]:
@@ -292,77 +368,221 @@ class DistributedAtomSpace:
     def get_node_type(self, node_handle: str) -> str:
         return self.db.get_node_type(node_handle)
 
+    def get_incoming(self, handle: str, link_type: Optional[str] = None) -> List[str]:
+        return self.db.get_incoming(handle, link_type)
+
+    def get_incoming_many(self, handles: List[str], link_types: Optional[List[str]] = None) -> Dict[str, List[str]]:
+        return self.db.get_incoming_many(handles, link_types)
+
+    def expand(self,
+        handles: List[str],
+        depth: int,
+        link_types: Optional[List[str]] = None,
+        max_fanout: Optional[int] = None) -> Dict[str, int]:
+        """
+        Atoms reachable from the passed ones in up to depth hops through the
+        links pointing to them, mapped to their distance. See
+        DBInterface.expand().
+        """
+        return self.db.expand(handles, depth, link_types, max_fanout)
+
     def get_node_name(self, node_handle: str) -> str:
         return self.db.get_node_name(node_handle)
 
     def query(self,
         query: LogicalExpression,
-        output_format: QueryOutputFormat = QueryOutputFormat.HANDLE) -> str:
+        output_format: QueryOutputFormat = QueryOutputFormat.HANDLE,
+        budget: Optional[QueryBudget] = None) -> str:
+        """
+        If a budget is passed, QueryBudgetExceeded is raised as soon as the
+        query exceeds any of its limits (or the budget is cancelled).
+        """
 
-        query_answer = PatternMatchingAnswer()
+        query_answer = PatternMatchingAnswer(QueryContext(budget=budget))
         matched = query.matched(self.db, query_answer)
-        tag_not = ""
-        mapping = ""
-        if matched:
-            if query_answer.negation:
-                tag_not = "NOT "
-            if output_format == QueryOutputFormat.HANDLE:
-                mapping = str(query_answer.assignments)
-            elif output_format == QueryOutputFormat.ATOM_INFO:
-                mapping = str({
-                    var: self.db.get_atom_as_dict(handle)
-                    for var, handle in query_answer.assignments.items()})
-            elif output_format == QueryOutputFormat.JSON:
-                mapping = json.dumps({
-                    var: self.db.get_atom_as_deep_representation(handle)
-                    for var, handle in query_answer.assignments.items()}, sort_keys=False, indent=4)
-            else:
-                raise ValueError(f"Invalid output format: '{output_format}'")
-        return f"{tag_not}{mapping}"
+        return self._format_query_answer(matched, query_answer, output_format)
+
+    def profile_query(self,
+        query: LogicalExpression,
+        output_format: QueryOutputFormat = QueryOutputFormat.HANDLE,
+        budget: Optional[QueryBudget] = None) -> Tuple[str, Dict]:
+        """
+        Same as query() but also returns the profile of the evaluation: a tree
+        (mirroring the query operators) with wall time, number of DB calls,
+        fetched bytes, input/output assignments and strategy used by each
+        operator. See explain() for the plan without executing the query.
+        """
+
+        query_answer = PatternMatchingAnswer(QueryContext(budget=budget))
+        matched, profiler = _profile_query(self.db, query, query_answer)
+        return self._format_query_answer(matched, query_answer, output_format), profiler.to_dict()
+
+    def count(self, query: LogicalExpression, budget: Optional[QueryBudget] = None) -> int:
+        """
+        Number of assignments which satisfy the query. When possible the
+        count is taken from index sizes, without fetching the matched links.
+        """
+        return _count_query(self.db, query, PatternMatchingAnswer(QueryContext(budget=budget)))
+
+    def project(self,
+        query: LogicalExpression,
+        variables: List[str],
+        distinct: bool = True,
+        budget: Optional[QueryBudget] = None) -> List[Tuple[str, ...]]:
+        """
+        Values (handles) of the passed variables in each assignment which
+        satisfies the query. If distinct is True, duplicates are removed and
+        variables which aren't needed are dropped during the joins.
+        """
+        return _project_query(
+            self.db, query, variables, PatternMatchingAnswer(QueryContext(budget=budget)), distinct)
+
+    def sample(self,
+        query: LogicalExpression,
+        size: int,
+        budget: Optional[QueryBudget] = None) -> Tuple[str, float]:
+        """
+        Up to size assignments drawn uniformly at random from the ones which
+        satisfy the query (formatted like in query()) and an estimate of the
+        total number of assignments. Link/LinkTemplate terms are sampled
+        directly from the indexes so the query is not fully evaluated.
+        """
+        assignments, estimate = _sample_query(
+            self.db, query, size, PatternMatchingAnswer(QueryContext(budget=budget)))
+        return str(assignments), estimate
+
+    def explain(self, query: LogicalExpression) -> Dict:
+        """
+        Plan (evaluation order and strategy of each operator) of a query with
+        estimated cardinalities. The query isn't executed.
+        """
+        return explain(self.db, query)
+
+    def query_many(self,
+        queries: List[LogicalExpression],
+        output_format: QueryOutputFormat = QueryOutputFormat.HANDLE) -> List[str]:
+        """
+        Same as query() for a batch of queries. Pattern lookups shared by
+        different queries are fetched only once, in a single round trip.
+        """
+        return [
+            self._format_query_answer(matched, query_answer, output_format)
+            for matched, query_answer in match_many(self.db, queries)]
+
+    def prepare(self, query: LogicalExpression) -> PreparedQuery:
+        """
+        Compile a query with Parameter placeholders so it can be executed
+        many times (see execute()) without rebuilding, rehashing or
+        replanning it.
+        """
+        return PreparedQuery(self.db, query)
+
+    def execute(self,
+        prepared_query: PreparedQuery,
+        params: Dict[str, str],
+        output_format: QueryOutputFormat = QueryOutputFormat.HANDLE,
+        budget: Optional[QueryBudget] = None) -> str:
+
+        query_answer = PatternMatchingAnswer(QueryContext(budget=budget))
+        matched = prepared_query.execute(params, query_answer)
+        return self._format_query_answer(matched, query_answer, output_format)
 
     def open_transaction(self) -> Transaction:
         return Transaction()
 
     def commit_transaction(self, transaction: Transaction) -> None:
+        self.db.record_hash_algorithm()
+        self._record_pattern_index_policy()
         shared_data = SharedData()
+        shared_data.pattern_black_list = self.pattern_black_list
+        shared_data.pattern_index_policy = self.pattern_index_policy
         parser_thread = ParserThread(
             MultiThreadParsing(self.db, transaction.metta_string(), shared_data, use_action_broker_cache=True), 
             use_action_broker_cache=True)
         parser_thread.start()
         parser_thread.join()
         assert shared_data.parse_ok_count == 1
+        if self.standing_queries:
+            expressions = list(shared_data.regular_expressions)
+            exists = self.db.links_exist([(e.named_type, e.elements) for e in expressions])
+            new_expressions = [e for e, e_exists in zip(expressions, exists) if not e_exists]
         self._process_parsed_data(shared_data, True)
+        if self.standing_queries and new_expressions:
+            self._update_standing_queries(new_expressions)
+
+    def _update_standing_queries(self, new_expressions: List[Expression]) -> None:
+        new_links = []
+        for expression in new_expressions:
+            target_types = [
+                self.db.get_atom_as_dict(target)["type"] for target in expression.elements]
+            new_links.append((expression.named_type, expression.elements, target_types))
+        for query, callback in list(self.standing_queries.values()):
+            assignments = delta(self.db, query, new_links, PatternMatchingAnswer())
+            if assignments:
+                callback(assignments)
+
+    def register_standing_query(
+        self,
+        query: LogicalExpression,
+        callback: Callable[[Set[Assignment]], None]) -> int:
+        """
+        Register a query to be evaluated incrementally on every
+        commit_transaction(). The callback is called with the assignments
+        which satisfy the query because of the links added by the
+        transaction (it's not called if there are none). Queries must be
+        Links, LinkTemplates, Ands of them (possibly with negations) or Ors of
+        such queries.
+
+        Returns an id to be used in unregister_standing_query().
+        """
+        check_standing_query(query)
+        query_id = self.next_standing_query_id
+        self.next_standing_query_id += 1
+        self.standing_queries[query_id] = (query, callback)
+        return query_id
+
+    def unregister_standing_query(self, query_id: int) -> None:
+        del self.standing_queries[query_id]
 
-    def load_knowledge_base(self, source):
+    def load_knowledge_base(self, source, processes: Optional[int] = None):
         """
         This method parses one or more files
         and feeds the databases with all MeTTa expressions.
+
+        Files are parsed by a pool with up to processes processes (the
+        number of CPUs by default).
         """
         logger().info(f"Loading knowledge base")
+        self.db.record_hash_algorithm()
+        self._record_pattern_index_policy()
         knowledge_base_file_list = self._get_file_list(source)
         for file_name in knowledge_base_file_list:
             logger().info(f"Knowledge base file: {file_name}")
         shared_data = SharedData()
         shared_data.pattern_black_list = self.pattern_black_list
+        shared_data.pattern_index_policy = self.pattern_index_policy
+        manifest = LoadManifest(self.database_name, knowledge_base_file_list, "metta")
 
-        parser_threads = [
-            ParserThread(KnowledgeBaseFile(self.db, file_name, shared_data))
-            for file_name in knowledge_base_file_list
-        ]
-        for i in range(len(parser_threads)):
-            parser_threads[i].start()
-            # Sleep to avoid concurrency harzard in yacc lib startup
-            # (which is not thread safe)
-            if i < (len(parser_threads) - 1):
-                sleep(10)
-        for thread in parser_threads:
-            thread.join()
-        assert shared_data.parse_ok_count == len(parser_threads)
-        self._process_parsed_data(shared_data, False)
+        if manifest.is_done("parse"):
+            logger().info(f"Skipping parsing (already done)")
+        else:
+            # Parsing can't be resumed half way (the key-value files are
+            # written in no particular order) so it's done from the start
+            manifest.reset()
+            tasks = [(file_name, ExpressionHasher.algorithm) for file_name in knowledge_base_file_list]
+            processes = min(processes or os.cpu_count() or 1, len(tasks))
+            if processes <= 1:
+                self._add_parsed_files(shared_data, map(_parse_knowledge_base_file, tasks))
+            else:
+                with multiprocessing.get_context("spawn").Pool(processes) as pool:
+                    self._add_parsed_files(shared_data, pool.imap_unordered(_parse_knowledge_base_file, tasks))
+            assert shared_data.parse_ok_count == len(tasks)
+        self._process_parsed_data(shared_data, False, manifest)
+        manifest.remove()
         logger().info(f"Finished loading knowledge base")
         self._log_mongodb_counts()
 
-    def load_canonical_knowledge_base(self, source):
+    def load_canonical_knowledge_base(self, source, processes: int = 1):
         """
         This method loads a MeTTa knowledge base under certain assumptions:
 
@@ -400,16 +620,29 @@ class DistributedAtomSpace:
 
         Typically this method is used to load huge knowledge bases generated (or translated
         to MeTTa) by an automated tool.
+
+        If processes > 1, the expressions of each file are split in byte ranges (at line
+        boundaries) parsed by a pool with that many processes.
         """
         logger().info(f"Loading canonical knowledge base")
+        self.db.record_hash_algorithm()
+        self._record_pattern_index_policy()
         knowledge_base_file_list = sorted(self._get_file_list(source), reverse=True)
         for file_name in knowledge_base_file_list:
             logger().info(f"Knowledge base file: {file_name}")
-        canonical_parser = CanonicalParser(self.db, True)
+        manifest = LoadManifest(
+            self.database_name,
+            knowledge_base_file_list,
+            "canonical",
+            # Parsing progress is recorded differently with one or many processes
+            settings={'parallel': processes > 1})
+        canonical_parser = CanonicalParser(self.db, True, processes, manifest=manifest)
         canonical_parser.pattern_black_list = self.pattern_black_list
+        canonical_parser.pattern_index_policy = self.pattern_index_policy
         for file_name in knowledge_base_file_list:
             canonical_parser.parse(file_name)
         canonical_parser.populate_indexes()
+        manifest.remove()
         logger().info(f"Finished loading canonical knowledge base")
         self._log_mongodb_counts()
 
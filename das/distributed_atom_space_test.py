@@ -4,6 +4,7 @@ import os
 import pytest
 from das.distributed_atom_space import DistributedAtomSpace, WILDCARD, QueryOutputFormat
 from das.database.db_interface import UNORDERED_LINK_TYPES
+from das.pattern_matcher.pattern_matcher import Link, Node, Variable
 
 das = DistributedAtomSpace()
 
@@ -255,3 +256,11 @@ def test_get_links_with_patterns():
         set([human, ent]),
         [human, mammal],
     ])
+
+def test_profile_query():
+    query = Link(inheritance, [Variable('V1'), Node(concept, 'mammal')], True)
+    answer = das.query(query)
+    assert isinstance(answer, str)
+    profiled_answer, profile = das.profile_query(query)
+    assert len(profiled_answer) == len(answer)
+    assert profile['operator'] == 'Link'
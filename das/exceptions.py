@@ -1,4 +1,4 @@
-from typing import List
+from typing import Any, Dict, List, Optional
 
 class MettaLexerError(Exception):
     def __init__(self, error_message: str):
@@ -20,3 +20,19 @@ class UndefinedSymbolError(Exception):
     def __init__(self, symbols: List[str]):
         super().__init__(str(symbols))
         self.missing_symbols = [symbol for symbol in symbols]
+
+class QueryBudgetExceeded(Exception):
+    def __init__(self, budget: str, limit: Optional[Any], statistics: Dict[str, Any]):
+        super().__init__(f'Query budget exceeded: {budget} (limit: {limit}) statistics: {statistics}')
+        self.budget = budget
+        self.limit = limit
+        self.statistics = statistics
+
+class UnsupportedOperationError(NotImplementedError):
+    def __init__(self, operation: str):
+        super().__init__(f'{operation}() is not supported by this DB')
+        self.operation = operation
+
+class MongoWriterError(Exception):
+    def __init__(self, error_message: str):
+        super().__init__(error_message)
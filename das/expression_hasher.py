@@ -1,13 +1,47 @@
-from typing import List, Any
+from typing import Callable, Dict, List, Any
 from hashlib import md5
 
+# Functions which compute the 128-bit digest (as a hex string) used to build
+# handles, by name. Atoms loaded with different algorithms can't be mixed so
+# each database records the one it uses (see RedisMongoDB).
+HASH_ALGORITHMS: Dict[str, Callable[[bytes], str]] = {
+    'md5': lambda data: md5(data).hexdigest(),
+}
+try:
+    import xxhash
+    HASH_ALGORITHMS['xxh128'] = xxhash.xxh3_128_hexdigest
+except ImportError:
+    pass
+DEFAULT_HASH_ALGORITHM = 'md5'
+
 class ExpressionHasher:
 
     compound_separator = " "
+    algorithm = DEFAULT_HASH_ALGORITHM
+    _digest = HASH_ALGORITHMS[DEFAULT_HASH_ALGORITHM]
+
+    @staticmethod
+    def register_algorithm(name: str, digest: Callable[[bytes], str]) -> None:
+        """
+        Make a hash algorithm available to set_algorithm(). digest must
+        return a 128-bit digest as a hex string.
+        """
+        HASH_ALGORITHMS[name] = digest
+
+    @staticmethod
+    def set_algorithm(name: str) -> None:
+        """
+        Select the hash algorithm used to compute all the hashes of this
+        process.
+        """
+        if name not in HASH_ALGORITHMS:
+            raise ValueError(f"Invalid hash algorithm: {name}. Available algorithms: {list(HASH_ALGORITHMS.keys())}")
+        ExpressionHasher.algorithm = name
+        ExpressionHasher._digest = HASH_ALGORITHMS[name]
 
     @staticmethod
     def _compute_hash(text: str) -> str:
-        return md5(text.encode("utf-8")).digest().hex()
+        return ExpressionHasher._digest(text.encode("utf-8"))
 
     @staticmethod
     def named_type_hash(name: str) -> str:
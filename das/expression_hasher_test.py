@@ -0,0 +1,17 @@
+import pytest
+from das.expression_hasher import ExpressionHasher, DEFAULT_HASH_ALGORITHM
+
+def test_hash_algorithm():
+    assert ExpressionHasher.algorithm == DEFAULT_HASH_ALGORITHM
+    assert ExpressionHasher.named_type_hash("Type") == "a1fa27779242b4902f7ae3bdd5c6d508"
+    ExpressionHasher.register_algorithm("test", lambda data: data.hex().rjust(32, "0")[:32])
+    try:
+        ExpressionHasher.set_algorithm("test")
+        assert ExpressionHasher.algorithm == "test"
+        assert ExpressionHasher.named_type_hash("Type") == "00000000000000000000000054797065"
+        assert ExpressionHasher.composite_hash(["a", "b"]) == "00000000000000000000000000612062"
+    finally:
+        ExpressionHasher.set_algorithm(DEFAULT_HASH_ALGORITHM)
+    with pytest.raises(ValueError):
+        ExpressionHasher.set_algorithm("invalid")
+    assert ExpressionHasher.named_type_hash("Type") == "a1fa27779242b4902f7ae3bdd5c6d508"
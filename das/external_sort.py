@@ -0,0 +1,119 @@
+import gzip
+import heapq
+import multiprocessing
+import os
+import shutil
+import tempfile
+from typing import Iterator, List, Optional, Tuple
+
+from das.logger import logger
+
+# Approximate number of bytes of the input file sorted in memory at once
+# (split among the processes generating the sorted runs)
+SORT_MEMORY_BUDGET = 512 * 1024 * 1024
+# Directory where sorted runs are written (None means the directory of the
+# file being sorted)
+SORT_TMP_DIR = None
+# Max number of runs merged at once. More runs are merged in several passes.
+SORT_MAX_MERGE_FAN_IN = 128
+
+def _open_run(file_name: str, mode: str, compress: bool):
+    return gzip.open(file_name, mode, compresslevel=1) if compress else open(file_name, mode)
+
+def _sort_run(task: Tuple[str, int, int, str, bool, bool]) -> str:
+    # Runs in the worker processes of sorted_lines()
+    input_file_name, start, end, run_file_name, unique, compress = task
+    with open(input_file_name, "rb") as file:
+        file.seek(start)
+        lines = file.read(end - start).splitlines(keepends=True)
+    if lines and not lines[-1].endswith(b"\n"):
+        lines[-1] += b"\n"
+    lines.sort()
+    with _open_run(run_file_name, "wb", compress) as run:
+        previous = None
+        for line in lines:
+            if not (unique and line == previous):
+                run.write(line)
+            previous = line
+    return run_file_name
+
+def _split_file(file_name: str, run_size: int) -> List[Tuple[int, int]]:
+    # Byte ranges (at line boundaries) of up to about run_size bytes
+    file_size = os.path.getsize(file_name)
+    ranges = []
+    with open(file_name, "rb") as file:
+        start = 0
+        while start < file_size:
+            file.seek(min(start + run_size, file_size))
+            file.readline()
+            end = min(file.tell(), file_size)
+            ranges.append((start, end))
+            start = end
+    return ranges
+
+def _merge(run_file_names: List[str], unique: bool, compress: bool) -> Iterator[bytes]:
+    runs = [_open_run(run_file_name, "rb", compress) for run_file_name in run_file_names]
+    try:
+        previous = None
+        for line in heapq.merge(*runs):
+            if not (unique and line == previous):
+                yield line
+            previous = line
+    finally:
+        for run in runs:
+            run.close()
+
+def sorted_lines(
+    file_name: str,
+    *,
+    unique: bool = False,
+    memory_budget: int = SORT_MEMORY_BUDGET,
+    processes: Optional[int] = None,
+    tmp_dir: Optional[str] = None,
+    compress: bool = False) -> Iterator[bytes]:
+    """
+    External merge sort of the lines of a file. Yields the lines (bytes,
+    including the trailing newline) in byte order so, in key-value files,
+    all the lines with the same key are consecutive. Identical lines are
+    yielded only once if unique is True.
+
+    The file is split in runs of up to memory_budget / processes bytes which
+    are sorted in parallel by a pool with that many processes (the number of
+    CPUs by default) and written to tmp_dir (gzipped if compress is True).
+    Runs are then k-way merged while the lines are consumed, so no sorted
+    copy of the whole file is written.
+    """
+    processes = processes or os.cpu_count() or 1
+    run_size = max(1, memory_budget // processes)
+    tmp_dir = tempfile.mkdtemp(
+        prefix="das_sort_",
+        dir=tmp_dir or SORT_TMP_DIR or os.path.dirname(os.path.abspath(file_name)))
+    try:
+        ranges = _split_file(file_name, run_size)
+        suffix = ".gz" if compress else ""
+        tasks = [
+            (file_name, start, end, os.path.join(tmp_dir, f"run_{i}{suffix}"), unique, compress)
+            for i, (start, end) in enumerate(ranges)]
+        logger().info(f"Sorting {file_name} in {len(tasks)} runs")
+        if processes == 1 or len(tasks) <= 1:
+            run_file_names = [_sort_run(task) for task in tasks]
+        else:
+            with multiprocessing.get_context("spawn").Pool(min(processes, len(tasks))) as pool:
+                run_file_names = pool.map(_sort_run, tasks)
+        merge_pass = 0
+        while len(run_file_names) > SORT_MAX_MERGE_FAN_IN:
+            merge_pass += 1
+            logger().info(f"Merging {len(run_file_names)} runs of {file_name} (pass {merge_pass})")
+            merged_file_names = []
+            for i in range(0, len(run_file_names), SORT_MAX_MERGE_FAN_IN):
+                group = run_file_names[i:i + SORT_MAX_MERGE_FAN_IN]
+                merged_file_name = os.path.join(tmp_dir, f"merge_{merge_pass}_{i}{suffix}")
+                with _open_run(merged_file_name, "wb", compress) as merged:
+                    merged.writelines(_merge(group, unique, compress))
+                for run_file_name in group:
+                    os.remove(run_file_name)
+                merged_file_names.append(merged_file_name)
+            run_file_names = merged_file_names
+        yield from _merge(run_file_names, unique, compress)
+    finally:
+        shutil.rmtree(tmp_dir, ignore_errors=True)
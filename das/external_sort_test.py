@@ -0,0 +1,45 @@
+import random
+from das.external_sort import sorted_lines
+import das.external_sort
+from das.key_value_file import key_value_generator, sort_file
+
+def _write_lines(path, lines):
+    with open(path, "w") as file:
+        file.write("".join(f"{line}\n" for line in lines))
+
+def test_sorted_lines(tmp_path):
+    random.seed(0)
+    lines = [f"{random.randrange(50):02d}\t{random.randrange(1000)}" for _ in range(2000)]
+    path = str(tmp_path / "file.txt")
+    _write_lines(path, lines)
+    expected = sorted(line.encode() + b"\n" for line in lines)
+    assert list(sorted_lines(path, memory_budget=1000, processes=1)) == expected
+    assert list(sorted_lines(path, memory_budget=1000, processes=1, compress=True)) == expected
+    assert list(sorted_lines(path, unique=True, memory_budget=1000, processes=1)) == sorted(set(expected))
+    assert list(sorted_lines(path, processes=1)) == expected
+    assert list(tmp_path.iterdir()) == [tmp_path / "file.txt"]
+
+def test_sorted_lines_merge_passes(tmp_path, monkeypatch):
+    monkeypatch.setattr(das.external_sort, "SORT_MAX_MERGE_FAN_IN", 3)
+    lines = [f"{i % 7}\t{i}" for i in range(100)]
+    path = str(tmp_path / "file.txt")
+    _write_lines(path, lines)
+    answer = list(sorted_lines(path, memory_budget=50, processes=1, tmp_dir=str(tmp_path)))
+    assert answer == sorted(line.encode() + b"\n" for line in lines)
+    assert list(sorted_lines(str(tmp_path / "file.txt"), processes=1)) == answer
+
+def test_sorted_lines_in_parallel(tmp_path):
+    lines = [f"{i % 13}\t{i}" for i in range(1000)]
+    path = str(tmp_path / "file.txt")
+    _write_lines(path, lines)
+    answer = list(sorted_lines(path, memory_budget=4000, processes=2))
+    assert answer == sorted(line.encode() + b"\n" for line in lines)
+
+def test_key_value_generator_sort(tmp_path):
+    path = str(tmp_path / "file.txt")
+    _write_lines(path, ["b\t1", "a\t2", "b\t3", "a\t2", "c\t4"])
+    answer = [(key, sorted(value)) for key, value, _ in key_value_generator(path, sort=True, unique=True)]
+    assert answer == [("a", ["2"]), ("b", ["1", "3"]), ("c", ["4"])]
+    sort_file(path)
+    with open(path) as file:
+        assert file.read() == "a\t2\na\t2\nb\t1\nb\t3\nc\t4\n"
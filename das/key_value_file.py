@@ -1,10 +1,23 @@
 from das.expression_hasher import ExpressionHasher
+from das.external_sort import sorted_lines
 import os
 
-def sort_file(file_name):
-    os.system(f"sort -t , -k 1,1 {file_name} > {file_name}.sorted")
+def sort_file(file_name, unique=False, **sort_args):
+    # See das.external_sort.sorted_lines() for sort_args
+    with open(f"{file_name}.sorted", "wb") as output:
+        output.writelines(sorted_lines(file_name, unique=unique, **sort_args))
     os.rename(f"{file_name}.sorted", file_name)
 
+def _read_lines(input_filename, sort, unique):
+    # If sort is True, lines are grouped by key while the sorted runs are
+    # merged instead of in a second pass over a sorted copy of the file
+    if sort:
+        for line in sorted_lines(input_filename, unique=unique):
+            yield line.decode()
+    else:
+        with open(input_filename, 'r') as fh:
+            yield from fh
+
 def write_key_value(file, key, value):
     if isinstance(key, list):
         key = ExpressionHasher.composite_hash(key)
@@ -14,63 +27,61 @@ def write_key_value(file, key, value):
     file.write(line)
     file.write("\n")
 
-def key_value_generator(input_filename, *, block_size=None, merge_rest=False):
+def key_value_generator(input_filename, *, block_size=None, merge_rest=False, sort=False, unique=False):
     last_key = ''
     last_list = []
     block_count = 0
     global KEY_VALUE_LINE_COUNTER
     KEY_VALUE_LINE_COUNTER = 0
-    with open(input_filename, 'r') as fh:
-        for line in fh:
-            KEY_VALUE_LINE_COUNTER += 1
-            line = line.strip()
-            if line == '':
-                continue
-            if merge_rest:
-                v = line.split("\t")
-                key = v[0]
-                value = ",".join(v[1:])
-            else:
-                key, value = line.split("\t")
-            if last_key == key:
-                last_list.append(value)
-                if block_size and len(last_list) >= block_size:
-                    yield last_key, last_list, block_count
-                    block_count += 1
-                    last_list = []
-            else:
-                if last_key != '':
-                    yield last_key, last_list, block_count
-                block_count = 0
-                last_key = key
-                last_list = [value]
+    for line in _read_lines(input_filename, sort, unique):
+        KEY_VALUE_LINE_COUNTER += 1
+        line = line.strip()
+        if line == '':
+            continue
+        if merge_rest:
+            v = line.split("\t")
+            key = v[0]
+            value = ",".join(v[1:])
+        else:
+            key, value = line.split("\t")
+        if last_key == key:
+            last_list.append(value)
+            if block_size and len(last_list) >= block_size:
+                yield last_key, last_list, block_count
+                block_count += 1
+                last_list = []
+        else:
+            if last_key != '':
+                yield last_key, last_list, block_count
+            block_count = 0
+            last_key = key
+            last_list = [value]
     if last_key != '':
         yield last_key, last_list, block_count
 
-def key_value_targets_generator(input_filename, *, block_size=None, merge_rest=False):
+def key_value_targets_generator(input_filename, *, block_size=None, merge_rest=False, sort=False, unique=False):
     last_key = ''
     last_list = []
     global KEY_VALUE_LINE_COUNTER
     KEY_VALUE_LINE_COUNTER = 0
     block_count = 0
-    with open(input_filename, 'r') as fh:
-        for line in fh:
-            KEY_VALUE_LINE_COUNTER += 1
-            line = line.strip()
-            if line == '':
-                continue
-            key, value, *targets = line.split("\t")
-            if last_key == key:
-                last_list.append(tuple([value, tuple(targets)]))
-                if block_size and len(last_list) >= block_size:
-                    yield last_key, last_list, block_count
-                    block_count += 1
-                    last_list = []
-            else:
-                if last_key != '':
-                    yield last_key, last_list, block_count
-                block_count = 0
-                last_key = key
-                last_list = [tuple([value, tuple(targets)])]
+    for line in _read_lines(input_filename, sort, unique):
+        KEY_VALUE_LINE_COUNTER += 1
+        line = line.strip()
+        if line == '':
+            continue
+        key, value, *targets = line.split("\t")
+        if last_key == key:
+            last_list.append(tuple([value, tuple(targets)]))
+            if block_size and len(last_list) >= block_size:
+                yield last_key, last_list, block_count
+                block_count += 1
+                last_list = []
+        else:
+            if last_key != '':
+                yield last_key, last_list, block_count
+            block_count = 0
+            last_key = key
+            last_list = [tuple([value, tuple(targets)])]
     if last_key != '':
         yield last_key, last_list, block_count
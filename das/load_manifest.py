@@ -0,0 +1,141 @@
+import json
+import os
+from threading import Lock
+from typing import Any, Callable, Dict, Iterable, Iterator, List, Optional
+
+from das.logger import logger
+
+# Progress of the last knowledge base load in each database (removed when
+# the load finishes)
+LOAD_MANIFEST_FILE_NAME = "/tmp/parser_manifest_{database_name}.json"
+# Number of items consumed between checkpoints in LoadManifest.track()
+CHECKPOINT_INTERVAL = 100000
+
+class LoadManifest:
+    """
+    Progress of a knowledge base load (per stage, e.g. parsing of a file or
+    upload of a Redis collection) kept in a JSON file so a load restarted
+    after dying skips the work already done.
+
+    A manifest belongs to a load of a given list of files (with their sizes
+    and modification times) in a given database with the given settings
+    (which change the shape of the recorded progress, e.g. the number of
+    processes). The manifest of any other load found in file_name (by
+    default, LOAD_MANIFEST_FILE_NAME for the database) is discarded.
+    """
+
+    def __init__(
+        self,
+        database_name: str,
+        source_files: List[str],
+        loader: str,
+        settings: Optional[Dict[str, Any]] = None,
+        file_name: Optional[str] = None):
+        self.file_name = file_name or LOAD_MANIFEST_FILE_NAME.format(database_name=database_name)
+        self.lock = Lock()
+        identity = {
+            'loader': loader,
+            'database': database_name,
+            'settings': settings or {},
+            'files': [
+                [os.path.abspath(f), os.path.getsize(f), os.stat(f).st_mtime_ns] for f in source_files],
+        }
+        self.data = {'identity': identity, 'stages': {}}
+        self.resumed = False
+        if os.path.exists(self.file_name):
+            with open(self.file_name, "r") as file:
+                data = json.load(file)
+            if data.get('identity') == identity:
+                logger().info(f"Resuming load from {self.file_name}")
+                self.data = data
+                self.resumed = True
+            else:
+                logger().info(f"Discarding manifest of another load in {self.file_name}")
+        self.save()
+
+    def save(self) -> None:
+        with self.lock:
+            temporary_file_name = f"{self.file_name}.tmp"
+            with open(temporary_file_name, "w") as file:
+                json.dump(self.data, file)
+                file.flush()
+                os.fsync(file.fileno())
+            os.replace(temporary_file_name, self.file_name)
+
+    def get(self, stage: str, default: Optional[Any] = None) -> Any:
+        with self.lock:
+            return self.data['stages'].get(stage, default)
+
+    def set(self, stage: str, state: Any) -> None:
+        """
+        Record the state of a stage and save the manifest.
+        """
+        with self.lock:
+            self.data['stages'][stage] = state
+        self.save()
+
+    def set_many(self, states: Dict[str, Any]) -> None:
+        """
+        Same as set() for many stages at once (saved together).
+        """
+        with self.lock:
+            self.data['stages'].update(states)
+        self.save()
+
+    def is_done(self, stage: str) -> bool:
+        state = self.get(stage)
+        return isinstance(state, dict) and state.get('done', False)
+
+    def set_done(self, stage: str) -> None:
+        self.set(stage, {'done': True})
+
+    def reset(self) -> None:
+        """
+        Forget the progress of all the stages.
+        """
+        with self.lock:
+            self.data['stages'] = {}
+        self.save()
+
+    def track(
+        self,
+        stage: str,
+        items: Iterable[Any],
+        checkpoint: Callable[[], None],
+        interval: Optional[int] = None) -> Iterator[Any]:
+        """
+        Yield the items of a stage skipping the ones consumed before its last
+        checkpoint (so items must be yielded in the same order every time).
+        Every interval (CHECKPOINT_INTERVAL by default) items (and after the
+        last one), checkpoint() is called
+        to persist the work done with the items consumed so far and the
+        progress is recorded.
+        """
+        interval = interval or CHECKPOINT_INTERVAL
+        state = self.get(stage, {})
+        if state.get('done', False):
+            logger().info(f"Skipping {stage} (done)")
+            return
+        skip = state.get('count', 0)
+        if skip:
+            logger().info(f"Skipping the first {skip} items of {stage}")
+        count = 0
+        for item in items:
+            count += 1
+            if count <= skip:
+                continue
+            yield item
+            if count % interval == 0:
+                checkpoint()
+                self.set(stage, {'count': count})
+        checkpoint()
+        self.set_done(stage)
+
+    def remove(self) -> None:
+        if os.path.exists(self.file_name):
+            os.remove(self.file_name)
+
+def remove_load_manifest(database_name: str) -> None:
+    file_name = LOAD_MANIFEST_FILE_NAME.format(database_name=database_name)
+    if os.path.exists(file_name):
+        os.remove(file_name)
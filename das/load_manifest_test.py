@@ -0,0 +1,50 @@
+from das.load_manifest import LoadManifest, remove_load_manifest
+
+def _manifest(tmp_path, database_name="das", processes=1):
+    return LoadManifest(
+        database_name,
+        [str(tmp_path / "kb.metta")],
+        "canonical",
+        settings={'parallel': processes > 1},
+        file_name=str(tmp_path / "manifest.json"))
+
+def test_track(tmp_path):
+    (tmp_path / "kb.metta").write_text("(: Concept Type)\n")
+    manifest = _manifest(tmp_path)
+    assert not manifest.resumed
+    checkpoints = []
+    consumed = []
+    try:
+        for item in manifest.track("stage", range(10), lambda: checkpoints.append(len(consumed)), interval=3):
+            if item == 7:
+                raise RuntimeError()
+            consumed.append(item)
+    except RuntimeError:
+        pass
+    assert checkpoints == [3, 6]
+    manifest = _manifest(tmp_path)
+    assert manifest.resumed
+    assert list(manifest.track("stage", range(10), lambda: None, interval=3)) == [6, 7, 8, 9]
+    assert manifest.is_done("stage")
+    assert list(_manifest(tmp_path).track("stage", range(10), lambda: None)) == []
+
+def test_identity(tmp_path):
+    (tmp_path / "kb.metta").write_text("(: Concept Type)\n")
+    _manifest(tmp_path).set_done("stage")
+    assert not _manifest(tmp_path, "other").resumed
+    _manifest(tmp_path).set_done("stage")
+    assert _manifest(tmp_path, processes=1).is_done("stage")
+    assert not _manifest(tmp_path, processes=4).resumed
+    manifest = _manifest(tmp_path)
+    assert not manifest.resumed
+    assert not manifest.is_done("stage")
+    manifest.set_done("stage")
+    (tmp_path / "kb.metta").write_text("(: Concept Type)\n(: Predicate Type)\n")
+    assert not _manifest(tmp_path).is_done("stage")
+    _manifest(tmp_path).remove()
+    assert list(tmp_path.iterdir()) == [tmp_path / "kb.metta"]
+
+def test_file_name():
+    assert LoadManifest("db_1", [], "metta").file_name != LoadManifest("db_2", [], "metta").file_name
+    remove_load_manifest("db_1")
+    remove_load_manifest("db_2")
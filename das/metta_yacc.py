@@ -24,7 +24,6 @@ EXPRESSION -> EXPRESSION_OPENNING LIST_OF_EXPRESSIONS EXPRESSION_CLOSING
 """
 
 from typing import List, Any, Optional
-import ply.yacc as yacc
 from das.metta_lex import MettaLex
 from das.exceptions import MettaSyntaxError, UndefinedSymbolError
 from das.expression_hasher import ExpressionHasher
@@ -177,4 +176,4 @@ class MettaYacc(BaseYacc):
         super().__init__(**kwargs)
         self.lex_wrap = MettaLex()
         super().setup()
-        self.parser = yacc.yacc(module=self)
+        self.parser = self.build_parser()
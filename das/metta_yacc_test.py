@@ -61,6 +61,18 @@ def test_action_broker():
     assert action_broker.count_toplevel_expression == 1
     assert action_broker.count_type == 9
 
+def test_shared_parsing_tables():
+    action_broker_1 = ActionBroker()
+    action_broker_2 = ActionBroker()
+    yacc_wrap_1 = MettaYacc(action_broker=action_broker_1)
+    yacc_wrap_2 = MettaYacc(action_broker=action_broker_2)
+    assert yacc_wrap_1.parser.action is yacc_wrap_2.parser.action
+    assert yacc_wrap_1.parse(test_data) == "SUCCESS"
+    assert action_broker_1.count_toplevel_expression == 1
+    assert action_broker_2.count_toplevel_expression == 0
+    assert yacc_wrap_2.parse(test_data) == "SUCCESS"
+    assert action_broker_2.count_toplevel_expression == 1
+
 def test_terminal_hash():
 
     yacc_wrap = MettaYacc()
@@ -0,0 +1,169 @@
+import os
+import sys
+from queue import Queue
+from threading import Lock, Thread
+from typing import Any, Dict, List, Optional
+
+from pymongo import MongoClient as MongoDBClient
+from pymongo.database import Database
+from pymongo.errors import BulkWriteError
+from pymongo.write_concern import WriteConcern
+
+from das.exceptions import MongoWriterError
+from das.logger import logger
+
+# Max number of batches waiting to be inserted. Producers block when the
+# queue is full so the number of documents in memory is bounded.
+MONGO_WRITER_QUEUE_SIZE = 8
+# Number of threads inserting batches concurrently
+MONGO_WRITER_WORKERS = 4
+# Max number of documents inserted by each insert_many()
+MONGO_WRITER_BATCH_SIZE = 10000
+# Write concern of the insertions (None means the database's default)
+MONGO_WRITE_CONCERN: Optional[WriteConcern] = None
+# Documents with larger names can't be stored by MongoDB
+MAX_DOCUMENT_NAME_SIZE = 16000000
+DUPLICATE_KEY_ERROR = 11000
+
+def connect_mongo_db(database_name: str) -> Database:
+    """
+    Connect to the MongoDB database given by the DAS_MONGODB_* and
+    DAS_DATABASE_* environment variables.
+    """
+    hostname = os.environ.get('DAS_MONGODB_HOSTNAME')
+    port = os.environ.get('DAS_MONGODB_PORT')
+    username = os.environ.get('DAS_DATABASE_USERNAME')
+    password = os.environ.get('DAS_DATABASE_PASSWORD')
+    logger().info(f"Connecting to MongoDB at {hostname}:{port}")
+    return MongoDBClient(f'mongodb://{username}:{password}@{hostname}:{port}')[database_name]
+
+class MongoWriter:
+    """
+    Pool of threads which insert batches of documents in MongoDB.
+
+    Documents passed to write() are split in batches of up to batch_size
+    documents which are passed through a bounded queue, so a producer (e.g. a
+    parser) faster than MongoDB is blocked instead of accumulating documents,
+    and inserted concurrently by worker threads with unordered writes.
+    close() waits for all the queued batches to be inserted.
+
+    Duplicate key errors are counted (see statistics) and, unless
+    allow_duplicates is True, logged. Any other error is raised by the next
+    call to write() or close().
+    """
+
+    def __init__(
+        self,
+        mongo_db: Any,
+        allow_duplicates: bool,
+        queue_size: int = MONGO_WRITER_QUEUE_SIZE,
+        workers: int = MONGO_WRITER_WORKERS,
+        batch_size: int = MONGO_WRITER_BATCH_SIZE,
+        write_concern: Optional[WriteConcern] = MONGO_WRITE_CONCERN):
+        self.mongo_db = mongo_db
+        self.allow_duplicates = allow_duplicates
+        self.batch_size = batch_size
+        self.write_concern = write_concern
+        self.queue = Queue(maxsize=queue_size)
+        self.error: Optional[Exception] = None
+        # Number of batches, inserted documents and duplicates per collection
+        self.statistics: Dict[str, Dict[str, int]] = {}
+        self.lock = Lock()
+        self.threads = [Thread(target=self._run, daemon=True) for _ in range(workers)]
+        for thread in self.threads:
+            thread.start()
+
+    def _collection(self, collection_name: str) -> Any:
+        collection = self.mongo_db[collection_name]
+        if self.write_concern is not None:
+            collection = collection.with_options(write_concern=self.write_concern)
+        return collection
+
+    def _add_statistics(self, collection_name: str, inserted: int, duplicates: int) -> None:
+        with self.lock:
+            statistics = self.statistics.setdefault(
+                collection_name, {'batches': 0, 'inserted': 0, 'duplicates': 0})
+            statistics['batches'] += 1
+            statistics['inserted'] += inserted
+            statistics['duplicates'] += duplicates
+
+    def _insert_many(self, collection_name: str, documents: List[Dict[str, Any]]) -> None:
+        all_ids = set()
+        bulk_insertion_no_duplicates = []
+        for document in documents:
+            if document["_id"] not in all_ids:
+                all_ids.add(document["_id"])
+                bulk_insertion_no_duplicates.append(document)
+        bulk_insertion = [
+            document for document in bulk_insertion_no_duplicates
+            if ("name" not in document) or sys.getsizeof(document["name"]) < MAX_DOCUMENT_NAME_SIZE]
+        if len(bulk_insertion_no_duplicates) != len(bulk_insertion):
+            logger().error(f"Striped {len(bulk_insertion_no_duplicates) - len(bulk_insertion)} too large documents")
+        if not bulk_insertion:
+            return
+        duplicates = len(documents) - len(bulk_insertion_no_duplicates)
+        try:
+            self._collection(collection_name).insert_many(bulk_insertion, ordered=False)
+            inserted = len(bulk_insertion)
+        except BulkWriteError as exception:
+            write_errors = exception.details.get("writeErrors", [])
+            other_errors = [error for error in write_errors if error.get("code") != DUPLICATE_KEY_ERROR]
+            inserted = exception.details.get("nInserted", 0)
+            duplicates += len(write_errors) - len(other_errors)
+            if other_errors:
+                self._add_statistics(collection_name, inserted, duplicates)
+                raise MongoWriterError(
+                    f"{len(other_errors)} documents not inserted in {collection_name}: " + \
+                    f"{other_errors[0].get('errmsg')}") from exception
+        if duplicates and not self.allow_duplicates:
+            logger().error(f"{duplicates} duplicate documents in a batch of {len(documents)} in {collection_name}")
+        self._add_statistics(collection_name, inserted, duplicates)
+
+    def _run(self) -> None:
+        while True:
+            batch = self.queue.get()
+            if batch is None:
+                self.queue.task_done()
+                break
+            # Keep consuming after errors so producers don't block forever
+            if self.error is None:
+                try:
+                    self._insert_many(*batch)
+                except Exception as exception:
+                    logger().error(f"Error inserting documents in {batch[0]}: {exception}")
+                    self.error = exception
+            self.queue.task_done()
+
+    def write(self, collection_name: str, documents: List[Dict[str, Any]]) -> None:
+        """
+        Queue the documents to be inserted, in batches of up to batch_size
+        documents. Blocks while the queue is full.
+        """
+        if self.error is not None:
+            raise self.error
+        for i in range(0, len(documents), self.batch_size):
+            self.queue.put((collection_name, documents[i:i + self.batch_size]))
+
+    def flush(self) -> None:
+        """
+        Wait for all the queued batches to be inserted.
+        """
+        self.queue.join()
+        if self.error is not None:
+            raise self.error
+
+    def close(self) -> Dict[str, Dict[str, int]]:
+        """
+        Wait for all the queued batches to be inserted. Returns the
+        statistics of each collection.
+        """
+        for _ in self.threads:
+            self.queue.put(None)
+        for thread in self.threads:
+            thread.join()
+        for collection_name, statistics in self.statistics.items():
+            logger().info(f"Inserted {statistics['inserted']} documents in {collection_name} " + \
+                f"({statistics['batches']} batches, {statistics['duplicates']} duplicates)")
+        if self.error is not None:
+            raise self.error
+        return self.statistics
@@ -3,15 +3,20 @@ import datetime
 import time
 import pickle
 from threading import Thread, Lock
+from typing import List, Optional
 from das.expression import Expression
 from das.database.mongo_schema import CollectionNames as MongoCollections
-from das.database.key_value_schema import CollectionNames as KeyPrefix, build_redis_key
+from das.database.key_value_schema import CollectionNames as KeyPrefix, build_redis_key, \
+    get_target_type_hashes, PatternIndexPolicy
 from das.metta_yacc import MettaYacc
 from das.atomese_yacc import AtomeseYacc
 from das.database.db_interface import DBInterface
 from das.database.db_interface import DBInterface, WILDCARD
 from das.logger import logger
-from das.key_value_file import write_key_value, key_value_generator, key_value_targets_generator
+from das.mongo_writer import MongoWriter
+from das.redis_bulk_loader import RedisBulkLoader
+from das.load_manifest import LoadManifest
+from das.key_value_file import write_key_value, key_value_generator, key_value_targets_generator, sort_file
 
 class SharedData():
     def __init__(self):
@@ -39,6 +44,7 @@ class SharedData():
             s.value: f"/tmp/parser_{s.value}.txt" for s in KeyPrefix
         }
         self.pattern_black_list = []
+        self.pattern_index_policy = PatternIndexPolicy()
 
     def add_regular_expression(self, expression: Expression) -> None:
         self.lock_regular_expressions.acquire()
@@ -60,6 +66,21 @@ class SharedData():
         self.terminals.add(terminal)
         self.lock_terminals.release()
 
+    def add_expressions(
+        self,
+        regular_expressions: List[Expression],
+        typedef_expressions: List[Expression],
+        terminals: List[Expression]) -> None:
+        self.lock_regular_expressions.acquire()
+        self.regular_expressions.update(regular_expressions)
+        self.lock_regular_expressions.release()
+        self.lock_typedef_expressions.acquire()
+        self.typedef_expressions.update(typedef_expressions)
+        self.lock_typedef_expressions.release()
+        self.lock_terminals.acquire()
+        self.terminals.update(terminals)
+        self.lock_terminals.release()
+
     def parse_ok(self):
         self.lock_parse_ok_count.acquire()
         self.parse_ok_count += 1
@@ -75,6 +96,15 @@ class SharedData():
         self.process_ok_count += 1
         self.lock_process_ok_count.release()
         
+def parse_action_broker_input(parser_actions_broker: "ParserActions", use_action_broker_cache: bool = False) -> None:
+    if parser_actions_broker.file_path.endswith(".scm"):
+        parser = AtomeseYacc(action_broker=parser_actions_broker)
+    else:
+        parser = MettaYacc(
+            action_broker=parser_actions_broker,
+            use_action_broker_cache=use_action_broker_cache)
+    parser.parse_action_broker_input()
+
 class ParserThread(Thread):
 
     def __init__(self, parser_actions_broker: "ParserActions", use_action_broker_cache: bool = False):
@@ -86,13 +116,7 @@ class ParserThread(Thread):
         logger().info(f"Parser thread {self.name} (TID {self.native_id}) started. " + \
             f"Parsing {self.parser_actions_broker.file_path}")
         stopwatch_start = time.perf_counter()
-        if self.parser_actions_broker.file_path.endswith(".scm"):
-            parser = AtomeseYacc(action_broker=self.parser_actions_broker)
-        else:
-            parser = MettaYacc(
-                action_broker=self.parser_actions_broker, 
-                use_action_broker_cache=self.use_action_broker_cache)
-        parser.parse_action_broker_input()
+        parse_action_broker_input(self.parser_actions_broker, self.use_action_broker_cache)
         self.parser_actions_broker.shared_data.parse_ok()
         elapsed = (time.perf_counter() - stopwatch_start) // 60
         logger().info(f"Parser thread {self.name} (TID {self.native_id}) Finished. " + \
@@ -106,22 +130,17 @@ class FlushNonLinksToDBThread(Thread):
         self.shared_data = shared_data
         self.allow_duplicates = allow_duplicates
 
-    def _insert_many(self, collection, bulk_insertion):
-        try:
-            collection.insert_many(bulk_insertion, ordered=False)
-        except Exception as e:
-            if not self.allow_duplicates:
-                logger().error(str(e))
-
     def run(self):
         logger().info(f"Flush thread {self.name} (TID {self.native_id}) started.")
         stopwatch_start = time.perf_counter()
+        mongo_writer = MongoWriter(self.db.mongo_db, self.allow_duplicates)
         bulk_insertion = []
         while self.shared_data.typedef_expressions:
             bulk_insertion.append(self.shared_data.typedef_expressions.pop().to_dict())
-        if bulk_insertion:
-            mongo_collection = self.db.mongo_db[MongoCollections.ATOM_TYPES]
-            self._insert_many(mongo_collection, bulk_insertion)
+            if len(bulk_insertion) >= mongo_writer.batch_size:
+                mongo_writer.write(MongoCollections.ATOM_TYPES, bulk_insertion)
+                bulk_insertion = []
+        mongo_writer.write(MongoCollections.ATOM_TYPES, bulk_insertion)
 
         named_entities = open(self.shared_data.temporary_file_name[KeyPrefix.NAMED_ENTITIES], "w")
         bulk_insertion = []
@@ -129,11 +148,12 @@ class FlushNonLinksToDBThread(Thread):
             terminal = self.shared_data.terminals.pop()
             bulk_insertion.append(terminal.to_dict())
             write_key_value(named_entities, terminal.hash_code, terminal.terminal_name)
+            if len(bulk_insertion) >= mongo_writer.batch_size:
+                mongo_writer.write(MongoCollections.NODES, bulk_insertion)
+                bulk_insertion = []
         named_entities.close()
-        if bulk_insertion:
-            mongo_collection = self.db.mongo_db[MongoCollections.NODES]
-            self._insert_many(mongo_collection, bulk_insertion)
-        named_entities.close()
+        mongo_writer.write(MongoCollections.NODES, bulk_insertion)
+        mongo_writer.close()
         self.shared_data.build_ok()
         elapsed = (time.perf_counter() - stopwatch_start) // 60
         logger().info(f"Flush thread {self.name} (TID {self.native_id}) finished. {elapsed:.0f} minutes.")
@@ -159,10 +179,8 @@ class BuildConnectivityThread(Thread):
                 write_key_value(incoming, element, expression.hash_code)
         outgoing.close()
         incoming.close()
-        os.system(f"sort -t , -k 1,1 {outgoing_file_name} > {outgoing_file_name}.sorted")
-        os.rename(f"{outgoing_file_name}.sorted", outgoing_file_name)
-        os.system(f"sort -t , -k 1,1 {incoming_file_name} > {incoming_file_name}.sorted")
-        os.rename(f"{incoming_file_name}.sorted", incoming_file_name)
+        sort_file(outgoing_file_name)
+        sort_file(incoming_file_name)
         self.shared_data.build_ok()
         elapsed = (time.perf_counter() - stopwatch_start) // 60
         logger().info(f"Temporary file builder thread {self.name} (TID {self.native_id}) finished. " + \
@@ -182,44 +200,17 @@ class BuildPatternsThread(Thread):
         patterns = open(file_name, "w")
         for i in range(len(self.shared_data.regular_expressions_list)):
             expression = self.shared_data.regular_expressions_list[i]
+            keys = []
             if expression.named_type not in self.shared_data.pattern_black_list:
-                arity = len(expression.elements)
-                type_hash = expression.named_type_hash
-                keys = []
-                keys.append([WILDCARD, *expression.elements])
-                if arity == 1:
-                    keys.append([type_hash, WILDCARD])
-                    keys.append([WILDCARD, expression.elements[0]])
-                    keys.append([WILDCARD, WILDCARD])
-                elif arity == 2:
-                    keys.append([type_hash, expression.elements[0], WILDCARD])
-                    keys.append([type_hash, WILDCARD, expression.elements[1]])
-                    keys.append([type_hash, WILDCARD, WILDCARD])
-                    keys.append([WILDCARD, expression.elements[0], expression.elements[1]])
-                    keys.append([WILDCARD, expression.elements[0], WILDCARD])
-                    keys.append([WILDCARD, WILDCARD, expression.elements[1]])
-                    keys.append([WILDCARD, WILDCARD, WILDCARD])
-                elif arity == 3:
-                    keys.append([type_hash, expression.elements[0], expression.elements[1], WILDCARD])
-                    keys.append([type_hash, expression.elements[0], WILDCARD, expression.elements[2]])
-                    keys.append([type_hash, WILDCARD, expression.elements[1], expression.elements[2]])
-                    keys.append([type_hash, expression.elements[0], WILDCARD, WILDCARD])
-                    keys.append([type_hash, WILDCARD, expression.elements[1], WILDCARD])
-                    keys.append([type_hash, WILDCARD, WILDCARD, expression.elements[2]])
-                    keys.append([type_hash, WILDCARD, WILDCARD, WILDCARD])
-                    keys.append([WILDCARD, expression.elements[0], expression.elements[1], expression.elements[2]])
-                    keys.append([WILDCARD, expression.elements[0], expression.elements[1], WILDCARD])
-                    keys.append([WILDCARD, expression.elements[0], WILDCARD, expression.elements[2]])
-                    keys.append([WILDCARD, WILDCARD, expression.elements[1], expression.elements[2]])
-                    keys.append([WILDCARD, expression.elements[0], WILDCARD, WILDCARD])
-                    keys.append([WILDCARD, WILDCARD, expression.elements[1], WILDCARD])
-                    keys.append([WILDCARD, WILDCARD, WILDCARD, expression.elements[2]])
-                    keys.append([WILDCARD, WILDCARD, WILDCARD, WILDCARD])
+                keys = self.shared_data.pattern_index_policy.pattern_keys(
+                    expression.named_type,
+                    expression.named_type_hash,
+                    expression.elements,
+                    get_target_type_hashes(expression.composite_type))
             for key in keys:
                 write_key_value(patterns, key, [expression.hash_code, *expression.elements])
         patterns.close()
-        os.system(f"sort -t , -k 1,1 {file_name} > {file_name}.sorted")
-        os.rename(f"{file_name}.sorted", file_name)
+        sort_file(file_name)
         self.shared_data.build_ok()
         elapsed = (time.perf_counter() - stopwatch_start) // 60
         logger().info(f"Temporary file builder thread {self.name} (TID {self.native_id}) finished. {elapsed:.0f} minutes.")
@@ -246,8 +237,7 @@ class BuildTypeTemplatesThread(Thread):
                 expression.named_type_hash,
                 [expression.hash_code, *expression.elements])
         template.close()
-        os.system(f"sort -t , -k 1,1 {file_name} > {file_name}.sorted")
-        os.rename(f"{file_name}.sorted", file_name)
+        sort_file(file_name)
         self.shared_data.build_ok()
         elapsed = (time.perf_counter() - stopwatch_start) // 60
         logger().info(f"Temporary file builder thread {self.name} (TID {self.native_id}) finished. {elapsed:.0f} minutes.")
@@ -260,38 +250,33 @@ class PopulateMongoDBLinksThread(Thread):
         self.shared_data = shared_data
         self.allow_duplicates = allow_duplicates
 
-    def _insert_many(self, collection, bulk_insertion):
-        try:
-            collection.insert_many(bulk_insertion, ordered=False)
-        except Exception as e:
-            if not self.allow_duplicates:
-                logger().error(str(e))
-
     def run(self):
         logger().info(f"MongoDB links uploader thread {self.name} (TID {self.native_id}) started.")
-        duplicates = 0
         stopwatch_start = time.perf_counter()
-        bulk_insertion_1 = []
-        bulk_insertion_2 = []
-        bulk_insertion_N = []
+        mongo_writer = MongoWriter(self.db.mongo_db, self.allow_duplicates)
+        # Documents are built and queued one batch at a time
+        bulk_insertion = {
+            MongoCollections.LINKS_ARITY_1: [],
+            MongoCollections.LINKS_ARITY_2: [],
+            MongoCollections.LINKS_ARITY_N: [],
+        }
         for i in range(len(self.shared_data.regular_expressions_list)):
             expression = self.shared_data.regular_expressions_list[i]
             arity = len(expression.elements)
             if arity == 1:
-                bulk_insertion_1.append(expression.to_dict())
+                collection_name = MongoCollections.LINKS_ARITY_1
             elif arity == 2:
-                bulk_insertion_2.append(expression.to_dict())
+                collection_name = MongoCollections.LINKS_ARITY_2
             else:
-                bulk_insertion_N.append(expression.to_dict())
-        if bulk_insertion_1:
-            mongo_collection = self.db.mongo_db[MongoCollections.LINKS_ARITY_1]
-            self._insert_many(mongo_collection, bulk_insertion_1)
-        if bulk_insertion_2:
-            mongo_collection = self.db.mongo_db[MongoCollections.LINKS_ARITY_2]
-            self._insert_many(mongo_collection, bulk_insertion_2)
-        if bulk_insertion_N:
-            mongo_collection = self.db.mongo_db[MongoCollections.LINKS_ARITY_N]
-            self._insert_many(mongo_collection, bulk_insertion_N)
+                collection_name = MongoCollections.LINKS_ARITY_N
+            bulk_insertion[collection_name].append(expression.to_dict())
+            if len(bulk_insertion[collection_name]) >= mongo_writer.batch_size:
+                mongo_writer.write(collection_name, bulk_insertion[collection_name])
+                bulk_insertion[collection_name] = []
+        for collection_name, documents in bulk_insertion.items():
+            mongo_writer.write(collection_name, documents)
+        statistics = mongo_writer.close()
+        duplicates = sum(collection_statistics['duplicates'] for collection_statistics in statistics.values())
         self.shared_data.mongo_uploader_ok = True
         elapsed = (time.perf_counter() - stopwatch_start) // 60
         logger().info(f"MongoDB links uploader thread {self.name} (TID {self.native_id}) finished. " + \
@@ -306,7 +291,9 @@ class PopulateRedisCollectionThread(Thread):
         collection_name: str,
         use_targets: bool,
         merge_rest: bool,
-        update: bool):
+        update: bool,
+        bulk_load: bool = True,
+        manifest: Optional[LoadManifest] = None):
 
         super().__init__()
         self.db = db
@@ -315,6 +302,10 @@ class PopulateRedisCollectionThread(Thread):
         self.use_targets = use_targets
         self.merge_rest = merge_rest
         self.update = update
+        # Use pipelined commands (see RedisBulkLoader)
+        self.bulk_load = bulk_load
+        # Progress of the load (see LoadManifest)
+        self.manifest = manifest
 
     def run(self):
         file_name = self.shared_data.temporary_file_name[self.collection_name]
@@ -322,13 +313,23 @@ class PopulateRedisCollectionThread(Thread):
             f"Uploading {self.collection_name}")
         stopwatch_start = time.perf_counter()
         generator = key_value_targets_generator if self.use_targets else key_value_generator
-        for key, value, block_count in generator(file_name, merge_rest=self.merge_rest):
+        bulk_loader = RedisBulkLoader(self.db.redis) if self.bulk_load else None
+        key_values = generator(file_name, merge_rest=self.merge_rest)
+        if self.manifest is not None:
+            key_values = self.manifest.track(
+                f"redis:{self.collection_name}",
+                key_values,
+                bulk_loader.flush if bulk_loader is not None else lambda: None)
+        for key, value, block_count in key_values:
             assert block_count == 0
             #print(f"file_name = {file_name} type(value) = {type(value)} type(value[0]) = {type(value[0])} value = {value}")
-            if self.use_targets:
-                self.db.redis.sadd(build_redis_key(self.collection_name, key), *[pickle.dumps(v) for v in value])
+            members = [pickle.dumps(v) for v in value] if self.use_targets else value
+            if bulk_loader is not None:
+                bulk_loader.sadd(build_redis_key(self.collection_name, key), members)
             else:
-                self.db.redis.sadd(build_redis_key(self.collection_name, key), *value)
+                self.db.redis.sadd(build_redis_key(self.collection_name, key), *members)
+        if bulk_loader is not None:
+            bulk_loader.close()
         elapsed = (time.perf_counter() - stopwatch_start) // 60
         self.shared_data.process_ok()
         logger().info(f"Redis collection uploader thread {self.name} (TID {self.native_id}) finished. " + \
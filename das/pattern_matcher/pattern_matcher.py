@@ -1,11 +1,15 @@
+import random
 import time
 from abc import ABC, abstractmethod
 from copy import deepcopy
 from enum import Enum, auto
-from functools import cmp_to_key
-from typing import Dict, FrozenSet, List, Optional, Set, Union
+from functools import cmp_to_key, wraps
+from itertools import permutations
+from typing import Any, Dict, FrozenSet, List, Optional, Set, Tuple, Union
 
 from das.database.db_interface import DBInterface, WILDCARD
+from das.exceptions import QueryBudgetExceeded
+from das.pattern_matcher.query_profiler import QueryProfiler
 
 DEBUG_AND = False
 DEBUG_OR = False
@@ -16,6 +20,8 @@ DEBUG_LINK_TEMPLATE = False
 CONFIG = {
     # Enforce different values for different variables in ordered assignments
     'no_overload': False, # Enforce different values for different variables in ordered assignments
+    # Reuse the answer of structurally identical Link/LinkTemplate terms within the same query
+    'memoize_subterms': True,
 }
 
 class CompatibilityStatus(int, Enum):
@@ -367,14 +373,159 @@ class CompositeAssignment(Assignment):
     def contains_unordered(self, unordered_assignment) -> bool:
         return all(assignment.contains_unordered(unordered_assignment) for assignment in self.unordered_mappings)
 
+def _anti_join(assignments: List[Assignment], forbidden_assignments: Set[Assignment]) -> List[Assignment]:
+    """
+    Assignments not excluded by any of the forbidden assignments (see
+    Assignment.check_negation()).
+
+    An OrderedAssignment excludes an ordered candidate iff its variables are a
+    subset of the candidate's and they are assigned to the same values. So
+    ordered forbidden assignments are grouped by variable set and indexed by
+    their values, and each ordered candidate is checked with one lookup per
+    group rather than one comparison per forbidden assignment.
+    """
+    ordered_index: Dict[Tuple[str, ...], Set[Tuple[str, ...]]] = {}
+    other_forbidden_assignments = []
+    for forbidden in forbidden_assignments:
+        if isinstance(forbidden, OrderedAssignment):
+            variables = tuple(sorted(forbidden.variables))
+            ordered_index.setdefault(variables, set()).add(tuple(forbidden.mapping[v] for v in variables))
+        else:
+            other_forbidden_assignments.append(forbidden)
+    if not other_forbidden_assignments and len(ordered_index) == 1:
+        variables = frozenset(next(iter(ordered_index)))
+        if all(isinstance(a, OrderedAssignment) and a.variables == variables for a in assignments):
+            # Same variables everywhere so exclusion is just equality
+            return [assignment for assignment in assignments if assignment not in forbidden_assignments]
+    answer = []
+    for assignment in assignments:
+        if isinstance(assignment, OrderedAssignment):
+            if any(all(v in assignment.variables for v in variables) and \
+                   tuple(assignment.mapping[v] for v in variables) in values
+                   for variables, values in ordered_index.items()):
+                continue
+            if all(assignment.check_negation(tabu) for tabu in other_forbidden_assignments):
+                answer.append(assignment)
+        elif all(assignment.check_negation(tabu) for tabu in forbidden_assignments):
+            answer.append(assignment)
+    return answer
+
+class QueryBudget:
+    """
+    Limits for the resources used by a query: wall time (in seconds), number
+    of members fetched from the indexes and size of intermediate assignment
+    sets. None means unlimited.
+
+    Limits are checked cooperatively by the operators while they are
+    evaluated so a query can be interrupted (QueryBudgetExceeded is raised)
+    in the middle of a join. cancel() can be called from another thread to
+    interrupt the query at the next check.
+    """
+
+    def __init__(
+        self,
+        max_time: Optional[float] = None,
+        max_fetched_members: Optional[int] = None,
+        max_assignments: Optional[int] = None):
+
+        self.max_time = max_time
+        self.max_fetched_members = max_fetched_members
+        self.max_assignments = max_assignments
+        self.start_time = time.perf_counter()
+        self.fetched_members = 0
+        self.max_intermediate_assignments = 0
+        self.cancelled = False
+
+    def cancel(self) -> None:
+        self.cancelled = True
+
+    def statistics(self) -> Dict[str, Any]:
+        return {
+            'elapsed_time': time.perf_counter() - self.start_time,
+            'fetched_members': self.fetched_members,
+            'max_intermediate_assignments': self.max_intermediate_assignments,
+        }
+
+    def add_fetched_members(self, count: int) -> None:
+        self.fetched_members += count
+        if self.max_fetched_members is not None and self.fetched_members > self.max_fetched_members:
+            raise QueryBudgetExceeded('fetched members', self.max_fetched_members, self.statistics())
+        self.check()
+
+    def check(self, assignments: int = 0) -> None:
+        if assignments > self.max_intermediate_assignments:
+            self.max_intermediate_assignments = assignments
+            if self.max_assignments is not None and assignments > self.max_assignments:
+                raise QueryBudgetExceeded('intermediate assignments', self.max_assignments, self.statistics())
+        if self.cancelled:
+            raise QueryBudgetExceeded('cancelled', None, self.statistics())
+        if self.max_time is not None and time.perf_counter() - self.start_time > self.max_time:
+            raise QueryBudgetExceeded('wall time', self.max_time, self.statistics())
+
+class QueryContext:
+    """
+    State shared by all the terms evaluated on behalf of the same query.
+
+    A fresh context is created for every top-level PatternMatchingAnswer and
+    it's passed down to the answers of the subterms, so anything stored here
+    lives exactly as long as the query evaluation.
+    """
+
+    def __init__(
+        self,
+        prefetched_patterns: Optional[Dict[str, Any]] = None,
+        prefetched_templates: Optional[Dict[str, Any]] = None,
+        budget: Optional[QueryBudget] = None):
+
+        # Answers of input-independent terms (Link with wildcards and
+        # LinkTemplate) keyed by the structural key of the term
+        self.cache: Dict[Tuple, Set[Assignment]] = {}
+        # Matched links fetched in advance (see match_many()) keyed by
+        # pattern/template hash
+        self.prefetched_patterns = prefetched_patterns if prefetched_patterns is not None else {}
+        self.prefetched_templates = prefetched_templates if prefetched_templates is not None else {}
+        # Set only when the query is being profiled (see profile())
+        self.profiler: Optional[QueryProfiler] = None
+        self.budget = budget
+
+    def set_strategy(self, strategy: str) -> None:
+        if self.profiler is not None:
+            self.profiler.set_strategy(strategy)
+
+    def get_cached_assignments(self, key: Tuple) -> Optional[Set[Assignment]]:
+        if not CONFIG['memoize_subterms']:
+            return None
+        cached = self.cache.get(key, None)
+        # Callers are allowed to change the returned set (e.g. Or.matched()
+        # extends the answer of its first term) so the cached set is never
+        # handed out directly
+        return set(cached) if cached is not None else None
+
+    def cache_assignments(self, key: Tuple, assignments: Set[Assignment]) -> None:
+        if CONFIG['memoize_subterms']:
+            self.cache[key] = set(assignments)
+
+    def get_matched_pattern(self, db: DBInterface, pattern_hash: str):
+        matched = self.prefetched_patterns.get(pattern_hash, None)
+        return matched if matched is not None else db.get_matched_pattern(pattern_hash)
+
+    def get_matched_template(self, db: DBInterface, template_hash: str):
+        matched = self.prefetched_templates.get(template_hash, None)
+        return matched if matched is not None else db.get_matched_template(template_hash)
+
 class PatternMatchingAnswer:
     """
     TODO: documentation
     """
 
-    def __init__(self):
+    def __init__(self, context: Optional[QueryContext] = None):
         self.assignments: Set[Assignment] = set()
         self.negation: bool = False
+        self.context: QueryContext = context if context is not None else QueryContext()
+        # Variables the caller is interested in (None means all of them). If
+        # set, distinct assignments restricted to (a superset of) these
+        # variables may be returned instead of the full ones.
+        self.projection: Optional[Set[str]] = None
 
     def __repr__(self):
         s = 'NOT\n' if self.negation else ''
@@ -383,6 +534,18 @@ class PatternMatchingAnswer:
             s += '\n'
         return s
 
+def _profiled(matched):
+    """
+    Decorator for LogicalExpression.matched() which records the evaluation of
+    the expression when the query is being profiled.
+    """
+    @wraps(matched)
+    def wrapper(self, db: DBInterface, answer: PatternMatchingAnswer) -> bool:
+        if answer.context.profiler is None:
+            return matched(self, db, answer)
+        return answer.context.profiler.run(matched, self, answer)
+    return wrapper
+
 class LogicalExpression(ABC):
     """
     TODO: documentation
@@ -392,6 +555,16 @@ class LogicalExpression(ABC):
     def matched(self, db: DBInterface, answer: PatternMatchingAnswer) -> bool:
         pass
 
+    def structural_key(self) -> Tuple:
+        """
+        Hashable representation of the expression. Two expressions with the
+        same structural key (same operators, types, node names and variable
+        names) always produce the same answer. By default the key is unique
+        to the instance so expressions which don't override this are never
+        shared through the memo cache.
+        """
+        return (type(self).__name__, id(self))
+
     def __repr__(self):
         return '<LogicalExpression>'
 
@@ -403,6 +576,8 @@ class Atom(LogicalExpression, ABC):
     def __init__(self, atom_type: str):
         self.atom_type = atom_type
         self.handle = None
+        # True if the handle depends on a Parameter (so it can't be cached)
+        self.parametric = False
 
     def __repr__(self):
         return f'{self.atom_type}'
@@ -428,16 +603,43 @@ class Node(Atom):
             self.handle = db.get_node_handle(self.atom_type, self.name)
         return self.handle
 
+    def structural_key(self) -> Tuple:
+        return ('Node', self.atom_type, self.name)
+
+    @_profiled
     def matched(self, db: DBInterface, answer: PatternMatchingAnswer) -> bool:
+        answer.context.set_strategy('existence check')
         return db.node_exists(self.atom_type, self.name)
 
+class Parameter(Node):
+    """
+    Placeholder for a Node whose name is only known when a PreparedQuery is
+    executed.
+    """
+
+    def __init__(self, parameter_name: str, node_type: str):
+        super().__init__(node_type, None)
+        self.parameter_name = parameter_name
+        self.parametric = True
+
+    def __repr__(self):
+        return f'<{self.atom_type}: ${self.parameter_name}={self.name}>'
+
+    def bind(self, db: DBInterface, node_name: str) -> None:
+        self.name = node_name
+        self.handle = db.get_node_handle(self.atom_type, node_name)
+
+    def get_handle(self, db: DBInterface) -> str:
+        if self.name is None:
+            raise ValueError(f'Unbound query parameter: {self.parameter_name}')
+        return super().get_handle(db)
+
 class Link(Atom):
     """
     TODO: documentation
     """
 
     def __init__(self, link_type: str, targets: List[Atom], ordered: bool):
-        assert not any(isinstance(target, TypedVariable) for target in targets)
         super().__init__(link_type)
         def comparator(t1, t2):
             if isinstance(t1, Variable):
@@ -451,17 +653,50 @@ class Link(Atom):
             self.targets = targets
         else:
             self.targets = sorted(targets, key=cmp_to_key(comparator))
+        self.parametric = any(getattr(target, 'parametric', False) for target in targets)
+        # Type of each TypedVariable target (None in the other positions) or
+        # None if there are no TypedVariable targets
+        if any(isinstance(target, TypedVariable) for target in self.targets):
+            self.target_types = [
+                target.type if isinstance(target, TypedVariable) else None for target in self.targets]
+        else:
+            self.target_types = None
+        # Index key precomputed by PreparedQuery
+        self.pattern_hash = None
 
     def __repr__(self):
         return f'<{super().__repr__()}: {self.targets}>'
 
+    def structural_key(self) -> Tuple:
+        return ('Link', self.atom_type, self.ordered, tuple(target.structural_key() for target in self.targets))
+
     def get_handle(self, db: DBInterface) -> str:
-        if not self.handle:
+        if self.handle:
+            return self.handle
+        target_handles = [target if type(target) is str else target.get_handle(db) for target in self.targets]
+        if any(handle is None for handle in target_handles):
+            return None
+        handle = db.get_link_handle(self.atom_type, target_handles)
+        if not self.parametric:
+            self.handle = handle
+        return handle
+
+    def get_pattern_hash(self, db: DBInterface, target_handles: Optional[List[str]] = None) -> Optional[str]:
+        """
+        Index key of the links matching this pattern or None if the pattern
+        has no wildcards or the DB doesn't support lookups by key.
+        """
+        if self.pattern_hash is not None:
+            return self.pattern_hash
+        if any(isinstance(target, LinkTemplate) for target in self.targets):
+            return None
+        if target_handles is None:
             target_handles = [target if type(target) is str else target.get_handle(db) for target in self.targets]
-            if any(handle is None for handle in target_handles):
-                return None
-            self.handle = db.get_link_handle(self.atom_type, target_handles)
-        return self.handle
+        if WILDCARD not in target_handles or any(handle is None for handle in target_handles):
+            return None
+        if self.target_types is not None:
+            return db.get_typed_link_pattern_hash(self.atom_type, target_handles, self.target_types)
+        return db.get_link_pattern_hash(self.atom_type, target_handles)
 
     def _assign_variables(self, db: DBInterface, link: str, link_targets: List[str]) -> Optional[Assignment]:
         #link_targets = db.get_link_targets(link)
@@ -476,6 +711,8 @@ class Link(Atom):
             return answer if answer.freeze() else None
         else:
             answer = UnorderedAssignment()
+            # link_targets may be shared by other terms (see QueryContext)
+            link_targets = list(link_targets)
             targets_to_match = []
             for atom in self.targets:
                 if isinstance(atom, Variable):
@@ -502,7 +739,7 @@ class Link(Atom):
     def _apply_assignment(self, assignment: OrderedAssignment, db: DBInterface) -> str:
         targets = []
         for t in self.targets:
-            if type(t) is Node:
+            if isinstance(t, Node):
                 targets.append(t.get_handle(db))
             elif type(t) is Link:
                 targets.append(t._apply_assignment(assignment, db))
@@ -514,7 +751,7 @@ class Link(Atom):
     def apply_assignment(self, assignment: OrderedAssignment, db: DBInterface) -> str:
         targets = []
         for t in self.targets:
-            if type(t) is Node:
+            if isinstance(t, Node):
                 targets.append(t.get_handle(db))
             elif type(t) is Link:
                 targets.append(t._apply_assignment(assignment, db))
@@ -522,9 +759,11 @@ class Link(Atom):
                 targets.append(assignment.mapping[t.name])
         return Link(self.atom_type, targets, self.ordered)
 
+    @_profiled
     def matched(self, db: DBInterface, answer: PatternMatchingAnswer) -> bool:
         if DEBUG_LINK: print('link match', self)
         if any(isinstance(atom, LinkTemplate) for atom in self.targets):
+            answer.context.set_strategy('typed targets')
             return self._typed_variable_matched(db, answer)
         if DEBUG_LINK: print('matched()', f'entering self = {self}')
         if not all(atom.matched(db, answer) for atom in self.targets):
@@ -536,10 +775,27 @@ class Link(Atom):
         target_handles = [atom.get_handle(db) for atom in self.targets]
         if DEBUG_LINK: print(f'target_handles = {target_handles}')
         if any(handle == WILDCARD for handle in target_handles):
+            key = self.structural_key()
+            cached = answer.context.get_cached_assignments(key)
+            if cached is not None:
+                answer.context.set_strategy('cached')
+                if DEBUG_LINK: print('matched()', f'leaving 1 (cached) self = {self}')
+                answer.assignments = cached
+                return bool(answer.assignments)
             if DEBUG_LINK: print(f'self.atom_type = {self.atom_type} target_handles = {target_handles}')
-            matched = db.get_matched_links(self.atom_type, target_handles)
+            answer.context.set_strategy('pattern index lookup')
+            pattern_hash = self.get_pattern_hash(db, target_handles)
+            if pattern_hash is not None:
+                matched = answer.context.get_matched_pattern(db, pattern_hash)
+            elif self.target_types is not None:
+                matched = db.get_matched_typed_links(self.atom_type, target_handles, self.target_types)
+            else:
+                matched = db.get_matched_links(self.atom_type, target_handles)
             if DEBUG_LINK: print(f'matched = {matched}')
             if DEBUG_LINK: print(f'len(matched) = {len(matched)}')
+            budget = answer.context.budget
+            if budget is not None:
+                budget.add_fetched_members(len(matched))
             count = 1
             total = len(matched)
             start = time.perf_counter()
@@ -552,22 +808,31 @@ class Link(Atom):
                 asn = self._assign_variables(db, link, targets)
                 if asn:
                     answer.assignments.add(asn)
+                    if budget is not None:
+                        budget.check(len(answer.assignments))
+            answer.context.cache_assignments(key, answer.assignments)
             if DEBUG_LINK: print(f'len(answer.assignments) = {len(answer.assignments)}')
             if DEBUG_LINK: print(f'answer.assignments = {answer.assignments}')
             if DEBUG_LINK: print('matched()', f'leaving 1 self = {self}')
             return bool(answer.assignments)
         else:
             if DEBUG_LINK: print('matched()', f'leaving 2 self = {self}')
+            answer.context.set_strategy('existence check')
             if db.link_exists(self.atom_type, target_handles):
                 return True
             else:
-                new_assignments = set()
-                for assignment in answer.assignments:
+                answer.context.set_strategy('existence filter')
+                budget = answer.context.budget
+                assignments = list(answer.assignments)
+                links = []
+                for assignment in assignments:
+                    if budget is not None:
+                        budget.check()
                     assert type(assignment) is OrderedAssignment
                     link = self.apply_assignment(assignment, db)
-                    if db.link_exists(link.atom_type, link.targets):
-                        new_assignments.add(assignment)
-                answer.assignments = new_assignments
+                    links.append((link.atom_type, link.targets))
+                answer.assignments = set(
+                    assignment for assignment, exists in zip(assignments, db.links_exist(links)) if exists)
                 return bool(answer.assignments)
 
 class Variable(Atom):
@@ -582,6 +847,9 @@ class Variable(Atom):
     def __repr__(self):
         return f'{self.name}'
 
+    def structural_key(self) -> Tuple:
+        return ('Variable', self.name)
+
     def get_handle(self, db: DBInterface) -> str:
         return WILDCARD
 
@@ -600,12 +868,34 @@ class TypedVariable(Variable):
     def __repr__(self):
         return f'{self.name}: {self.type}'
 
+    def structural_key(self) -> Tuple:
+        return ('TypedVariable', self.name, self.type)
+
     def get_handle(self, db: DBInterface) -> str:
         return WILDCARD
 
     def matched(self, db: DBInterface, answer: PatternMatchingAnswer) -> bool:
         return True
 
+class _BoundVariable(Variable):
+    """
+    Variable whose value is already known. Used to evaluate terms for a given
+    partial assignment (see sample()).
+    """
+
+    def __init__(self, variable_name: str, value: str):
+        super().__init__(variable_name)
+        self.value = value
+
+    def __repr__(self):
+        return f'{self.name}={self.value}'
+
+    def structural_key(self) -> Tuple:
+        return ('BoundVariable', self.name, self.value)
+
+    def get_handle(self, db: DBInterface) -> str:
+        return self.value
+
 class LinkTemplate(LogicalExpression):
     """
     TODO: documentation
@@ -617,10 +907,24 @@ class LinkTemplate(LogicalExpression):
         self.targets = targets
         self.ordered = ordered
         self.handle = None
+        # Index key precomputed by PreparedQuery
+        self.template_hash = None
 
     def __repr__(self):
         return f'<{self.link_type}: {self.targets}>'
 
+    def structural_key(self) -> Tuple:
+        return ('LinkTemplate', self.link_type, self.ordered, tuple(target.structural_key() for target in self.targets))
+
+    def get_template_hash(self, db: DBInterface) -> Optional[str]:
+        """
+        Index key of the links matching this template or None if the DB
+        doesn't support lookups by key.
+        """
+        if self.template_hash is not None:
+            return self.template_hash
+        return db.get_type_template_hash([self.link_type, *[v.type for v in self.targets]])
+
     def _assign_variables(self, db: DBInterface, link: str, link_targets: List[str]) -> Optional[Assignment]:
         assert(len(link_targets) == len(self.targets)), f'link_targets = {link_targets} self.targets = {self.targets}'
         answer = None
@@ -633,10 +937,25 @@ class LinkTemplate(LogicalExpression):
                 return None
         return answer if answer.freeze() else None
 
+    @_profiled
     def matched(self, db: DBInterface, answer: PatternMatchingAnswer) -> bool:
         if DEBUG_LINK_TEMPLATE: print('link template match', self)
-        matched = db.get_matched_type_template([self.link_type, *[v.type for v in self.targets]])
+        key = self.structural_key()
+        cached = answer.context.get_cached_assignments(key)
+        if cached is not None:
+            answer.context.set_strategy('cached')
+            answer.assignments = cached
+            return bool(answer.assignments)
+        answer.context.set_strategy('template index lookup')
+        template_hash = self.get_template_hash(db)
+        if template_hash is not None:
+            matched = answer.context.get_matched_template(db, template_hash)
+        else:
+            matched = db.get_matched_type_template([self.link_type, *[v.type for v in self.targets]])
         if DEBUG_LINK_TEMPLATE: print('len(matched)', len(matched))
+        budget = answer.context.budget
+        if budget is not None:
+            budget.add_fetched_members(len(matched))
         answer.assignments = set()
         for match in matched:
             link, targets = match
@@ -644,6 +963,180 @@ class LinkTemplate(LogicalExpression):
             if asn:
                 if DEBUG_LINK_TEMPLATE: print('asn', asn)
                 answer.assignments.add(asn)
+                if budget is not None:
+                    budget.check(len(answer.assignments))
+        answer.context.cache_assignments(key, answer.assignments)
+        return bool(answer.assignments)
+
+class Closure(LogicalExpression):
+    """
+    Transitive closure of a binary link type: matches the (source, target)
+    pairs connected by a chain of 1 to max_depth links of the given type
+    (e.g. all the ancestors of a Concept in an Inheritance hierarchy). If
+    reflexive is True, chains of length 0 (source == target) match as well.
+
+    Source and target are Nodes or Variables. The closure is computed by a
+    breadth first search starting from the bound endpoint (forwards from the
+    source or backwards from the target) where the links of each level are
+    fetched in a single batch. If neither endpoint is bound, all the links of
+    the type are fetched and the search runs from every source in memory.
+    """
+
+    def __init__(
+        self,
+        link_type: str,
+        source: Atom,
+        target: Atom,
+        max_depth: Optional[int] = None,
+        reflexive: bool = False):
+        assert all(isinstance(endpoint, (Node, Variable)) for endpoint in [source, target])
+        assert max_depth is None or max_depth >= 1
+        self.link_type = link_type
+        self.source = source
+        self.target = target
+        self.max_depth = max_depth
+        self.reflexive = reflexive
+
+    def __repr__(self):
+        depth = '' if self.max_depth is None else f' (max_depth={self.max_depth})'
+        closure = '*' if self.reflexive else '+'
+        return f'<{self.link_type}{closure}: {[self.source, self.target]}{depth}>'
+
+    def structural_key(self) -> Tuple:
+        return (
+            'Closure',
+            self.link_type,
+            self.source.structural_key(),
+            self.target.structural_key(),
+            self.max_depth,
+            self.reflexive)
+
+    @staticmethod
+    def _neighbor(handle: str, targets: List[str]) -> str:
+        # Works for unordered link types as well, whose targets may be stored
+        # in any order
+        return targets[1] if targets[0] == handle else targets[0]
+
+    def _search(
+        self,
+        db: DBInterface,
+        start: str,
+        forward: bool,
+        stop: Optional[str],
+        answer: PatternMatchingAnswer) -> Set[str]:
+        """
+        Atoms reachable from start by chains of links. Each level of the
+        search is fetched with a single get_matched_links_many() call. The
+        search ends as soon as stop is reached.
+        """
+        budget = answer.context.budget
+        reached = set()
+        frontier = [start]
+        depth = 0
+        while frontier and (self.max_depth is None or depth < self.max_depth):
+            if forward:
+                patterns = [[handle, WILDCARD] for handle in frontier]
+            else:
+                patterns = [[WILDCARD, handle] for handle in frontier]
+            level = db.get_matched_links_many(self.link_type, patterns)
+            next_frontier = []
+            for handle, matched in zip(frontier, level):
+                if budget is not None:
+                    budget.add_fetched_members(len(matched))
+                for _, targets in matched:
+                    if len(targets) != 2:
+                        continue
+                    neighbor = self._neighbor(handle, targets)
+                    if neighbor not in reached:
+                        reached.add(neighbor)
+                        next_frontier.append(neighbor)
+            if stop is not None and stop in reached:
+                break
+            if budget is not None:
+                budget.check(len(reached))
+            frontier = next_frontier
+            depth += 1
+        if self.reflexive:
+            reached.add(start)
+        return reached
+
+    def _search_all(self, db: DBInterface, answer: PatternMatchingAnswer) -> Dict[str, Set[str]]:
+        """
+        Closure of every source, computed in memory from all the links of the
+        type.
+        """
+        matched = db.get_matched_links(self.link_type, [WILDCARD, WILDCARD])
+        budget = answer.context.budget
+        if budget is not None:
+            budget.add_fetched_members(len(matched))
+        # All the links of a type are either ordered or unordered
+        ordered = db.is_ordered(matched[0][0]) if matched else True
+        successors: Dict[str, Set[str]] = {}
+        for _, targets in matched:
+            if len(targets) != 2:
+                continue
+            successors.setdefault(targets[0], set()).add(targets[1])
+            if not ordered:
+                successors.setdefault(targets[1], set()).add(targets[0])
+        closures = {}
+        total = 0
+        for source in successors:
+            reached = set()
+            frontier = [source]
+            depth = 0
+            while frontier and (self.max_depth is None or depth < self.max_depth):
+                next_frontier = []
+                for handle in frontier:
+                    for neighbor in successors.get(handle, []):
+                        if neighbor not in reached:
+                            reached.add(neighbor)
+                            next_frontier.append(neighbor)
+                frontier = next_frontier
+                depth += 1
+            if self.reflexive:
+                reached.add(source)
+            closures[source] = reached
+            total += len(reached)
+            if budget is not None:
+                budget.check(total)
+        if self.reflexive:
+            for targets in list(successors.values()):
+                for handle in targets:
+                    closures.setdefault(handle, set([handle]))
+        return closures
+
+    @_profiled
+    def matched(self, db: DBInterface, answer: PatternMatchingAnswer) -> bool:
+        key = self.structural_key()
+        cached = answer.context.get_cached_assignments(key)
+        if cached is not None:
+            answer.context.set_strategy('cached')
+            answer.assignments = cached
+            return bool(answer.assignments)
+        answer.context.set_strategy('breadth first search')
+        source = self.source.get_handle(db)
+        target = self.target.get_handle(db)
+        if source is None or target is None:
+            return False
+        if source != WILDCARD and target != WILDCARD:
+            return target in self._search(db, source, True, target, answer)
+        if source != WILDCARD:
+            closures = {source: self._search(db, source, True, None, answer)}
+        elif target != WILDCARD:
+            closures = {s: set([target]) for s in self._search(db, target, False, None, answer)}
+        else:
+            closures = self._search_all(db, answer)
+        answer.assignments = set()
+        for source_handle, reached in closures.items():
+            for target_handle in reached:
+                assignment = OrderedAssignment()
+                if isinstance(self.source, Variable) and not assignment.assign(self.source.name, source_handle):
+                    continue
+                if isinstance(self.target, Variable) and not assignment.assign(self.target.name, target_handle):
+                    continue
+                if assignment.freeze():
+                    answer.assignments.add(assignment)
+        answer.context.cache_assignments(key, answer.assignments)
         return bool(answer.assignments)
 
 class Not(LogicalExpression):
@@ -657,8 +1150,13 @@ class Not(LogicalExpression):
     def __repr__(self):
         return f'NOT({self.term})'
 
+    def structural_key(self) -> Tuple:
+        return ('Not', self.term.structural_key())
+
+    @_profiled
     def matched(self, db: DBInterface, answer: PatternMatchingAnswer) -> bool:
         if DEBUG_NOT: print(f'NOT', self)
+        answer.context.set_strategy('negation')
         self.term.matched(db, answer)
         answer.negation = not answer.negation
         return True
@@ -674,16 +1172,21 @@ class Or(LogicalExpression):
     def __repr__(self):
         return f'OR({self.terms})'
 
+    def structural_key(self) -> Tuple:
+        return ('Or', tuple(term.structural_key() for term in self.terms))
+
+    @_profiled
     def matched(self, db: DBInterface, answer: PatternMatchingAnswer) -> bool:
         if DEBUG_OR: print(f'OR', self)
+        answer.context.set_strategy('union')
         if not self.terms:
             return False
         assert not answer.assignments
-        or_answer = PatternMatchingAnswer()
+        or_answer = PatternMatchingAnswer(answer.context)
         or_matched = False
         negative_terms = set()
         for term in self.terms:
-            term_answer = PatternMatchingAnswer()
+            term_answer = PatternMatchingAnswer(answer.context)
             if isinstance(term, Not):
                 if DEBUG_OR: print(f'negative term: {term}')
                 negative_terms.add(term)
@@ -703,11 +1206,14 @@ class Or(LogicalExpression):
             if DEBUG_OR: print(f'New term: {term}')
             if DEBUG_OR: print(f'term_answer:\n{term_answer}')
             or_answer.assignments.update(term_answer.assignments)
+            if answer.context.budget is not None:
+                answer.context.budget.check(len(or_answer.assignments))
             if DEBUG_OR: print(f'or_answer after extending:\n{or_answer}')
         if negative_terms:
+            answer.context.set_strategy('union + difference')
             joint_negative_term = And([t.term for t in negative_terms])
             if DEBUG_NOT: print(f'Joint negative term: {joint_negative_term}')
-            term_answer = PatternMatchingAnswer()
+            term_answer = PatternMatchingAnswer(answer.context)
             joint_negative_term.matched(db, term_answer)
             if DEBUG_NOT: print(f'term_answer.assignments = {term_answer.assignments}')
             if DEBUG_NOT: print(f'or_answer.assignments = {or_answer.assignments}')
@@ -719,6 +1225,41 @@ class Or(LogicalExpression):
         if DEBUG_OR: print(f'OR result = {answer}')
         return or_matched
 
+def _get_variables(expression: Any) -> Set[str]:
+    if isinstance(expression, Variable):
+        return set([expression.name])
+    elif isinstance(expression, (Link, LinkTemplate)):
+        return set().union(*[_get_variables(target) for target in expression.targets])
+    elif isinstance(expression, Closure):
+        return _get_variables(expression.source) | _get_variables(expression.target)
+    elif isinstance(expression, Not):
+        return _get_variables(expression.term)
+    elif isinstance(expression, (And, Or)):
+        return set().union(*[_get_variables(term) for term in expression.terms])
+    else:
+        return set()
+
+def _project_assignments(assignments: Set[Assignment], variables: Set[str]) -> Set[Assignment]:
+    """
+    Drop the variables not in the passed set from ordered assignments.
+    Assignments which become equal are merged.
+    """
+    answer = set()
+    for assignment in assignments:
+        if isinstance(assignment, OrderedAssignment) and not assignment.variables <= variables:
+            projected = OrderedAssignment()
+            for variable, value in assignment.mapping.items():
+                if variable in variables:
+                    projected.assign(variable, value)
+            projected.freeze()
+            answer.add(projected)
+        else:
+            answer.add(assignment)
+    return answer
+
+def _negations_last(terms: List[LogicalExpression]) -> List[LogicalExpression]:
+    return [t for t in terms if not isinstance(t, Not)] + [t for t in terms if isinstance(t, Not)]
+
 class And(LogicalExpression):
     """
     TODO: documentation
@@ -730,20 +1271,34 @@ class And(LogicalExpression):
     def __repr__(self):
         return f'AND({self.terms})'
 
+    def structural_key(self) -> Tuple:
+        return ('And', tuple(term.structural_key() for term in self.terms))
+
     def post_process(self, assignment) -> Assignment:
         if not isinstance(assignment, CompositeAssignment):
             return assignment
         return assignment
 
+    @_profiled
     def matched(self, db: DBInterface, answer: PatternMatchingAnswer) -> bool:
         if DEBUG_AND: print(f'AND', self)
+        answer.context.set_strategy('nested loop join')
         if not self.terms:
             return False
         assert not answer.assignments
-        and_answer = PatternMatchingAnswer()
+        and_answer = PatternMatchingAnswer(answer.context)
         forbidden_assignments = set()
-        for term in self.terms:
-            term_answer = PatternMatchingAnswer()
+        first_positive_term = True
+        # Negations don't restrict the evaluation of other terms so they're
+        # evaluated last (and not at all if positive terms fail)
+        terms = _negations_last(self.terms)
+        if answer.projection is not None:
+            # Variables still needed after the evaluation of each term
+            needed_variables = [set(answer.projection) for _ in terms]
+            for i in range(len(terms) - 2, -1, -1):
+                needed_variables[i] = needed_variables[i + 1] | _get_variables(terms[i + 1])
+        for i, term in enumerate(terms):
+            term_answer = PatternMatchingAnswer(answer.context)
             if not term.matched(db, term_answer):
                 if DEBUG_AND: print(f'NOT MATCHED: {term}')
                 return False
@@ -755,27 +1310,552 @@ class And(LogicalExpression):
                 #if DEBUG_AND: print(f'term_answer:\n{term_answer}')
                 forbidden_assignments.update(term_answer.assignments)
                 continue
-            if not and_answer.assignments:
+            if first_positive_term:
                 if DEBUG_AND: print(f'First term: {term}')
                 if DEBUG_AND: print(f'term_answer:\n{term_answer}')
                 and_answer.assignments = term_answer.assignments
-                continue
-            if DEBUG_AND: print(f'New term: {term}')
-            if DEBUG_AND: print(f'term_answer:\n{term_answer}')
-            joint_assignments = []
-            for and_assignment in and_answer.assignments:
-                for term_assignment in term_answer.assignments:
-                    joint_assignment = and_assignment.join(term_assignment)
-                    if joint_assignment is not None:
-                        joint_assignments.append(joint_assignment)
-            and_answer.assignments = joint_assignments
-            if DEBUG_AND: print(f'and_answer after join:\n{and_answer}')
-        if DEBUG_NOT: print(f'FORBIDDEN = {forbidden_assignments}')
-        for assignment in and_answer.assignments:
-            if DEBUG_NOT: print(f'CHECK: {assignment}')
-            if all(assignment.check_negation(tabu) for tabu in forbidden_assignments):
-                answer.assignments.add(self.post_process(assignment))
+                first_positive_term = False
             else:
-                if DEBUG_AND: print(f'Excluding {assignment}')
+                if DEBUG_AND: print(f'New term: {term}')
+                if DEBUG_AND: print(f'term_answer:\n{term_answer}')
+                budget = answer.context.budget
+                joint_assignments = []
+                for and_assignment in and_answer.assignments:
+                    for term_assignment in term_answer.assignments:
+                        joint_assignment = and_assignment.join(term_assignment)
+                        if joint_assignment is not None:
+                            joint_assignments.append(joint_assignment)
+                    if budget is not None:
+                        budget.check(len(joint_assignments))
+                and_answer.assignments = joint_assignments
+                if DEBUG_AND: print(f'and_answer after join:\n{and_answer}')
+                if not and_answer.assignments:
+                    # No assignment satisfies the terms joined so far so the result
+                    # doesn't depend on the order in which terms are evaluated
+                    return False
+            if answer.projection is not None:
+                and_answer.assignments = _project_assignments(and_answer.assignments, needed_variables[i])
+        if DEBUG_NOT: print(f'FORBIDDEN = {forbidden_assignments}')
+        if forbidden_assignments:
+            answer.context.set_strategy('nested loop join + anti-join')
+            assignments = _anti_join(list(and_answer.assignments), forbidden_assignments)
+        else:
+            assignments = and_answer.assignments
+        for assignment in assignments:
+            answer.assignments.add(self.post_process(assignment))
         if DEBUG_AND: print(f'AND result = {answer}')
         return bool(answer.assignments)
+
+def _estimated_cost(term: LogicalExpression) -> float:
+    """
+    Static estimation of how large the answer of a term is, used to decide the
+    order in which the terms of an And are evaluated. Only the relative order
+    of the returned values is meaningful.
+    """
+    if isinstance(term, Not):
+        # Negations don't reduce the number of candidates of the positive terms
+        return float('inf')
+    elif isinstance(term, Link):
+        if any(isinstance(target, LinkTemplate) for target in term.targets):
+            return sum(_estimated_cost(target) for target in term.targets if isinstance(target, LinkTemplate))
+        return sum(1 for target in term.targets if isinstance(target, Variable))
+    elif isinstance(term, LinkTemplate):
+        return len(term.targets) + 1
+    elif isinstance(term, Closure):
+        # A search from a bound endpoint is cheaper than the closure of all
+        # the links of the type
+        return sum(1 for endpoint in [term.source, term.target] if isinstance(endpoint, Variable)) + 1
+    elif isinstance(term, And):
+        return min(_estimated_cost(t) for t in term.terms) if term.terms else 0
+    elif isinstance(term, Or):
+        return max(_estimated_cost(t) for t in term.terms) if term.terms else 0
+    else:
+        return 0
+
+class PreparedQuery:
+    """
+    A query compiled once and executed many times with different values for
+    its Parameters.
+
+    Compilation resolves the handles of all the constant Nodes and Links,
+    precomputes the index keys of the Links and LinkTemplates that don't
+    depend on Parameters and fixes the order in which the terms of every And
+    are evaluated (most selective first, negations last). Executing the query
+    only binds the parameters and runs the compiled expression.
+
+    The compiled expression is a private copy of the passed query. Parameters
+    are bound in place so a PreparedQuery shouldn't be executed concurrently
+    by different threads.
+    """
+
+    def __init__(self, db: DBInterface, query: LogicalExpression):
+        self.db = db
+        self.query = deepcopy(query)
+        self.parameters: Dict[str, List[Parameter]] = {}
+        self._compile(self.query)
+
+    def __repr__(self):
+        return f'PREPARED({self.query})'
+
+    def _compile(self, expression: LogicalExpression) -> None:
+        if isinstance(expression, Parameter):
+            self.parameters.setdefault(expression.parameter_name, []).append(expression)
+        elif isinstance(expression, Node):
+            expression.get_handle(self.db)
+        elif isinstance(expression, Link):
+            for target in expression.targets:
+                if type(target) is not str:
+                    self._compile(target)
+            if expression.parametric or any(isinstance(target, LinkTemplate) for target in expression.targets):
+                return
+            expression.pattern_hash = expression.get_pattern_hash(self.db)
+            if expression.pattern_hash is None:
+                expression.get_handle(self.db)
+        elif isinstance(expression, LinkTemplate):
+            expression.template_hash = expression.get_template_hash(self.db)
+        elif isinstance(expression, Closure):
+            self._compile(expression.source)
+            self._compile(expression.target)
+        elif isinstance(expression, Not):
+            self._compile(expression.term)
+        elif isinstance(expression, (And, Or)):
+            for term in expression.terms:
+                self._compile(term)
+            if isinstance(expression, And):
+                # sorted() is stable so terms with the same cost keep the original order
+                expression.terms = sorted(expression.terms, key=_estimated_cost)
+
+    def execute(self, params: Dict[str, str], answer: PatternMatchingAnswer) -> bool:
+        missing = [name for name in self.parameters if name not in params]
+        if missing:
+            raise ValueError(f'Missing query parameters: {missing}')
+        for name, parameters in self.parameters.items():
+            for parameter in parameters:
+                parameter.bind(self.db, params[name])
+        return self.query.matched(self.db, answer)
+
+def _collect_index_keys(db: DBInterface, expression: Any, pattern_hashes: Set[str], template_hashes: Set[str]) -> None:
+    if isinstance(expression, Link):
+        if not expression.parametric:
+            pattern_hash = expression.get_pattern_hash(db)
+            if pattern_hash is not None:
+                pattern_hashes.add(pattern_hash)
+        for target in expression.targets:
+            _collect_index_keys(db, target, pattern_hashes, template_hashes)
+    elif isinstance(expression, LinkTemplate):
+        template_hash = expression.get_template_hash(db)
+        if template_hash is not None:
+            template_hashes.add(template_hash)
+    elif isinstance(expression, Not):
+        _collect_index_keys(db, expression.term, pattern_hashes, template_hashes)
+    elif isinstance(expression, (And, Or)):
+        for term in expression.terms:
+            _collect_index_keys(db, term, pattern_hashes, template_hashes)
+
+def match_many(db: DBInterface, queries: List[LogicalExpression]) -> List[Tuple[bool, PatternMatchingAnswer]]:
+    """
+    Evaluate a batch of queries. The index keys of all the Links with
+    wildcards and LinkTemplates in the batch are deduplicated and fetched
+    together (in a single round trip if the DB supports it) before the
+    queries are evaluated one by one.
+    """
+    pattern_hashes = set()
+    template_hashes = set()
+    for query in queries:
+        _collect_index_keys(db, query, pattern_hashes, template_hashes)
+    prefetched_patterns = db.get_matched_patterns(list(pattern_hashes)) if pattern_hashes else {}
+    prefetched_templates = db.get_matched_templates(list(template_hashes)) if template_hashes else {}
+    answers = []
+    for query in queries:
+        answer = PatternMatchingAnswer(QueryContext(prefetched_patterns, prefetched_templates))
+        matched = query.matched(db, answer)
+        answers.append((matched, answer))
+    return answers
+
+def profile(db: DBInterface, query: LogicalExpression, answer: PatternMatchingAnswer) -> Tuple[bool, QueryProfiler]:
+    """
+    Evaluate a query recording, for each operator, wall time, number of DB
+    calls, bytes fetched, number of input/output assignments and the strategy
+    used to compute its answer.
+    """
+    profiler = QueryProfiler(db)
+    answer.context.profiler = profiler
+    try:
+        matched = query.matched(db, answer)
+    finally:
+        answer.context.profiler = None
+    return matched, profiler
+
+def explain(db: DBInterface, expression: LogicalExpression) -> Dict[str, Any]:
+    """
+    Plan of a query (the order in which its terms are evaluated and the
+    strategy used to evaluate each of them) with estimated cardinalities. The
+    query isn't executed. Estimates for Links and LinkTemplates are the sizes
+    of the index entries they would fetch (no members are fetched). The
+    estimate for an And is the estimate of its most selective positive term
+    and the estimate for an Or is the sum of its positive terms.
+    """
+    answer = {'operator': type(expression).__name__}
+    if isinstance(expression, (Atom, LinkTemplate, Closure)):
+        answer['expression'] = repr(expression)
+    children = []
+    if isinstance(expression, Node):
+        strategy = 'existence check'
+        estimate = 1
+    elif isinstance(expression, Link):
+        if any(isinstance(target, LinkTemplate) for target in expression.targets):
+            strategy = 'typed targets'
+            children = [explain(db, target) for target in expression.targets if isinstance(target, LinkTemplate)]
+            estimate = min(child['estimated_cardinality'] for child in children)
+        else:
+            target_handles = [t if type(t) is str else t.get_handle(db) for t in expression.targets]
+            if any(handle is None for handle in target_handles):
+                strategy = 'existence check'
+                estimate = 0
+            elif WILDCARD in target_handles:
+                strategy = 'pattern index lookup'
+                estimate = db.count_matched_links(expression.atom_type, target_handles, expression.target_types)
+            else:
+                strategy = 'existence check'
+                estimate = 1
+    elif isinstance(expression, LinkTemplate):
+        strategy = 'template index lookup'
+        estimate = db.count_matched_type_template([expression.link_type, *[v.type for v in expression.targets]])
+    elif isinstance(expression, Closure):
+        # The size of a closure isn't known before the search
+        strategy = 'breadth first search'
+        estimate = None
+    elif isinstance(expression, Not):
+        strategy = 'negation'
+        children = [explain(db, expression.term)]
+        estimate = None
+    elif isinstance(expression, Or):
+        strategy = 'union'
+        children = [explain(db, term) for term in expression.terms]
+        if any(isinstance(term, Not) for term in expression.terms):
+            strategy = 'union + difference'
+        estimates = [child['estimated_cardinality'] for child in children if child['operator'] != 'Not']
+        estimate = None if any(e is None for e in estimates) else sum(estimates)
+    elif isinstance(expression, And):
+        strategy = 'nested loop join'
+        children = [explain(db, term) for term in _negations_last(expression.terms)]
+        if any(isinstance(term, Not) for term in expression.terms):
+            strategy = 'nested loop join + anti-join'
+        estimates = [child['estimated_cardinality'] for child in children if child['operator'] != 'Not']
+        estimates = [e for e in estimates if e is not None]
+        estimate = min(estimates) if estimates else None
+    else:
+        strategy = None
+        estimate = None
+    answer['strategy'] = strategy
+    answer['estimated_cardinality'] = estimate
+    answer['children'] = children
+    return answer
+
+def count(db: DBInterface, query: LogicalExpression, answer: PatternMatchingAnswer) -> int:
+    """
+    Number of assignments which satisfy the query. Links and LinkTemplates
+    whose targets are all distinct variables are counted from the size of
+    their index entries, without fetching them.
+    """
+    if isinstance(query, (Link, LinkTemplate)) and _counted_by_index(query):
+        if isinstance(query, Link):
+            target_handles = [target.get_handle(db) for target in query.targets]
+            return db.count_matched_links(query.atom_type, target_handles, query.target_types)
+        else:
+            return db.count_matched_type_template([query.link_type, *[v.type for v in query.targets]])
+    if not query.matched(db, answer):
+        return 0
+    if answer.negation:
+        raise ValueError(f'Negative queries can not be counted: {query}')
+    return len(answer.assignments)
+
+def _counted_by_index(term: Union['Link', 'LinkTemplate']) -> bool:
+    # One matched link per assignment is guaranteed only if every target is a
+    # different (and unconstrained) variable
+    if CONFIG['no_overload'] or not term.ordered:
+        return False
+    if not all(isinstance(target, Variable) for target in term.targets):
+        return False
+    return len(set(target.name for target in term.targets)) == len(term.targets)
+
+def project(
+    db: DBInterface,
+    query: LogicalExpression,
+    variables: List[str],
+    answer: PatternMatchingAnswer,
+    distinct: bool = True) -> List[Tuple[str, ...]]:
+    """
+    Values of the passed variables in the assignments which satisfy the
+    query. If distinct is True, projection is pushed down into the joins so
+    variables which aren't needed anymore are dropped (and duplicates are
+    merged) as early as possible.
+    """
+    missing = set(variables) - _get_variables(query)
+    if missing:
+        raise ValueError(f'Variables not in query: {sorted(missing)}')
+    if distinct:
+        answer.projection = set(variables)
+    if not query.matched(db, answer):
+        return []
+    if answer.negation:
+        raise ValueError(f'Negative queries can not be projected: {query}')
+    values = []
+    for assignment in answer.assignments:
+        if isinstance(assignment, CompositeAssignment):
+            assignment = assignment.ordered_mapping
+        if not isinstance(assignment, OrderedAssignment) or not all(v in assignment.variables for v in variables):
+            raise ValueError(f'Only variables of ordered links can be projected: {variables}')
+        values.append(tuple(assignment.mapping[v] for v in variables))
+    if distinct:
+        return sorted(set(values))
+    return values
+
+def _bind(expression: Any, mapping: Dict[str, str]) -> Any:
+    """
+    Copy of the expression where (untyped) variables in mapping are replaced
+    by their values. Typed variables are kept so their types are still
+    checked (consistency with mapping is enforced by the joins).
+    """
+    if type(expression) is Variable and expression.name in mapping:
+        return _BoundVariable(expression.name, mapping[expression.name])
+    elif isinstance(expression, Link):
+        return Link(expression.atom_type, [_bind(t, mapping) for t in expression.targets], expression.ordered)
+    elif isinstance(expression, Closure):
+        return Closure(
+            expression.link_type,
+            _bind(expression.source, mapping),
+            _bind(expression.target, mapping),
+            expression.max_depth,
+            expression.reflexive)
+    elif isinstance(expression, Not):
+        return Not(_bind(expression.term, mapping))
+    elif isinstance(expression, And):
+        return And([_bind(t, mapping) for t in expression.terms])
+    elif isinstance(expression, Or):
+        return Or([_bind(t, mapping) for t in expression.terms])
+    else:
+        return expression
+
+def _complete(
+    db: DBInterface,
+    assignment: Assignment,
+    terms: List[LogicalExpression],
+    context: QueryContext) -> List[Assignment]:
+    """
+    All the assignments which extend the passed one and satisfy all the
+    terms, i.e. the answer of And(terms) restricted to the assignment.
+    Variables of unordered assignments aren't bound to a single value so
+    they're only enforced by the joins.
+    """
+    mapping = assignment.mapping if isinstance(assignment, OrderedAssignment) else {}
+    completions = [assignment]
+    for term in _negations_last(terms):
+        bound = _bind(term, mapping)
+        term_answer = PatternMatchingAnswer(context)
+        if isinstance(bound, And):
+            completions = [c for completion in completions for c in _complete(db, completion, bound.terms, context)]
+        elif isinstance(bound, Not):
+            term_matched = bound.term.matched(db, term_answer)
+            if term_answer.assignments and not term_answer.negation:
+                completions = _anti_join(completions, term_answer.assignments)
+            elif term_matched and not _get_variables(bound.term) - set(mapping.keys()):
+                # Negation of an existing fully bound term
+                return []
+        else:
+            if not bound.matched(db, term_answer):
+                return []
+            if term_answer.negation:
+                completions = _anti_join(completions, term_answer.assignments)
+            elif term_answer.assignments:
+                completions = [
+                    joint for joint in (c.join(a) for c in completions for a in term_answer.assignments)
+                    if joint is not None]
+        if not completions:
+            return []
+    return completions
+
+def _sampled_from_index(term: LogicalExpression) -> bool:
+    if isinstance(term, LinkTemplate):
+        return term.ordered
+    if isinstance(term, Link):
+        return term.ordered and \
+            not any(isinstance(t, (Link, LinkTemplate)) for t in term.targets) and \
+            any(isinstance(t, Variable) for t in term.targets)
+    return False
+
+def _sample_term(db: DBInterface, term: Union[Link, LinkTemplate], size: int) -> Tuple[List[Optional[Assignment]], int]:
+    """
+    Random sample of the links matching a term (as assignments, None for the
+    rejected links) along with the number of links matching the term.
+    """
+    if isinstance(term, Link):
+        target_handles = [target.get_handle(db) for target in term.targets]
+        matched = db.sample_matched_links(term.atom_type, target_handles, size, term.target_types)
+    else:
+        template = [term.link_type, *[v.type for v in term.targets]]
+        matched = db.sample_matched_type_template(template, size)
+    total = _term_cardinality(db, term)
+    return [term._assign_variables(db, link, targets) for link, targets in matched], total
+
+def _term_cardinality(db: DBInterface, term: Union[Link, LinkTemplate]) -> int:
+    if isinstance(term, Link):
+        target_handles = [target.get_handle(db) for target in term.targets]
+        return db.count_matched_links(term.atom_type, target_handles, term.target_types)
+    else:
+        return db.count_matched_type_template([term.link_type, *[v.type for v in term.targets]])
+
+def sample(
+    db: DBInterface,
+    query: LogicalExpression,
+    size: int,
+    answer: PatternMatchingAnswer) -> Tuple[List[Assignment], float]:
+    """
+    Up to size assignments drawn uniformly at random from the ones which
+    satisfy the query, along with an estimate of how many assignments satisfy
+    it.
+
+    Single Link/LinkTemplate terms are sampled directly from the index (with
+    rejection of the links which don't make a valid assignment). In an And,
+    the positive Link/LinkTemplate term with the smallest index entry is
+    sampled and the other terms are evaluated only for the sampled
+    assignments. Since every sampled assignment is completed in all possible
+    ways, every answer has the same probability of being drawn. The sample is
+    doubled until it yields enough answers. Other queries are evaluated in
+    full and sampled afterwards.
+    """
+    if _sampled_from_index(query):
+        driver, rest = query, []
+    elif isinstance(query, And):
+        candidates = [term for term in query.terms if _sampled_from_index(term)]
+        if candidates:
+            driver = min(candidates, key=lambda term: _term_cardinality(db, term))
+            rest = [term for term in query.terms if term is not driver]
+        else:
+            driver = None
+    else:
+        driver = None
+    if driver is None:
+        if not query.matched(db, answer):
+            return [], 0.0
+        if answer.negation:
+            raise ValueError(f'Negative queries can not be sampled: {query}')
+        assignments = list(answer.assignments)
+        return random.sample(assignments, min(size, len(assignments))), float(len(assignments))
+    sample_size = size
+    while True:
+        sampled, total = _sample_term(db, driver, sample_size)
+        results = []
+        for assignment in sampled:
+            if assignment is not None:
+                results.extend(_complete(db, assignment, rest, answer.context))
+        if len(results) >= size or len(sampled) >= total or len(sampled) < sample_size:
+            break
+        sample_size *= 2
+    estimate = total * len(results) / len(sampled) if sampled else 0.0
+    return random.sample(results, min(size, len(results))), estimate
+
+def _flatten_and(terms: List[LogicalExpression]) -> List[LogicalExpression]:
+    answer = []
+    for term in terms:
+        if isinstance(term, And):
+            answer.extend(_flatten_and(term.terms))
+        else:
+            answer.append(term)
+    return answer
+
+def check_standing_query(query: LogicalExpression) -> None:
+    """
+    Raise ValueError if the query can't be evaluated incrementally (see
+    delta()): it must be a Link, a LinkTemplate, an And of them (possibly
+    with negations) or an Or of such queries.
+    """
+    if isinstance(query, Or):
+        for term in query.terms:
+            check_standing_query(term)
+        return
+    terms = _flatten_and(query.terms) if isinstance(query, And) else [query]
+    for term in terms:
+        if isinstance(term, Not) and isinstance(query, And):
+            continue
+        if isinstance(term, LinkTemplate):
+            continue
+        if isinstance(term, Link) and not any(isinstance(t, LinkTemplate) for t in term.targets):
+            continue
+        raise ValueError(f'Invalid term in standing query: {term}')
+
+def _match_new_link(
+    db: DBInterface,
+    term: Union[Link, LinkTemplate],
+    link_type: str,
+    targets: List[str],
+    target_types: List[str]) -> List[Assignment]:
+    """
+    Assignments which make the term match the passed link, built as in
+    query() (unordered terms yield UnorderedAssignments and LinkTemplate
+    types are matched by DBInterface.type_template_matches()).
+    """
+    if isinstance(term, LinkTemplate):
+        template = [term.link_type, *[v.type for v in term.targets]]
+        if len(term.targets) != len(targets) or not db.type_template_matches(template, [link_type, *target_types]):
+            return []
+        assignment = term._assign_variables(db, None, targets)
+        return [assignment] if assignment else []
+    if term.atom_type != link_type or len(term.targets) != len(targets):
+        return []
+    if term.ordered:
+        orderings = [range(len(targets))]
+    else:
+        orderings = permutations(range(len(targets)))
+    answer = []
+    for ordering in orderings:
+        assignment = OrderedAssignment()
+        for term_target, i in zip(term.targets, ordering):
+            if isinstance(term_target, TypedVariable) and term_target.type != target_types[i]:
+                break
+            if isinstance(term_target, Variable):
+                if not assignment.assign(term_target.name, targets[i]):
+                    break
+            elif term_target.get_handle(db) != targets[i]:
+                break
+        else:
+            if assignment.freeze() and assignment not in answer:
+                answer.append(assignment)
+    if answer and not term.ordered and any(isinstance(t, Variable) for t in term.targets):
+        assignment = term._assign_variables(db, None, targets)
+        return [assignment] if assignment else []
+    return answer
+
+def delta(
+    db: DBInterface,
+    query: LogicalExpression,
+    new_links: List[Tuple[str, List[str], List[str]]],
+    answer: PatternMatchingAnswer) -> Set[Assignment]:
+    """
+    Assignments which satisfy the query (evaluated against the DB which
+    already contains the new links) and use at least one of the new links,
+    i.e. the ones which didn't satisfy the query before the new links were
+    added. New links are (link_type, target_handles, target_types) tuples.
+
+    Semi-naive evaluation: for each Link/LinkTemplate term, the new links
+    matching it are joined with the other terms, evaluated only for the
+    variables bound by the new link. Negations are applied to the new
+    assignments but assignments invalidated by the new links aren't
+    reported.
+    """
+    check_standing_query(query)
+    if isinstance(query, Or):
+        result = set()
+        for term in query.terms:
+            result.update(delta(db, term, new_links, answer))
+        return result
+    terms = _flatten_and(query.terms) if isinstance(query, And) else [query]
+    result = set()
+    for i, term in enumerate(terms):
+        if isinstance(term, Not):
+            continue
+        other_terms = terms[:i] + terms[i + 1:]
+        for link_type, targets, target_types in new_links:
+            for assignment in _match_new_link(db, term, link_type, targets, target_types):
+                result.update(_complete(db, assignment, other_terms, answer.context))
+    return result
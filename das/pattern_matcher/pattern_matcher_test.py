@@ -1,13 +1,18 @@
+import random
 from copy import deepcopy
 
 import pytest
 
-from das.pattern_matcher.pattern_matcher import (And, CompatibilityStatus,
+from das.pattern_matcher.pattern_matcher import (CONFIG, And, Closure, CompatibilityStatus,
                                                  Link, LogicalExpression, Node,
-                                                 Not, OrderedAssignment,
-                                                 PatternMatchingAnswer, LinkTemplate,
+                                                 Not, Or, OrderedAssignment,
+                                                 Parameter, PatternMatchingAnswer, LinkTemplate,
+                                                 PreparedQuery, _anti_join, _estimated_cost, match_many, count, project, sample, delta,
+                                                 profile, explain, QueryBudget, QueryContext,
                                                  UnorderedAssignment, Variable, TypedVariable)
+from das.database.db_interface import DBInterface, WILDCARD
 from das.database.stub_db import StubDB
+from das.exceptions import QueryBudgetExceeded, UnsupportedOperationError
 
 
 def test_basic_matching():
@@ -623,3 +628,547 @@ def test_patterns():
         ],
         -1
     )
+
+def test_db_without_optional_lookups():
+    # DB implementing only the abstract methods of DBInterface
+    methods = {name: getattr(StubDB, name) for name in DBInterface.__abstractmethods__}
+    MinimalDB = type('MinimalDB', (DBInterface,), {'__init__': StubDB.__init__, **methods})
+    db = MinimalDB()
+    stub_db = StubDB()
+    assert db.get_link_pattern_hash('Inheritance', [WILDCARD, WILDCARD]) is None
+    for query in [
+        Link('Inheritance', [Variable('V1'), Node('Concept', 'mammal')], True),
+        LinkTemplate('Similarity', [TypedVariable('V1', 'Concept'), TypedVariable('V2', 'Concept')], False),
+    ]:
+        answer = PatternMatchingAnswer()
+        expected_answer = PatternMatchingAnswer()
+        assert query.matched(db, answer)
+        assert query.matched(stub_db, expected_answer)
+        assert answer.assignments == expected_answer.assignments
+    with pytest.raises(UnsupportedOperationError):
+        db.get_incoming(Node('Concept', 'mammal').get_handle(db))
+    with pytest.raises(UnsupportedOperationError):
+        Link('Inheritance', [TypedVariable('V1', 'Concept'), Variable('V2')], True).matched(db, PatternMatchingAnswer())
+
+def test_subterm_memoization():
+
+    class CountingStubDB(StubDB):
+        def __init__(self):
+            super().__init__()
+            self.fetch_count = 0
+        def get_matched_links(self, link_type, target_handles):
+            self.fetch_count += 1
+            return super().get_matched_links(link_type, target_handles)
+        def get_matched_type_template(self, template):
+            self.fetch_count += 1
+            return super().get_matched_type_template(template)
+        def get_matched_template(self, template_hash):
+            self.fetch_count += 1
+            return super().get_matched_template(template_hash)
+
+    db = CountingStubDB()
+    mammal = Node('Concept', 'mammal')
+    query = And([
+        Link('Inheritance', [Variable('V1'), mammal], True),
+        Or([
+            Link('Inheritance', [Variable('V1'), mammal], True),
+            And([
+                Link('Inheritance', [Variable('V1'), mammal], True),
+                LinkTemplate('Similarity', [TypedVariable('V1', 'Concept'), TypedVariable('V2', 'Concept')], True),
+            ]),
+            LinkTemplate('Similarity', [TypedVariable('V1', 'Concept'), TypedVariable('V2', 'Concept')], True),
+        ])
+    ])
+    answer = PatternMatchingAnswer()
+    assert query.matched(db, answer)
+    assert db.fetch_count == 2
+    memoized = sorted(str(assignment) for assignment in answer.assignments)
+
+    # Each query has its own context, so nothing leaks from previous answers
+    answer = PatternMatchingAnswer()
+    assert query.matched(db, answer)
+    assert db.fetch_count == 4
+
+    CONFIG['memoize_subterms'] = False
+    try:
+        answer = PatternMatchingAnswer()
+        assert query.matched(db, answer)
+        assert db.fetch_count == 9
+        assert sorted(str(assignment) for assignment in answer.assignments) == memoized
+    finally:
+        CONFIG['memoize_subterms'] = True
+
+def test_custom_expression():
+
+    class Everything(LogicalExpression):
+        # External expression without a structural key
+        def __init__(self, term):
+            self.term = term
+        def matched(self, db, answer):
+            return self.term.matched(db, answer)
+
+    db = StubDB()
+    link = Link('Inheritance', [Variable('V1'), Node('Concept', 'mammal')], True)
+    first, second = Everything(link), Everything(link)
+    assert first.structural_key() != second.structural_key()
+    assert Not(first).structural_key() != Not(second).structural_key()
+    answer = PatternMatchingAnswer()
+    expected_answer = PatternMatchingAnswer()
+    assert And([first, second]).matched(db, answer)
+    assert link.matched(db, expected_answer)
+    assert sorted(str(a) for a in answer.assignments) == sorted(str(a) for a in expected_answer.assignments)
+
+def test_prepared_query():
+
+    db: StubDB = StubDB()
+    mammal = Node('Concept', 'mammal')
+    query = And([
+        Not(Link('Similarity', [Variable('V1'), Node('Concept', 'ent')], False)),
+        Link('Inheritance', [Variable('V1'), Variable('V2')], True),
+        Link('Inheritance', [Variable('V1'), mammal], True),
+        Link('Similarity', [Variable('V1'), Parameter('similar', 'Concept')], False),
+    ])
+    prepared = PreparedQuery(db, query)
+    # Original query is left untouched
+    assert isinstance(query.terms[0], Not)
+    # Most selective terms first, negations last
+    assert [_estimated_cost(term) for term in prepared.query.terms] == [1, 1, 2, float('inf')]
+    assert list(prepared.parameters.keys()) == ['similar']
+
+    with pytest.raises(ValueError):
+        prepared.execute({}, PatternMatchingAnswer())
+
+    for similar, expected in [('human', ['chimp', 'monkey']), ('snake', []), ('monkey', ['chimp'])]:
+        answer = PatternMatchingAnswer()
+        plain_query = And([
+            Not(Link('Similarity', [Variable('V1'), Node('Concept', 'ent')], False)),
+            Link('Inheritance', [Variable('V1'), Variable('V2')], True),
+            Link('Inheritance', [Variable('V1'), mammal], True),
+            Link('Similarity', [Variable('V1'), Node('Concept', similar)], False),
+        ])
+        plain_answer = PatternMatchingAnswer()
+        assert prepared.execute({'similar': similar}, answer) == plain_query.matched(db, plain_answer)
+        assert sorted(str(a) for a in answer.assignments) == sorted(str(a) for a in plain_answer.assignments)
+        assert sorted(str(a.ordered_mapping) for a in answer.assignments) == \
+            sorted(str({'V1': f'<Concept: {name}>', 'V2': '<Concept: mammal>'}) for name in expected)
+
+class KeyedStubDB(StubDB):
+    """
+    StubDB with support to lookups by precomputed index keys
+    """
+
+    def __init__(self):
+        super().__init__()
+        self.patterns = {}
+        self.single_fetch_count = 0
+        self.batch_fetch_count = 0
+
+    def get_link_pattern_hash(self, link_type, target_handles):
+        key = str([link_type, *target_handles])
+        self.patterns[key] = (link_type, target_handles)
+        return key
+
+    def get_matched_pattern(self, pattern_hash):
+        self.single_fetch_count += 1
+        return self.get_matched_links(*self.patterns[pattern_hash])
+
+    def get_matched_patterns(self, pattern_hashes):
+        self.batch_fetch_count += 1
+        return {key: self.get_matched_links(*self.patterns[key]) for key in pattern_hashes}
+
+def test_match_many():
+
+    db = KeyedStubDB()
+    mammal = Node('Concept', 'mammal')
+    queries = [
+        And([Link('Inheritance', [Variable('V1'), mammal], True),
+             Link('Similarity', [Variable('V1'), Variable('V2')], False)]),
+        Link('Inheritance', [Variable('X'), mammal], True),
+        Link('Similarity', [Variable('V1'), Node('Concept', 'human')], False),
+        And([Link('Inheritance', [Variable('V1'), mammal], True),
+             Not(Link('Similarity', [Variable('V1'), Node('Concept', 'human')], False))]),
+    ]
+    answers = match_many(db, queries)
+    assert db.batch_fetch_count == 1
+    assert db.single_fetch_count == 0
+    assert len(db.patterns) == 3
+    assert len(answers) == len(queries)
+    for query, (matched, answer) in zip(queries, answers):
+        expected_answer = PatternMatchingAnswer()
+        assert matched == query.matched(StubDB(), expected_answer)
+        assert sorted(str(a) for a in answer.assignments) == sorted(str(a) for a in expected_answer.assignments)
+
+def test_profile():
+
+    db = StubDB()
+    mammal = Node('Concept', 'mammal')
+    query = And([
+        Link('Inheritance', [Variable('V1'), mammal], True),
+        Link('Similarity', [Variable('V1'), Variable('V2')], False),
+        Not(Link('Inheritance', [Variable('V2'), mammal], True)),
+    ])
+    answer = PatternMatchingAnswer()
+    expected_answer = PatternMatchingAnswer()
+    matched, profiler = profile(db, query, answer)
+    assert answer.context.profiler is None
+    assert matched == query.matched(db, expected_answer)
+    assert sorted(str(a) for a in answer.assignments) == sorted(str(a) for a in expected_answer.assignments)
+    root = profiler.to_dict()
+    assert root['operator'] == 'And'
+    assert root['strategy'] == 'nested loop join + anti-join'
+    assert root['matched'] == matched
+    assert root['output_assignments'] == len(answer.assignments)
+    assert [child['operator'] for child in root['children']] == ['Link', 'Link', 'Not']
+    assert [child['strategy'] for child in root['children']] == ['pattern index lookup'] * 2 + ['negation']
+    assert root['db_calls'] == sum(child['db_calls'] for child in root['children'])
+    assert root['db_calls'] > 0
+    assert root['fetched_bytes'] > 0
+    assert root['children'][2]['children'][0]['operator'] == 'Link'
+
+def test_explain():
+
+    db = StubDB()
+    mammal = Node('Concept', 'mammal')
+    query = And([
+        Link('Inheritance', [Variable('V1'), mammal], True),
+        Link('Similarity', [Variable('V1'), Variable('V2')], False),
+        Or([
+            Link('Inheritance', [Variable('V2'), mammal], True),
+            Link('Inheritance', [Node('Concept', 'human'), mammal], True),
+        ]),
+    ])
+    plan = explain(db, query)
+    assert plan['operator'] == 'And'
+    inheritance, similarity, union = plan['children']
+    assert inheritance['strategy'] == 'pattern index lookup'
+    assert inheritance['estimated_cardinality'] == len(db.get_matched_links('Inheritance', ['*', mammal.get_handle(db)]))
+    assert similarity['estimated_cardinality'] == len(db.get_matched_links('Similarity', ['*', '*']))
+    assert union['strategy'] == 'union'
+    assert union['children'][1]['strategy'] == 'existence check'
+    assert union['estimated_cardinality'] == inheritance['estimated_cardinality'] + 1
+    assert plan['estimated_cardinality'] == min(inheritance['estimated_cardinality'], similarity['estimated_cardinality'],
+                                                union['estimated_cardinality'])
+
+def test_query_budget():
+
+    db = StubDB()
+    query = And([
+        Link('Inheritance', [Variable('V1'), Variable('V2')], True),
+        Link('Inheritance', [Variable('V2'), Variable('V3')], True),
+    ])
+    unlimited_answer = PatternMatchingAnswer(QueryContext(budget=QueryBudget()))
+    assert query.matched(db, unlimited_answer)
+    statistics = unlimited_answer.context.budget.statistics()
+    assert statistics['fetched_members'] > 0
+    assert statistics['max_intermediate_assignments'] >= len(unlimited_answer.assignments)
+
+    with pytest.raises(QueryBudgetExceeded) as exception:
+        query.matched(db, PatternMatchingAnswer(QueryContext(budget=QueryBudget(max_fetched_members=1))))
+    assert exception.value.budget == 'fetched members'
+    assert exception.value.statistics['fetched_members'] > 1
+
+    with pytest.raises(QueryBudgetExceeded) as exception:
+        query.matched(db, PatternMatchingAnswer(QueryContext(budget=QueryBudget(max_assignments=2))))
+    assert exception.value.budget == 'intermediate assignments'
+    assert exception.value.statistics['max_intermediate_assignments'] == 3
+
+    with pytest.raises(QueryBudgetExceeded) as exception:
+        query.matched(db, PatternMatchingAnswer(QueryContext(budget=QueryBudget(max_time=0))))
+    assert exception.value.budget == 'wall time'
+
+    budget = QueryBudget()
+    budget.cancel()
+    with pytest.raises(QueryBudgetExceeded) as exception:
+        query.matched(db, PatternMatchingAnswer(QueryContext(budget=budget)))
+    assert exception.value.budget == 'cancelled'
+
+def test_typed_variable_link():
+
+    db = StubDB()
+    human = Node('Concept', 'human')
+    mammal = Node('Concept', 'mammal')
+
+    answer = PatternMatchingAnswer()
+    assert Link('Inheritance', [human, TypedVariable('V1', 'Concept')], True).matched(db, answer)
+    assert [a.mapping for a in answer.assignments] == [{'V1': mammal.get_handle(db)}]
+    assert not Link('Inheritance', [human, TypedVariable('V1', 'Predicate')], True).matched(db, PatternMatchingAnswer())
+
+    typed_answer = PatternMatchingAnswer()
+    untyped_answer = PatternMatchingAnswer()
+    assert Link('Similarity', [human, TypedVariable('V1', 'Concept')], False).matched(db, typed_answer)
+    assert Link('Similarity', [human, Variable('V1')], False).matched(db, untyped_answer)
+    assert sorted(str(a) for a in typed_answer.assignments) == sorted(str(a) for a in untyped_answer.assignments)
+
+    answer = PatternMatchingAnswer()
+    query = And([
+        Link('Inheritance', [Variable('V1'), mammal], True),
+        Link('Similarity', [Variable('V1'), TypedVariable('V2', 'Concept')], False),
+    ])
+    expected_answer = PatternMatchingAnswer()
+    expected_query = And([
+        Link('Inheritance', [Variable('V1'), mammal], True),
+        Link('Similarity', [Variable('V1'), Variable('V2')], False),
+    ])
+    assert query.matched(db, answer) == expected_query.matched(db, expected_answer)
+    assert sorted(str(a) for a in answer.assignments) == sorted(str(a) for a in expected_answer.assignments)
+
+def test_existence_filter():
+
+    class CountingStubDB(StubDB):
+        def __init__(self):
+            super().__init__()
+            self.link_exists_count = 0
+            self.links_exist_count = 0
+        def link_exists(self, link_type, targets):
+            self.link_exists_count += 1
+            return super().link_exists(link_type, targets)
+        def links_exist(self, links):
+            self.links_exist_count += 1
+            return super().links_exist(links)
+
+    db = CountingStubDB()
+    answer = PatternMatchingAnswer()
+    for name in ['human', 'monkey', 'chimp']:
+        assignment = OrderedAssignment()
+        assignment.assign('V1', Node('Concept', name).get_handle(db))
+        assignment.freeze()
+        answer.assignments.add(assignment)
+    assert not Link('Inheritance', [Node('Concept', 'human'), Node('Concept', 'animal')], True).matched(db, answer)
+    assert not answer.assignments
+    assert db.link_exists_count == 4
+    assert db.links_exist_count == 1
+
+def test_anti_join():
+
+    def ordered(mapping):
+        assignment = OrderedAssignment()
+        for variable, value in mapping.items():
+            assignment.assign(variable, value)
+        assignment.freeze()
+        return assignment
+
+    def unordered(mapping):
+        assignment = UnorderedAssignment()
+        for variable, value in mapping.items():
+            assignment.assign(variable, value)
+        assignment.freeze()
+        return assignment
+
+    assignments = [
+        ordered({'V1': 'a', 'V2': 'b'}),
+        ordered({'V1': 'a', 'V2': 'c'}),
+        ordered({'V1': 'b', 'V2': 'c'}),
+        ordered({'V1': 'c', 'V2': 'a', 'V3': 'b'}),
+        unordered({'V1': 'a', 'V2': 'd'}),
+    ]
+    for forbidden in [
+        set([ordered({'V1': 'a'})]),
+        set([ordered({'V1': 'a', 'V2': 'c'}), ordered({'V2': 'a'}), ordered({'V3': 'c'})]),
+        set([ordered({'V1': 'b', 'V2': 'c'}), unordered({'V1': 'c', 'V2': 'b'})]),
+        set([ordered({'V1': 'd'}), ordered({'V1': 'd', 'V3': 'd'})]),
+        set([ordered({'V1': 'b', 'V2': 'c'}), ordered({'V1': 'a', 'V2': 'c'})]),
+    ]:
+        # assignments[:3] have all the same variables (set difference path)
+        for candidates in [assignments, assignments[:3]]:
+            expected = [a for a in candidates if all(a.check_negation(tabu) for tabu in forbidden)]
+            assert _anti_join(candidates, forbidden) == expected
+
+def test_count_and_project():
+
+    class CountingStubDB(StubDB):
+        def __init__(self):
+            super().__init__()
+            self.fetch_count = 0
+            self.index_count = 0
+        def get_matched_links(self, link_type, target_handles):
+            self.fetch_count += 1
+            return super().get_matched_links(link_type, target_handles)
+        def count_matched_links(self, link_type, target_handles, target_types=None):
+            self.index_count += 1
+            return len(super().get_matched_links(link_type, target_handles))
+
+    db = CountingStubDB()
+    mammal = Node('Concept', 'mammal')
+    inheritance = Link('Inheritance', [Variable('V1'), Variable('V2')], True)
+    assert count(db, inheritance, PatternMatchingAnswer()) == 12
+    assert db.fetch_count == 0
+    assert db.index_count == 1
+    answer = PatternMatchingAnswer()
+    inheritance.matched(db, answer)
+    assert len(answer.assignments) == 12
+
+    query = And([
+        Link('Inheritance', [Variable('V1'), mammal], True),
+        Link('Inheritance', [Variable('V1'), Variable('V2')], True),
+        Link('Inheritance', [Variable('V2'), Variable('V3')], True),
+        Not(Link('Inheritance', [Variable('V1'), Node('Concept', 'rhino')], True)),
+    ])
+    full_answer = PatternMatchingAnswer()
+    assert query.matched(db, full_answer)
+    assert count(db, query, PatternMatchingAnswer()) == len(full_answer.assignments)
+    assert project(db, query, ['V3'], PatternMatchingAnswer()) == [(Node('Concept', 'animal').get_handle(db),)]
+    for variables in [['V1'], ['V1', 'V3'], ['V3', 'V2']]:
+        expected = [tuple(a.mapping[v] for v in variables) for a in full_answer.assignments]
+        assert project(db, query, variables, PatternMatchingAnswer()) == sorted(set(expected))
+        assert sorted(project(db, query, variables, PatternMatchingAnswer(), distinct=False)) == sorted(expected)
+    with pytest.raises(ValueError):
+        project(db, query, ['V4'], PatternMatchingAnswer())
+
+def test_sample():
+
+    random.seed(0)
+    db = StubDB()
+    mammal = Node('Concept', 'mammal')
+    queries = [
+        Link('Inheritance', [Variable('V1'), Variable('V2')], True),
+        And([
+            Link('Inheritance', [Variable('V1'), Variable('V2')], True),
+            Link('Inheritance', [Variable('V2'), Variable('V3')], True),
+        ]),
+        And([
+            Link('Inheritance', [Variable('V1'), mammal], True),
+            Link('Similarity', [Variable('V1'), TypedVariable('V2', 'Concept')], False),
+            Not(Link('Similarity', [Variable('V2'), Node('Concept', 'monkey')], False)),
+        ]),
+        Or([
+            Link('Inheritance', [Variable('V1'), mammal], True),
+            Link('Inheritance', [Variable('V1'), Node('Concept', 'plant')], True),
+        ]),
+    ]
+    for query in queries:
+        expected_answer = PatternMatchingAnswer()
+        query.matched(StubDB(), expected_answer)
+        expected = set(str(a) for a in expected_answer.assignments)
+        for size in [1, 2, 100]:
+            assignments, estimate = sample(db, query, size, PatternMatchingAnswer())
+            assert len(assignments) == min(size, len(expected))
+            assert len(set(str(a) for a in assignments)) == len(assignments)
+            assert all(str(a) in expected for a in assignments)
+            if size == 100:
+                # Everything is sampled so the estimate is exact
+                assert estimate == len(expected)
+            else:
+                assert estimate > 0
+
+def test_delta():
+
+    def concept(name):
+        return Node('Concept', name).get_handle(db)
+
+    db = StubDB()
+    mammal = Node('Concept', 'mammal')
+    queries = [
+        Link('Inheritance', [Variable('V1'), mammal], True),
+        And([
+            Link('Inheritance', [Variable('V1'), Variable('V2')], True),
+            Link('Inheritance', [Variable('V2'), Variable('V3')], True),
+            Not(Link('Inheritance', [Variable('V1'), Node('Concept', 'plant')], True)),
+        ]),
+        Or([
+            Link('Inheritance', [Variable('V1'), Node('Concept', 'reptile')], True),
+            And([
+                Link('Inheritance', [Variable('V1'), TypedVariable('V2', 'Concept')], True),
+                Link('Similarity', [Variable('V1'), Variable('V3')], False),
+            ]),
+        ]),
+    ]
+    before = []
+    for query in queries:
+        answer = PatternMatchingAnswer()
+        query.matched(db, answer)
+        before.append(set(str(a) for a in answer.assignments))
+    new_links = [
+        ('Inheritance', [concept('ent'), concept('mammal')], ['Concept', 'Concept']),
+        ('Inheritance', [concept('plant'), concept('reptile')], ['Concept', 'Concept']),
+    ]
+    for link_type, targets, _ in new_links:
+        db.all_links.append([link_type, *targets])
+    for query, before_assignments in zip(queries, before):
+        answer = PatternMatchingAnswer()
+        query.matched(db, answer)
+        after_assignments = set(str(a) for a in answer.assignments)
+        assert after_assignments - before_assignments
+        assert set(str(a) for a in delta(db, query, new_links, PatternMatchingAnswer())) == \
+            after_assignments - before_assignments
+
+def test_delta_unordered():
+
+    def concept(name):
+        return Node('Concept', name).get_handle(db)
+
+    db = StubDB()
+    queries = [
+        Link('Similarity', [Variable('V1'), Variable('V2')], False),
+        Link('Similarity', [Node('Concept', 'reptile'), Variable('V1')], False),
+        LinkTemplate('Similarity', [TypedVariable('V1', 'Concept'), TypedVariable('V2', 'Concept')], False),
+        And([
+            Link('Similarity', [Variable('V1'), Variable('V2')], False),
+            Link('Similarity', [Variable('V2'), Variable('V3')], False),
+        ]),
+    ]
+    before = []
+    for query in queries:
+        answer = PatternMatchingAnswer()
+        query.matched(db, answer)
+        before.append(set(answer.assignments))
+    new_link = ['Similarity', concept('mammal'), concept('reptile')]
+    db.all_links.append(new_link)
+    db.template_index[str(['Similarity', 'Concept', 'Concept'])].append([str(new_link), new_link[1:]])
+    new_links = [(new_link[0], new_link[1:], ['Concept', 'Concept'])]
+    for query, before_assignments in zip(queries, before):
+        answer = PatternMatchingAnswer()
+        query.matched(db, answer)
+        after_assignments = set(answer.assignments) - before_assignments
+        assert after_assignments
+        assignments = delta(db, query, new_links, PatternMatchingAnswer())
+        if not isinstance(query, And):
+            assert all(isinstance(a, UnorderedAssignment) for a in assignments)
+        assert assignments == after_assignments
+
+def test_closure():
+
+    def values(assignments, variable):
+        return set(a.mapping[variable] for a in assignments)
+
+    def concepts(*names):
+        return set(Node('Concept', name).get_handle(db) for name in names)
+
+    db = StubDB()
+    triceratops = Node('Concept', 'triceratops')
+    animal = Node('Concept', 'animal')
+
+    answer = PatternMatchingAnswer()
+    assert Closure('Inheritance', triceratops, Variable('V1')).matched(db, answer)
+    assert values(answer.assignments, 'V1') == concepts('dinosaur', 'reptile', 'animal')
+
+    answer = PatternMatchingAnswer()
+    assert Closure('Inheritance', triceratops, Variable('V1'), max_depth=2, reflexive=True).matched(db, answer)
+    assert values(answer.assignments, 'V1') == concepts('triceratops', 'dinosaur', 'reptile')
+
+    answer = PatternMatchingAnswer()
+    assert Closure('Inheritance', Variable('V1'), Node('Concept', 'reptile')).matched(db, answer)
+    assert values(answer.assignments, 'V1') == concepts('snake', 'dinosaur', 'triceratops')
+
+    assert Closure('Inheritance', triceratops, animal).matched(db, PatternMatchingAnswer())
+    assert not Closure('Inheritance', animal, triceratops).matched(db, PatternMatchingAnswer())
+    assert not Closure('Inheritance', triceratops, animal, max_depth=2).matched(db, PatternMatchingAnswer())
+
+    # Only the levels of the search hit the DB
+    _, profiler = profile(db, Closure('Inheritance', triceratops, Variable('V1')), PatternMatchingAnswer())
+    assert profiler.to_dict()['strategy'] == 'breadth first search'
+    assert profiler.to_dict()['db_calls'] == 4
+
+    answer = PatternMatchingAnswer()
+    assert Closure('Inheritance', Variable('V1'), Variable('V2')).matched(db, answer)
+    pairs = set((a.mapping['V1'], a.mapping['V2']) for a in answer.assignments)
+    assert len(pairs) == 20
+    assert (triceratops.get_handle(db), animal.get_handle(db)) in pairs
+    assert (animal.get_handle(db), triceratops.get_handle(db)) not in pairs
+
+    # Animals which aren't mammals
+    answer = PatternMatchingAnswer()
+    assert And([
+        Closure('Inheritance', Variable('V1'), animal),
+        Not(Closure('Inheritance', Variable('V1'), Node('Concept', 'mammal'), reflexive=True)),
+    ]).matched(db, answer)
+    assert values(answer.assignments, 'V1') == concepts('reptile', 'snake', 'dinosaur', 'triceratops', 'earthworm')
@@ -0,0 +1,138 @@
+import pickle
+import time
+from typing import Any, Callable, Dict, List, Optional
+
+from das.database.db_interface import DBInterface
+
+# DBInterface methods which actually hit the DB (other methods just compute
+# hashes or read prefetched caches)
+FETCH_METHODS = set([
+    'node_exists',
+    'link_exists',
+    'links_exist',
+    'get_link_targets',
+    'get_link_targets_many',
+    'get_incoming',
+    'get_incoming_many',
+    'is_ordered',
+    'get_matched_links',
+    'get_matched_links_many',
+    'get_matched_typed_links',
+    'get_all_nodes',
+    'get_matched_type_template',
+    'get_matched_type',
+    'get_node_name',
+    'get_matched_node_name',
+    'get_matched_pattern',
+    'get_matched_template',
+    'get_matched_patterns',
+    'get_matched_templates',
+    'count_matched_links',
+    'sample_matched_links',
+    'sample_matched_type_template',
+    'count_matched_type_template',
+])
+
+class ProfilingDB:
+    """
+    Proxy to a DBInterface which counts the calls to the DB and the amount of
+    data they return. The size of the data is estimated by the size of its
+    pickled representation.
+    """
+
+    def __init__(self, db: DBInterface):
+        self.db = db
+        self.call_count = 0
+        self.fetched_bytes = 0
+
+    def __repr__(self):
+        return f'<ProfilingDB: {self.db}>'
+
+    def __getattr__(self, name):
+        attribute = getattr(self.db, name)
+        if name not in FETCH_METHODS:
+            return attribute
+        def counted_call(*args, **kwargs):
+            answer = attribute(*args, **kwargs)
+            self.call_count += 1
+            self.fetched_bytes += len(pickle.dumps(answer))
+            return answer
+        return counted_call
+
+class ProfileNode:
+    """
+    Statistics of the evaluation of one operator of a query.
+
+    Time, DB calls and fetched bytes are inclusive (i.e. they account for the
+    operator's children as well).
+    """
+
+    def __init__(self, operator: str, expression: Optional[str]):
+        self.operator = operator
+        self.expression = expression
+        self.strategy: Optional[str] = None
+        self.matched: Optional[bool] = None
+        self.wall_time: float = 0.0
+        self.db_calls: int = 0
+        self.fetched_bytes: int = 0
+        self.input_assignments: int = 0
+        self.output_assignments: int = 0
+        self.children: List['ProfileNode'] = []
+
+    def to_dict(self) -> Dict[str, Any]:
+        answer = {'operator': self.operator}
+        if self.expression is not None:
+            answer['expression'] = self.expression
+        answer.update({
+            'strategy': self.strategy,
+            'matched': self.matched,
+            'wall_time': self.wall_time,
+            'db_calls': self.db_calls,
+            'fetched_bytes': self.fetched_bytes,
+            'input_assignments': self.input_assignments,
+            'output_assignments': self.output_assignments,
+            'children': [child.to_dict() for child in self.children],
+        })
+        return answer
+
+class QueryProfiler:
+    """
+    Builds a tree of ProfileNode mirroring the operators evaluated by a
+    query. It's attached to the QueryContext of the query being profiled.
+    """
+
+    def __init__(self, db: DBInterface):
+        self.db = ProfilingDB(db)
+        self.root: Optional[ProfileNode] = None
+        self.stack: List[ProfileNode] = []
+
+    def set_strategy(self, strategy: str) -> None:
+        if self.stack:
+            self.stack[-1].strategy = strategy
+
+    def run(self, matched: Callable, expression: Any, answer: Any) -> bool:
+        if type(expression).__name__ in ['And', 'Or', 'Not']:
+            node = ProfileNode(type(expression).__name__, None)
+        else:
+            node = ProfileNode(type(expression).__name__, repr(expression))
+        if self.stack:
+            self.stack[-1].children.append(node)
+        else:
+            self.root = node
+        node.input_assignments = len(answer.assignments)
+        call_count = self.db.call_count
+        fetched_bytes = self.db.fetched_bytes
+        self.stack.append(node)
+        start = time.perf_counter()
+        try:
+            node.matched = matched(expression, self.db, answer)
+        finally:
+            node.wall_time = time.perf_counter() - start
+            self.stack.pop()
+            node.db_calls = self.db.call_count - call_count
+            node.fetched_bytes = self.db.fetched_bytes - fetched_bytes
+            node.output_assignments = len(answer.assignments)
+        return node.matched
+
+    def to_dict(self) -> Optional[Dict[str, Any]]:
+        return self.root.to_dict() if self.root is not None else None
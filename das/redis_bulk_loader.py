@@ -0,0 +1,215 @@
+import time
+from typing import Any, Dict, Iterable, List, Tuple, Union
+
+from redis.cluster import RedisCluster
+from redis.crc import key_slot
+from redis.exceptions import AskError, ConnectionError, MovedError, ResponseError, TimeoutError
+
+from das.logger import logger
+
+# Number of commands sent to a node in each round trip
+REDIS_BULK_BATCH_SIZE = 1000
+# Number of times a batch is resent after a connection error
+REDIS_BULK_MAX_RETRIES = 3
+# Seconds to wait before the first retry (doubled in each retry)
+REDIS_BULK_RETRY_DELAY = 1.0
+
+def _to_bytes(value: Union[str, bytes]) -> bytes:
+    return value if isinstance(value, bytes) else value.encode()
+
+def encode_command(*args: Union[str, bytes]) -> bytes:
+    """
+    Command encoded in the Redis protocol (RESP).
+    """
+    chunks = [b"*%d\r\n" % len(args)]
+    for arg in args:
+        arg = _to_bytes(arg)
+        chunks.append(b"$%d\r\n%s\r\n" % (len(arg), arg))
+    return b"".join(chunks)
+
+# Sent before a command redirected by an ASK error (see AskError)
+ASKING_COMMAND = encode_command("ASKING")
+
+class RedisBulkLoader:
+    """
+    Pipelined SADD of many keys. Commands are encoded in RESP, grouped by
+    the node which owns their key (the hash slot of the key is used to find
+    the node in a Redis cluster) and sent to each node through a single
+    connection, batch_size commands at a time.
+
+    Batches which fail because of a connection error are resent (SADD is
+    idempotent) up to max_retries times. Commands redirected by a MOVED
+    error (and, in a cluster, batches being resent) are routed again after
+    the cluster's slot map is refreshed. Commands redirected by an ASK error
+    (slot being migrated) are sent to the node in the error preceded by
+    ASKING.
+    """
+
+    def __init__(
+        self,
+        redis: Any,
+        batch_size: int = REDIS_BULK_BATCH_SIZE,
+        max_retries: int = REDIS_BULK_MAX_RETRIES,
+        retry_delay: float = REDIS_BULK_RETRY_DELAY):
+        self.redis = redis
+        self.cluster = isinstance(redis, RedisCluster)
+        self.batch_size = batch_size
+        self.max_retries = max_retries
+        self.retry_delay = retry_delay
+        # Client and pending (key, command, asking) of each node
+        self.batches: Dict[str, Tuple[Any, List[Tuple[bytes, bytes, bool]]]] = {}
+        self.connections: Dict[str, Tuple[Any, Any]] = {}
+        self.commands = 0
+        self.members = 0
+        self.bytes = 0
+        self.round_trips = 0
+        self.retries = 0
+        self.start_time = time.perf_counter()
+
+    def _node(self, key: bytes) -> Tuple[str, Any]:
+        if self.cluster:
+            node = self.redis.nodes_manager.get_node_from_slot(key_slot(key))
+            return node.name, node.redis_connection
+        return "default", self.redis
+
+    def _connection(self, node_name: str, client: Any) -> Any:
+        if node_name not in self.connections:
+            pool = client.connection_pool
+            self.connections[node_name] = (pool, pool.get_connection())
+        return self.connections[node_name][1]
+
+    def _release(self, node_name: str, disconnect: bool = False) -> None:
+        if node_name in self.connections:
+            pool, connection = self.connections.pop(node_name)
+            if disconnect:
+                connection.disconnect()
+            pool.release(connection)
+
+    def _add(self, key: bytes, command: bytes) -> None:
+        node_name, client = self._node(key)
+        batch = self.batches.setdefault(node_name, (client, []))[1]
+        batch.append((key, command, False))
+        if len(batch) >= self.batch_size:
+            self._send(node_name, *self.batches.pop(node_name))
+
+    def _send_batch(
+        self,
+        node_name: str,
+        client: Any,
+        batch: List[Tuple[bytes, bytes, bool]]) -> Tuple[List[Tuple[bytes, bytes, bool]], List[Tuple[AskError, bytes, bytes]]]:
+        # Returns the commands redirected by MOVED and by ASK errors
+        connection = self._connection(node_name, client)
+        connection.send_packed_command(
+            [b"".join(ASKING_COMMAND + command if asking else command for _, command, asking in batch)],
+            check_health=False)
+        moved = []
+        asked = []
+        error = None
+        for key, command, asking in batch:
+            try:
+                if asking:
+                    connection.read_response()
+                connection.read_response()
+            except MovedError:
+                moved.append((key, command, False))
+            except AskError as exception:
+                asked.append((exception, key, command))
+            except ResponseError as exception:
+                error = error or exception
+        self.round_trips += 1
+        if error is not None:
+            raise error
+        return moved, asked
+
+    def _send(self, node_name: str, client: Any, batch: List[Tuple[bytes, bytes, bool]], attempt: int = 0) -> None:
+        try:
+            moved, asked = self._send_batch(node_name, client, batch)
+        except (ConnectionError, TimeoutError) as exception:
+            self._release(node_name, disconnect=True)
+            if attempt == self.max_retries:
+                raise
+            self.retries += 1
+            delay = self.retry_delay * (2 ** attempt)
+            logger().error(f"Error sending {len(batch)} commands to Redis node {node_name}: " + \
+                f"{exception}. Retrying in {delay} seconds.")
+            time.sleep(delay)
+            self._retry(batch, attempt + 1)
+            return
+        if moved or asked:
+            if attempt == self.max_retries:
+                raise ResponseError(f"{len(moved) + len(asked)} commands still redirected after {attempt} retries")
+            self.retries += 1
+        if moved:
+            self._retry(moved, attempt + 1)
+        if asked:
+            self._ask(asked, attempt + 1)
+
+    def _retry(self, batch: List[Tuple[bytes, bytes, bool]], attempt: int) -> None:
+        # Commands are routed again since, in a cluster, their slots may
+        # have moved to other nodes
+        if self.cluster:
+            self.redis.nodes_manager.initialize()
+        routed: Dict[str, Tuple[Any, List[Tuple[bytes, bytes, bool]]]] = {}
+        for key, command, _ in batch:
+            node_name, client = self._node(key)
+            routed.setdefault(node_name, (client, []))[1].append((key, command, False))
+        for node_name, (client, node_batch) in routed.items():
+            self._send(node_name, client, node_batch, attempt)
+
+    def _ask(self, asked: List[Tuple[AskError, bytes, bytes]], attempt: int) -> None:
+        # Commands go to the node importing their slot, which accepts them
+        # only right after ASKING. The slot map isn't changed.
+        routed: Dict[str, Tuple[Any, List[Tuple[bytes, bytes, bool]]]] = {}
+        for exception, key, command in asked:
+            node = self.redis.nodes_manager.get_node(host=exception.host, port=exception.port)
+            if node is None:
+                self.redis.nodes_manager.initialize()
+                node = self.redis.nodes_manager.get_node(host=exception.host, port=exception.port)
+            routed.setdefault(node.name, (node.redis_connection, []))[1].append((key, command, True))
+        for node_name, (client, node_batch) in routed.items():
+            self._send(node_name, client, node_batch, attempt)
+
+    def sadd(self, key: Union[str, bytes], members: Iterable[Union[str, bytes]]) -> None:
+        members = list(members)
+        if not members:
+            return
+        key = _to_bytes(key)
+        command = encode_command(b"SADD", key, *members)
+        self.commands += 1
+        self.members += len(members)
+        self.bytes += len(command)
+        self._add(key, command)
+
+    def flush(self) -> None:
+        """
+        Send all the pending commands.
+        """
+        while self.batches:
+            node_name, (client, batch) = self.batches.popitem()
+            self._send(node_name, client, batch)
+
+    def metrics(self) -> Dict[str, Any]:
+        elapsed = time.perf_counter() - self.start_time
+        return {
+            'commands': self.commands,
+            'members': self.members,
+            'bytes': self.bytes,
+            'round_trips': self.round_trips,
+            'retries': self.retries,
+            'elapsed': elapsed,
+            'commands_per_second': self.commands / elapsed if elapsed > 0 else 0.0,
+        }
+
+    def close(self) -> None:
+        """
+        Send all the pending commands and release the connections.
+        """
+        try:
+            self.flush()
+        finally:
+            for node_name in list(self.connections.keys()):
+                self._release(node_name)
+        metrics = self.metrics()
+        logger().info(f"Redis bulk load: {metrics['commands']} commands, {metrics['members']} members, " + \
+            f"{metrics['bytes']} bytes, {metrics['round_trips']} round trips, {metrics['retries']} retries, " + \
+            f"{metrics['commands_per_second']:.0f} commands/s")
@@ -0,0 +1,150 @@
+from redis.cluster import RedisCluster
+from redis.crc import key_slot
+from redis.exceptions import AskError, MovedError
+from das.redis_bulk_loader import RedisBulkLoader, encode_command
+
+def test_encode_command():
+    assert encode_command("SADD", "key", b"a\r\nb") == b"*3\r\n$4\r\nSADD\r\n$3\r\nkey\r\n$4\r\na\r\nb\r\n"
+    assert encode_command("SADD", "ké", "") == b"*3\r\n$4\r\nSADD\r\n$3\r\nk\xc3\xa9\r\n$0\r\n\r\n"
+
+def _decode_commands(packed):
+    commands = []
+    lines = packed.split(b"\r\n")
+    i = 0
+    while i < len(lines) - 1:
+        count = int(lines[i][1:])
+        commands.append([lines[i + 2 + 2 * j] for j in range(count)])
+        i += 1 + 2 * count
+    return commands
+
+class FakeConnection:
+    # Node of a fake cluster. Slots are served if owned (new keys of slots
+    # being migrated are redirected by ASK) or, right after ASKING, if being
+    # imported.
+    def __init__(self, cluster, name):
+        self.cluster = cluster
+        self.name = name
+        self.sets = {}
+        self.importing = set()
+        self.migrating = {}
+        self.commands = []
+        self.responses = []
+        self.asking = False
+
+    def send_packed_command(self, packed, check_health=True):
+        for command in _decode_commands(b"".join(packed)):
+            self.commands.append(command[0])
+            if command[0] == b"ASKING":
+                self.asking = True
+                self.responses.append(b"OK")
+                continue
+            key = command[1]
+            slot = key_slot(key)
+            owner = self.cluster.owners.get(slot, "a")
+            if slot in self.migrating and key not in self.sets:
+                self.responses.append(AskError(f"{slot} {self.migrating[slot]}:6379"))
+            elif owner == self.name or (self.asking and slot in self.importing):
+                self.sets.setdefault(key, set()).update(command[2:])
+                self.responses.append(len(command) - 2)
+            else:
+                self.responses.append(MovedError(f"{slot} {owner}:6379"))
+            self.asking = False
+
+    def read_response(self):
+        response = self.responses.pop(0)
+        if isinstance(response, Exception):
+            raise response
+        return response
+
+    def disconnect(self):
+        pass
+
+class FakePool:
+    def __init__(self, connection):
+        self.connection = connection
+    def get_connection(self):
+        return self.connection
+    def release(self, connection):
+        pass
+
+class FakeClient:
+    def __init__(self, connection):
+        self.connection_pool = FakePool(connection)
+
+class FakeNode:
+    def __init__(self, connection):
+        self.name = f"{connection.name}:6379"
+        self.redis_connection = FakeClient(connection)
+
+class FakeNodesManager:
+    def __init__(self, cluster):
+        self.cluster = cluster
+        self.slots = {}
+        self.initialize_count = 0
+    def initialize(self):
+        self.initialize_count += 1
+        self.slots = dict(self.cluster.owners)
+    def get_node_from_slot(self, slot):
+        return self.cluster.nodes[self.slots.get(slot, "a")]
+    def get_node(self, host=None, port=None, node_name=None):
+        return self.cluster.nodes.get(host)
+
+class FakeCluster(RedisCluster):
+    def __init__(self, owners):
+        # Owner node ("a" or "b") of each slot ("a" if missing)
+        self.owners = owners
+        self.connections = {name: FakeConnection(self, name) for name in ["a", "b"]}
+        self.nodes = {name: FakeNode(connection) for name, connection in self.connections.items()}
+        self.nodes_manager = FakeNodesManager(self)
+        self.nodes_manager.initialize()
+
+KEYS = [f"key_{i}".encode() for i in range(20)]
+
+def test_batching():
+    connection = FakeConnection(FakeCluster({}), "a")
+    loader = RedisBulkLoader(FakeClient(connection), batch_size=3)
+    for key in KEYS[:7]:
+        loader.sadd(key, [b"x", b"y"])
+    assert loader.round_trips == 2
+    loader.close()
+    assert loader.round_trips == 3
+    assert connection.sets == {key: {b"x", b"y"} for key in KEYS[:7]}
+
+def test_cluster_routing():
+    cluster = FakeCluster({key_slot(key): "b" for key in KEYS[::2]})
+    loader = RedisBulkLoader(cluster, batch_size=5)
+    for key in KEYS:
+        loader.sadd(key, [b"x"])
+    loader.close()
+    assert set(cluster.connections["a"].sets) == set(KEYS[1::2])
+    assert set(cluster.connections["b"].sets) == set(KEYS[::2])
+    assert loader.round_trips == 4
+    assert loader.retries == 0
+
+def test_moved():
+    cluster = FakeCluster({})
+    cluster.owners = {key_slot(key): "b" for key in KEYS[::2]}
+    loader = RedisBulkLoader(cluster, batch_size=100)
+    for key in KEYS:
+        loader.sadd(key, [b"x"])
+    loader.close()
+    assert set(cluster.connections["a"].sets) == set(KEYS[1::2])
+    assert set(cluster.connections["b"].sets) == set(KEYS[::2])
+    assert cluster.nodes_manager.initialize_count == 2
+    assert loader.retries == 1
+
+def test_ask():
+    cluster = FakeCluster({})
+    migrating = {key_slot(key) for key in KEYS[:3]}
+    cluster.connections["a"].migrating = {slot: "b" for slot in migrating}
+    cluster.connections["b"].importing = migrating
+    loader = RedisBulkLoader(cluster, batch_size=100)
+    for key in KEYS:
+        loader.sadd(key, [b"x"])
+    loader.close()
+    assert set(cluster.connections["a"].sets) == set(KEYS[3:])
+    assert set(cluster.connections["b"].sets) == set(KEYS[:3])
+    assert cluster.connections["b"].commands == [b"ASKING", b"SADD"] * 3
+    # The slot map isn't refreshed by ASK redirections
+    assert cluster.nodes_manager.initialize_count == 1
+    assert loader.retries == 1
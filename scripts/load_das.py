@@ -8,6 +8,8 @@ def run():
 
     parser.add_argument('--knowledge-base', type=str, help='Path to a file or directory with a MeTTA knowledge base')
     parser.add_argument('--canonical', help='Optimized load for canonical knowledge bases', action='store_true')
+    parser.add_argument('--processes', type=int, help='Number of processes used to parse knowledge bases ' + \
+        '(by default, 1 for canonical knowledge bases and the number of CPUs otherwise)')
 
     args = parser.parse_args()
 
@@ -15,9 +17,9 @@ def run():
 
     if args.knowledge_base:
         if args.canonical:
-            das.load_canonical_knowledge_base(args.knowledge_base)
+            das.load_canonical_knowledge_base(args.knowledge_base, args.processes or 1)
         else:
-            das.load_knowledge_base(args.knowledge_base)
+            das.load_knowledge_base(args.knowledge_base, args.processes)
 
 if __name__ == "__main__":
     run()
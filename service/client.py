@@ -21,6 +21,7 @@ class ClientCommands(str, Enum):
     SEARCH_LINKS = "search_links"
     SEARCH_NODES = "search_nodes"
     QUERY = "query"
+    DEGREE_STATISTICS = "degree_statistics"
 
 def _check(response):
     assert response.success,response.msg
@@ -60,6 +61,16 @@ def main():
              "whose targets are 'key1' and 'key2' are returned.")
     parser.add_argument("--query", type=str, 
         help="Query string for 'query' command.")
+    parser.add_argument("--max-time", type=float, default=0,
+        help="Maximum wall time (in seconds) of a query. 0 means unlimited.")
+    parser.add_argument("--max-fetched-members", type=int, default=0,
+        help="Maximum number of index members fetched by a query. 0 means unlimited.")
+    parser.add_argument("--max-assignments", type=int, default=0,
+        help="Maximum number of intermediate assignments in a query. 0 means unlimited.")
+    parser.add_argument("--recompute", action="store_true",
+        help="Compute degree statistics again instead of returning the stored ones.")
+    parser.add_argument("--top-k", type=int, default=0,
+        help="Number of hubs reported by 'degree_statistics' when recomputing. 0 means the server default.")
     parser.add_argument("--output-format", default=f"{OutputFormat.HANDLE}",
         choices=[fmt.value for fmt in OutputFormat],
         help=f"Tells how the query or node/link search output should be formatted. " + \
@@ -155,9 +166,20 @@ def main():
             query_request = pb2.Query(
                 key=das_key,
                 query=query,
-                output_format=output_format)
+                output_format=output_format,
+                max_time=args.max_time,
+                max_fetched_members=args.max_fetched_members,
+                max_assignments=args.max_assignments)
             response = _check(stub.query(query_request))
             print(f"{response.msg}")
+        elif command == ClientCommands.DEGREE_STATISTICS:
+            assert args.das_key
+            statistics_request = pb2.StatisticsRequest(
+                key=args.das_key,
+                recompute=args.recompute,
+                top_k=args.top_k)
+            response = _check(stub.degree_statistics(statistics_request))
+            print(f"{response.msg}")
     
 if __name__ == "__main__":
     main()
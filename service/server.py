@@ -14,9 +14,12 @@ import das_pb2 as pb2
 import das_pb2_grpc as pb2_grpc
 from das.distributed_atom_space import DistributedAtomSpace, QueryOutputFormat
 from das.database.db_interface import UNORDERED_LINK_TYPES
-from das.pattern_matcher.pattern_matcher import Node, Link, And, Or, Not, Variable
+from das.pattern_matcher.pattern_matcher import Node, Link, And, Or, Not, Variable, QueryBudget
+from das.exceptions import QueryBudgetExceeded
 
 SERVICE_PORT = 7025
+# Number of hubs reported by degree_statistics when the request doesn't set it
+DEFAULT_TOP_K = 100
 COUCHBASE_SETUP_DIR = os.environ['COUCHBASE_SETUP_DIR']
 
 def build_random_string(length):
@@ -198,6 +201,8 @@ class ServiceDefinition(pb2_grpc.ServiceDefinitionServicer):
         try:
             callable_method = getattr(DistributedAtomSpace, method)
             answer = callable_method(*[das, *args])
+        except QueryBudgetExceeded as exception:
+            return self._error(str(exception))
         except Exception as exception:
             formatted_lines = traceback.format_exc().splitlines()
             return self._error(str(exception) + " " + str(formatted_lines))
@@ -242,7 +247,21 @@ class ServiceDefinition(pb2_grpc.ServiceDefinitionServicer):
             query = _parse_query(query_str)
             if query is None:
                 return self._error(f"Invalid query")
-            return self._basic_das_call(request.key, "query", [query, output_format])
+            budget = QueryBudget(
+                max_time=request.max_time if request.max_time else None,
+                max_fetched_members=request.max_fetched_members if request.max_fetched_members else None,
+                max_assignments=request.max_assignments if request.max_assignments else None)
+            # Interrupts the query if the client cancels the call or its deadline expires
+            context.add_callback(budget.cancel)
+            return self._basic_das_call(request.key, "query", [query, output_format, budget])
+
+    def degree_statistics(self, request, context):
+        with self.locked_scope:
+            if request.recompute:
+                top_k = request.top_k if request.top_k else DEFAULT_TOP_K
+                return self._basic_das_call(request.key, "compute_degree_statistics", [top_k])
+            else:
+                return self._basic_das_call(request.key, "get_degree_statistics", [])
 
 def main():
     server = grpc.server(futures.ThreadPoolExecutor(max_workers=10))
@@ -0,0 +1,42 @@
+import os
+import sys
+from types import SimpleNamespace
+
+os.environ.setdefault('COUCHBASE_SETUP_DIR', '')
+sys.path.append(os.path.dirname(__file__))
+
+from server import ServiceDefinition, AtomSpaceStatus, OutputFormat
+from das.distributed_atom_space import DistributedAtomSpace
+from das.database.stub_db import StubDB
+
+class FakeContext:
+    def __init__(self):
+        self.callbacks = []
+    def add_callback(self, callback):
+        self.callbacks.append(callback)
+
+def _service():
+    # DAS over a StubDB so the calls go through the DistributedAtomSpace API
+    das = DistributedAtomSpace.__new__(DistributedAtomSpace)
+    das.db = StubDB()
+    service = ServiceDefinition()
+    service.atom_spaces['key'] = das
+    service.atom_space_status['key'] = AtomSpaceStatus.READY
+    return service
+
+def test_query():
+    service = _service()
+    request = SimpleNamespace(
+        key='key',
+        query='Node n1 Concept mammal, Link Inheritance $v1 n1',
+        output_format=OutputFormat.HANDLE,
+        max_time=0,
+        max_fetched_members=0,
+        max_assignments=0)
+    context = FakeContext()
+    response = service.query(request, context)
+    assert response.success, response.msg
+    assert '<Concept: human>' in response.msg
+    assert len(context.callbacks) == 1
+    request.query = 'Link Inheritance $v1 n1'
+    assert not service.query(request, context).success